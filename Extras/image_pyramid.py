@@ -1,18 +1,33 @@
+import os
+import time
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 import cv2
 
 '''source: https://theailearner.com/tag/image-blending-with-pyramid-and-mask/'''
 
-aircraft = cv2.imread('Data/08_11_2023/Frame_53.jpg')
-#scene = cv2.imread('Data/08_11_2023/Frame_93.jpg')
-scene = cv2.imread('Data/10_11_2023/Frame_9.jpg')
-mask = np.load('mask.npy')
+'''
+Laplacian pyramid blending of object cutouts into apron scenes, for synthetic training data.
 
-mask = cv2.resize(mask, (aircraft.shape[1], aircraft.shape[0]), interpolation = cv2.INTER_NEAREST)
-mask = mask.astype(np.float32)
-mask = np.repeat(mask[:,:,np.newaxis], 3, axis = 2)
-print (f'Mask Shape: {mask.shape}')
+PyramidBlender pastes any number of objects into a scene in one pass: the objects and their masks are composited
+into one foreground and mask canvas, so the scene needs one blend/reconstruct whatever the object count. Only the
+region around the objects (plus a margin for the pyramid blur) is blended; the rest of the scene is copied.
+Scene pyramids are cached (scenes are reused across many pastes), all levels use float32 buffers that are allocated
+once per scene size, and a YOLO-seg label line is produced for the visible part of every pasted mask.
+
+    blender = PyramidBlender(num_levels = 5)
+    image, labels = blender.blend_objects('Data/10_11_2023/Frame_9.jpg',
+                                          [PastedObject('Data/08_11_2023/Frame_53.jpg', 'mask.npy', 0, 0, class_id = 0)])
+
+`augment_many` spreads jobs over a process pool; `python3 Extras/image_pyramid.py --benchmark` compares images/sec
+with the original one-image script (`legacy_blend`).
+'''
+
+# A YOLO-seg polygon needs at least 3 points
+MIN_POLYGON_POINTS = 3
 
 # Find the Gaussian pyramid of the two images and the mask
 def gaussian_pyramid(img, num_levels):
@@ -57,34 +72,357 @@ def reconstruct(laplacian_pyr):
     return laplacian_lst
 
 
+def legacy_blend(scene, aircraft, mask, num_levels = 5):
+    '''
+    The original one-object blend: every pyramid is rebuilt for every image
+    '''
+    mask = cv2.resize(mask, (aircraft.shape[1], aircraft.shape[0]), interpolation = cv2.INTER_NEAREST)
+    mask = mask.astype(np.float32)
+    mask = np.repeat(mask[:,:,np.newaxis], 3, axis = 2)
+
+    # Calculate Gaussian and Laplacian for Scene
+    gaussian_pyr_1 = gaussian_pyramid(scene, num_levels)
+    laplacian_pyr_1 = laplacian_pyramid(gaussian_pyr_1)
+
+    # Calculate Gaussian and Laplacian for Object
+    gaussian_pyr_2 = gaussian_pyramid(aircraft, num_levels)
+    laplacian_pyr_2 = laplacian_pyramid(gaussian_pyr_2)
+
+    # Calculate the Gaussian pyramid for the mask image and reverse it.
+    mask_pyr_final = gaussian_pyramid(mask, num_levels)
+    mask_pyr_final.reverse()
+
+    # Blend the images
+    add_laplace = blend(laplacian_pyr_1,laplacian_pyr_2,mask_pyr_final)
+
+    # Reconstruct the images
+    final  = reconstruct(add_laplace)
+    return final[num_levels]
+
+
+def load_mask(mask_path):
+    '''Binary float32 mask from a .npy array or an image file'''
+    if mask_path.endswith('.npy'):
+        mask = np.load(mask_path)
+    else:
+        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+    mask = mask.astype(np.float32)
+    if mask.max() > 1:
+        mask /= 255.0
+    return mask
+
+
+class PastedObject:
+    '''
+    image --> path or BGR array of the object (cutout or full frame)
+    mask --> path or array, same size as the image (resized otherwise), 1 = object
+    x, y --> top-left position of the object in the scene
+    '''
+    def __init__(self, image, mask, x, y, class_id):
+        self.image = image
+        self.mask = mask
+        self.x = x
+        self.y = y
+        self.class_id = class_id
+
+    def load(self):
+        image = cv2.imread(self.image) if isinstance(self.image, str) else self.image
+        mask = load_mask(self.mask) if isinstance(self.mask, str) else self.mask.astype(np.float32)
+        if mask.shape[:2] != image.shape[:2]:
+            mask = cv2.resize(mask, (image.shape[1], image.shape[0]), interpolation = cv2.INTER_NEAREST)
+        return image, mask
+
+
+class PyramidBlender:
+    '''
+    num_levels --> pyramid levels
+    cache_size --> number of scene pyramids kept in memory (LRU)
+    max_points --> simplify label polygons to at most this many points, at least 3 (None: keep all)
+    '''
+    def __init__(self, num_levels = 5, cache_size = 16, max_points = None):
+        if max_points is not None and max_points < MIN_POLYGON_POINTS:
+            raise ValueError(f'max_points must be at least {MIN_POLYGON_POINTS}, got {max_points}')
+        self.num_levels = num_levels
+        self.cache_size = cache_size
+        self.max_points = max_points
+
+        self._scene_cache = OrderedDict()
+        self._buffers = None
+
+    def scene_pyramid(self, scene_path):
+        '''Cached (uint8 scene, float32 Laplacian pyramid of the scene)'''
+        cached = self._scene_cache.get(scene_path)
+        if cached is None:
+            scene = cv2.imread(scene_path)
+            cached = (scene, laplacian_pyramid(gaussian_pyramid(scene.astype(np.float32), self.num_levels)))
+            self._scene_cache[scene_path] = cached
+            if len(self._scene_cache) > self.cache_size:
+                self._scene_cache.popitem(last = False)
+        else:
+            self._scene_cache.move_to_end(scene_path)
+        return cached
+
+    def _level_buffers(self, pyramid):
+        '''
+        float32 work buffers per level (blended level, foreground difference), allocated once per scene size;
+        blends use views of the region of interest
+        '''
+        shapes = [level.shape for level in pyramid]
+        if self._buffers is None or [buffer.shape for buffer, _ in self._buffers] != shapes:
+            self._buffers = [(np.empty(shape, dtype = np.float32), np.empty(shape, dtype = np.float32)) for shape in shapes]
+        return self._buffers
+
+    def _region(self, scene_shape, placements):
+        '''
+        Region of interest around all objects: padded by a margin for the pyramid blur and aligned to
+        2**num_levels so every pyramid level of the scene can be cropped exactly. None if nothing is visible.
+        '''
+        height, width = scene_shape[:2]
+        boxes = [box for box in placements if box is not None]
+        if not boxes:
+            return None
+
+        step = 2 ** self.num_levels
+        margin = 4 * step
+        x0 = max(min(box[0] for box in boxes) - margin, 0) // step * step
+        y0 = max(min(box[1] for box in boxes) - margin, 0) // step * step
+        x1 = min(-(-(max(box[2] for box in boxes) + margin) // step) * step, width)
+        y1 = min(-(-(max(box[3] for box in boxes) + margin) // step) * step, height)
+        return x0, y0, x1, y1, margin
+
+    def _composite(self, scene_shape, objects):
+        '''
+        Paste all objects into one foreground and one mask canvas covering the region of interest.
+        Returns (region, foreground, mask, per-object visible uint8 masks in region coordinates)
+        '''
+        height, width = scene_shape[:2]
+        loaded = [pasted.load() for pasted in objects]
+
+        # Bounding box of every object's mask in the scene, clipped to the scene
+        placements = []
+        for pasted, (image, object_mask) in zip(objects, loaded):
+            bx, by, bw, bh = cv2.boundingRect((object_mask > 0.5).astype(np.uint8))
+            x0, y0 = max(pasted.x + bx, 0), max(pasted.y + by, 0)
+            x1, y1 = min(pasted.x + bx + bw, width), min(pasted.y + by + bh, height)
+            placements.append((x0, y0, x1, y1) if bw and bh and x1 > x0 and y1 > y0 else None)
+
+        region = self._region(scene_shape, placements)
+        if region is None:
+            return None, None, None, [None] * len(objects)
+        rx0, ry0, rx1, ry1, _ = region
+
+        foreground = np.zeros((ry1 - ry0, rx1 - rx0, 3), dtype = np.float32)
+        mask = np.zeros((ry1 - ry0, rx1 - rx0), dtype = np.float32)
+
+        # Overlap of each object image with the region, as (slices in the object, slices in the region)
+        overlaps = []
+        for pasted, (image, _) in zip(objects, loaded):
+            x0, y0 = max(pasted.x, rx0), max(pasted.y, ry0)
+            x1, y1 = min(pasted.x + image.shape[1], rx1), min(pasted.y + image.shape[0], ry1)
+            if x1 <= x0 or y1 <= y0:
+                overlaps.append(None)
+                continue
+            overlaps.append(((slice(y0 - pasted.y, y1 - pasted.y), slice(x0 - pasted.x, x1 - pasted.x)),
+                             (slice(y0 - ry0, y1 - ry0), slice(x0 - rx0, x1 - rx0))))
+
+        # The object images around the masks give the blend its context (as in the original full-frame blend) ...
+        for (image, _), overlap, box in zip(loaded, overlaps, placements):
+            if overlap is not None and box is not None:
+                foreground[overlap[1]] = image[overlap[0]]
+
+        # ... and the masked pixels are pasted on top, in order, so later objects cover earlier ones
+        object_masks = []
+        for (image, object_mask), overlap, box in zip(loaded, overlaps, placements):
+            if overlap is None or box is None:
+                object_masks.append(None)
+                continue
+            crop, target = overlap
+
+            region_mask = object_mask[crop]
+            inside = region_mask > 0.5
+            foreground[target][inside] = image[crop][inside]
+            np.maximum(mask[target], region_mask, out = mask[target])
+
+            full_mask = np.zeros(mask.shape, dtype = np.uint8)
+            full_mask[target][inside] = 255
+            object_masks.append(full_mask)
+
+        # Later objects occlude earlier ones, labels only cover the visible part
+        occluded = np.zeros(mask.shape, dtype = np.uint8)
+        for object_mask in reversed(object_masks):
+            if object_mask is not None:
+                visible = cv2.bitwise_and(object_mask, cv2.bitwise_not(occluded))
+                cv2.bitwise_or(occluded, object_mask, dst = occluded)
+                object_mask[:] = visible
+        return region, foreground, mask, object_masks
+
+    def _label(self, class_id, object_mask, offset, scene_size):
+        contours, _ = cv2.findContours(object_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return None
+        contour = max(contours, key = cv2.contourArea)
+        if self.max_points is not None and len(contour) > self.max_points:
+            epsilon = 0.001 * cv2.arcLength(contour, True)
+            while len(contour) > self.max_points:
+                coarser = cv2.approxPolyDP(contour, epsilon, True)
+                if len(coarser) < MIN_POLYGON_POINTS:
+                    # One step too far (e.g. a box collapsing to a line): keep max_points evenly spaced points instead
+                    contour = contour[np.linspace(0, len(contour) - 1, self.max_points).astype(int)]
+                    break
+                contour = coarser
+                epsilon *= 1.5
+        if len(contour) < MIN_POLYGON_POINTS:
+            return None
+        polygon = (contour.reshape(-1, 2) + np.array(offset)).astype(np.float32) / np.array(scene_size, dtype = np.float32)
+        return f'{class_id} ' + ' '.join(np.char.mod('%.6f', polygon.ravel()))
+
+    def blend_objects(self, scene_path, objects):
+        '''
+        Blend all objects into the scene in one pass. Returns (uint8 BGR image, list of YOLO-seg label lines)
+        '''
+        scene, scene_pyr = self.scene_pyramid(scene_path)
+        height, width = scene.shape[:2]
+        image = scene.copy()
+
+        region, foreground, mask, object_masks = self._composite(scene.shape, objects)
+        if region is None:
+            return image, []
+        x0, y0, x1, y1, margin = region
+
+        # Only the region around the objects changes: blend the cropped levels of the cached scene pyramid
+        foreground_pyr = laplacian_pyramid(gaussian_pyramid(foreground, self.num_levels))
+        mask_pyr = gaussian_pyramid(mask, self.num_levels)
+        mask_pyr.reverse()
+
+        # blended = scene + mask * (foreground - scene), level by level into views of the preallocated buffers
+        blended = []
+        for level, ((out, diff), la, lb, level_mask) in enumerate(zip(self._level_buffers(scene_pyr), scene_pyr, foreground_pyr, mask_pyr)):
+            shift = self.num_levels - level
+            h, w = lb.shape[:2]
+            la = la[y0 >> shift:(y0 >> shift) + h, x0 >> shift:(x0 >> shift) + w]
+            out, diff = out[:h, :w], diff[:h, :w]
+
+            np.subtract(lb, la, out = diff)
+            np.multiply(diff, level_mask[:, :, np.newaxis], out = diff)
+            np.add(la, diff, out = out)
+            blended.append(out)
+
+        final = reconstruct(blended)[self.num_levels]
+
+        # Paste back without the outer margin (crop borders of the pyramid), except at the image borders
+        px0, py0 = (margin // 2 if x0 > 0 else 0), (margin // 2 if y0 > 0 else 0)
+        px1, py1 = (x1 - x0) - (margin // 2 if x1 < width else 0), (y1 - y0) - (margin // 2 if y1 < height else 0)
+        image[y0 + py0:y0 + py1, x0 + px0:x0 + px1] = np.clip(final[py0:py1, px0:px1], 0, 255)
+
+        labels = []
+        for pasted, object_mask in zip(objects, object_masks):
+            if object_mask is not None:
+                label = self._label(pasted.class_id, object_mask, (x0, y0), (width, height))
+                if label is not None:
+                    labels.append(label)
+        return image, labels
+
+
+# One blender (and scene cache) per worker process
+_worker_blender = None
+
+
+def _init_worker(num_levels, cache_size, max_points):
+    global _worker_blender
+    _worker_blender = PyramidBlender(num_levels, cache_size, max_points)
+
+
+def _run_job(job):
+    scene_path, objects, image_path, label_path = job
+    image, labels = _worker_blender.blend_objects(scene_path, objects)
+    cv2.imwrite(image_path, image)
+    with open(label_path, 'w') as file:
+        file.write(''.join(label + '\n' for label in labels))
+    return image_path
+
+
+def augment_many(jobs, workers = None, num_levels = 5, cache_size = 16, max_points = None):
+    '''
+    jobs --> iterable of (scene_path, [PastedObject, ...], output image path, output label path)
+    Jobs are best grouped by scene so each worker's scene cache gets reused. Returns images/sec.
+    '''
+    jobs = list(jobs)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                             initargs = (num_levels, cache_size, max_points)) as pool:
+        # chunksize keeps consecutive jobs (same scene) on the same worker
+        for _ in pool.map(_run_job, jobs, chunksize = 8):
+            pass
+    elapsed = time.perf_counter() - start
+    return len(jobs) / elapsed if elapsed > 0 else 0.0
+
+
+def benchmark(scene_paths, object_path, mask_path, num_images = 20, workers = None, output_folder = 'augmented'):
+    '''
+    images/sec of the original script (legacy_blend, one object per image) versus the engine
+    '''
+    os.makedirs(output_folder, exist_ok = True)
+    aircraft = cv2.imread(object_path)
+    mask = load_mask(mask_path)
+
+    start = time.perf_counter()
+    for i in range(num_images):
+        scene = cv2.imread(scene_paths[i % len(scene_paths)])
+        final = legacy_blend(scene, aircraft, mask)
+        cv2.imwrite(os.path.join(output_folder, f'legacy_{i}.jpg'), np.clip(final, 0, 255).astype(np.uint8))
+    legacy = num_images / (time.perf_counter() - start)
+
+    blender = PyramidBlender()
+    pasted = [PastedObject(aircraft, mask, 0, 0, class_id = 0)]
+    start = time.perf_counter()
+    for i in range(num_images):
+        image, labels = blender.blend_objects(scene_paths[i % len(scene_paths)], pasted)
+        cv2.imwrite(os.path.join(output_folder, f'engine_{i}.jpg'), image)
+    engine = num_images / (time.perf_counter() - start)
+
+    jobs = [(scene_paths[i % len(scene_paths)], pasted, os.path.join(output_folder, f'pool_{i}.jpg'),
+             os.path.join(output_folder, f'pool_{i}.txt')) for i in range(num_images)]
+    jobs.sort(key = lambda job: job[0])
+    pool = augment_many(jobs, workers = workers)
 
-original_size = aircraft.shape[:2]
+    print (f'legacy script: {legacy:.2f} images/sec')
+    print (f'engine (1 process, cached scenes): {engine:.2f} images/sec')
+    print (f'engine (process pool): {pool:.2f} images/sec')
+    return legacy, engine, pool
 
-num_levels = 5
 
-# Calculate Gaussian and Laplacian for Scene
-gaussian_pyr_1 = gaussian_pyramid(scene, num_levels)
-laplacian_pyr_1 = laplacian_pyramid(gaussian_pyr_1)
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Pyramid Blending')
 
-# Calculate Gaussian and Laplacian for Object
-gaussian_pyr_2 = gaussian_pyramid(aircraft, num_levels)
-laplacian_pyr_2 = laplacian_pyramid(gaussian_pyr_2)
+    # Arguments
+    parser.add_argument('--benchmark', action = 'store_true', help = 'Compare images/sec of the original script and the engine')
+    parser.add_argument('--num_images', type = int, default = 20, help = 'Images per benchmark run, default = 20')
+    parser.add_argument('--workers', type = int, default = None, help = 'Processes for the pool benchmark, default = number of CPUs')
 
-# Calculate the Gaussian pyramid for the mask image and reverse it.
-mask_pyr_final = gaussian_pyramid(mask, num_levels)
-mask_pyr_final.reverse()
+    args = parser.parse_args()
+    return args
 
-# Blend the images
-add_laplace = blend(laplacian_pyr_1,laplacian_pyr_2,mask_pyr_final)
 
-# Reconstruct the images
-final  = reconstruct(add_laplace)
+if __name__ == '__main__':
+    args = parse_arguments()
 
-#final = reconstruct(add_laplace, original_size)
+    if args.benchmark:
+        benchmark(['Data/10_11_2023/Frame_9.jpg', 'Data/08_11_2023/Frame_93.jpg'], 'Data/08_11_2023/Frame_53.jpg',
+                  'mask.npy', num_images = args.num_images, workers = args.workers)
+    else:
+        aircraft = cv2.imread('Data/08_11_2023/Frame_53.jpg')
+        #scene = cv2.imread('Data/08_11_2023/Frame_93.jpg')
+        scene = cv2.imread('Data/10_11_2023/Frame_9.jpg')
+        mask = np.load('mask.npy')
+        print (f'Mask Shape: {mask.shape}')
 
-cv2.imwrite('pyramid2.jpg',final[num_levels])
+        final = legacy_blend(scene, aircraft, mask)
+        cv2.imwrite('pyramid2.jpg', final)
 
-final_img = cv2.cvtColor(final[num_levels], cv2.COLOR_BGR2RGB)
-final_img = final_img.astype(np.uint8)
+        final_img = cv2.cvtColor(final, cv2.COLOR_BGR2RGB)
+        final_img = final_img.astype(np.uint8)
 
-print (f'Final Image Size: {final_img.shape}')
\ No newline at end of file
+        print (f'Final Image Size: {final_img.shape}')
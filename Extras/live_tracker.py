@@ -1,80 +1,182 @@
 # Plot data in real time.
-import h5py
 import os
+import sys
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation, FFMpegWriter
+from matplotlib.animation import FuncAnimation
+from matplotlib.widgets import CheckButtons, TextBox
 
-# path to HDF5 file
-folder_path = 'Raw_Time_Series_Data'
-hdf5_file_path = os.path.join(folder_path, 'tracking_data.h5')
+# Allow importing the modules in the repository root when run as `python Extras/live_tracker.py`
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tracking_reader import TrackingTail
+from track_summary import TrackSummaries, flat_seconds
+from turnaround_events import CLASS_NAMES
 
-def read_hdf5_data():
+'''
+Live plot of the tracked centroids (x and y over time).
+
+Every tick only reads the rows appended since the last one (TrackingTail) and folds them into multi-resolution
+per-track summaries (track_summary.py). Each track is drawn as its mean line plus a min/max band at the resolution
+that fits the width of the axes. Only tracks with samples in the last --window seconds are queried and drawn, so
+a redraw costs the same after a minute or after a day.
+
+Classes and tracks are picked in the window while it runs (class check boxes, track IDs text box, empty = all):
+    python3 Extras/live_tracker.py --classes 0 1 4 7 --tracks 8 12 17 18
+'''
+
+
+def parse_arguments():
     '''
-    Reads the latest data from the HDF5 file
+        Command Line Argument Parser
     '''
-    with h5py.File(hdf5_file_path, 'r', swmr = True) as file:
-        if 'tracking_data' in file:
-            data = file['tracking_data'][:]
-        else:
-            data = np.array([])
-    
-    return data
+    parser = argparse.ArgumentParser('Live Tracker')
+
+    # Arguments
+    parser.add_argument('--source', type = str, default = os.path.join('Raw_Time_Series_Data', 'tracking_data.h5'), help = 'HDF5 file written by generate_time_series.py, default = Raw_Time_Series_Data/tracking_data.h5')
+    parser.add_argument('--classes', type = int, nargs = '+', default = [0, 1, 4, 7], help = 'Classes shown at start, default = 0 1 4 7')
+    parser.add_argument('--tracks', type = int, nargs = '*', default = [], help = 'Track IDs shown at start, default = every track')
+    parser.add_argument('--window', type = float, default = 3600, help = 'Only show the last WINDOW seconds, 0 for the whole history (redraws then grow with the number of tracks), default = 3600')
+    parser.add_argument('--legend', type = int, default = 15, help = 'Most recent tracks listed in the legend, default = 15')
+    parser.add_argument('--interval', type = int, default = 1000, help = 'Milliseconds between updates, default = 1000')
+
+    args = parser.parse_args()
+    return args
+
+
+args = parse_arguments()
+
+# The file stays open in SWMR mode, each tick only reads the rows appended since the previous one
+tail = TrackingTail(args.source)
+# Tracks that left the window are forgotten, so memory stays flat on a dashboard left running for days
+summaries = TrackSummaries(retention = args.window or None)
+
+# Selection, changed from the widgets at runtime
+selected_classes = set(args.classes)
+selected_tracks = set(args.tracks)
+
+# Setup the plot, with room for the widgets on the right
+fig, (ax1, ax2) = plt.subplots(2, 1, figsize = (12, 8))
+fig.subplots_adjust(right = 0.78)
+
+ax1.set_ylabel('X-Coordinate')
+ax2.set_xlabel('Time (hours, GMT+1)')
+ax2.set_ylabel('Y-Coordinate')
+
+class_box = CheckButtons(fig.add_axes([0.8, 0.45, 0.18, 0.4]), [CLASS_NAMES[c] for c in sorted(CLASS_NAMES)],
+                         [c in selected_classes for c in sorted(CLASS_NAMES)])
+track_box = TextBox(fig.add_axes([0.8, 0.35, 0.18, 0.05]), 'IDs ', initial = ' '.join(map(str, args.tracks)))
+
+# track ID --> (mean line, min/max band) on ax1 and ax2; updated in place instead of redrawing everything
+artists = {}
+
+# Hours on the x axis count from the start of the first day seen
+origin = None
+legend_tracks = None
+
+
+def visible(track_id):
+    if summaries.classes[track_id] not in selected_classes:
+        return False
+    return not selected_tracks or track_id in selected_tracks
+
+
+def band(time, low, high):
+    return [np.concatenate((np.column_stack((time, low)), np.column_stack((time[::-1], high[::-1]))))]
+
+
+def set_limits(ax, x_limits, y_limits):
+    for limit, setter in ((x_limits, ax.set_xlim), (y_limits, ax.set_ylim)):
+        margin = 0.05 * (limit[1] - limit[0]) or 1e-3
+        setter(limit[0] - margin, limit[1] + margin)
+
+
+def on_classes(label):
+    selected_classes.clear()
+    selected_classes.update(c for c, checked in zip(sorted(CLASS_NAMES), class_box.get_status()) if checked)
+    update_plot(None)
+    fig.canvas.draw_idle()
+
+
+def on_tracks(text):
+    selected_tracks.clear()
+    selected_tracks.update(int(value) for value in text.replace(',', ' ').split() if value.isdigit())
+    update_plot(None)
+    fig.canvas.draw_idle()
 
-# Setup the plot
-fig, (ax1, ax2) = plt.subplots(2, 1, figsize = (10, 8))
 
 def update_plot(frames):
     '''
-    Update the Plot with new data
+    Fold new rows into the summaries and redraw the visible tracks at the resolution of the axes
     '''
-    data = read_hdf5_data()
-    if data.size > 0:
-        # Filter data with obj_class corresponding to 0,1,4,7
-        classes_of_interest = [0,1,4,7]
-        id_of_interest = [8, 12, 17, 18]      # Remove
-        filtered_data = data[np.isin(data[:,6], classes_of_interest)]
-        filtered_data = filtered_data[np.isin(filtered_data[:,5], id_of_interest)]    #Remove
-
-        # Clear current axes
-        ax1.clear()
-        ax2.clear()
-
-        # Set limits & labels
-        ax1.set_xlabel('Time')
-        ax1.set_ylabel('X-Coordinate')
-        #ax1.set_xlim(0,1)
-        #ax1.set_ylim(0, 640)
-
-        ax2.set_xlabel('Time')
-        ax2.set_ylabel('Y-Coordinate')
-        #ax2.set_xlim(0,1)
-        #ax2.set_ylim(0, 640)
-
-        dictionary = {'0': 'Aircraft', '1': 'Airport_Tractor', '4': 'Fuel Truck', '7': 'Pushback Tug'}
-
-        # Plot each object class
-        for obj_class in classes_of_interest:
-            class_data = filtered_data[filtered_data[:, 6] == obj_class]    # Get only the instances with a specific class o or 1 or 4 or 7
-            # Time vs x-coordinate
-            if class_data.size > 0:
-                if obj_class == 0:
-                    id = 8
-                elif obj_class == 4:
-                    id = 12
-                elif obj_class == 1:
-                    id = 17
-
-                ax1.plot(class_data[:, 4], class_data[:,7], label = f'ID: {str(id)} {dictionary[str(obj_class)]}', linewidth = 0.9, alpha = 0.5)
-                ax2.plot(class_data[:, 4], class_data[:,8], label = f'ID: {str(id)} {dictionary[str(obj_class)]}', linewidth = 0.9, alpha = 0.5)
-
-        # Add legends
-        ax1.legend(loc = 'upper left')
-        ax2.legend(loc = 'upper left')
-
-        plt.tight_layout()
+    global origin, legend_tracks
+
+    data = tail.read_new()
+    if data.size:
+        columns = tail.columns
+        seconds = flat_seconds(data[:, columns['date']], data[:, columns['time']])
+        if origin is None:
+            origin = np.floor(seconds.min() / 86400) * 86400
+        summaries.append(data[:, columns['track_id']].astype(np.int64), data[:, columns['class']].astype(np.int64),
+                         seconds, data[:, columns['x']], data[:, columns['y']])
+
+    if summaries.latest is None:
+        return
+
+    # Only tracks with samples inside the window are queried and drawn; resolution from the axes width in pixels
+    t1 = summaries.latest
+    window_start = t1 - args.window if args.window else -np.inf
+    shown = [track_id for track_id in summaries.recent(window_start) if visible(track_id)]
+    t0 = max(window_start, min((summaries.time_range(track_id)[0] for track_id in shown), default = t1))
+    points = int(ax1.bbox.width)
+
+    # Tracks that left the window (or the selection) give their artists back
+    for track_id in set(artists) - set(shown):
+        for artist in artists.pop(track_id):
+            artist.remove()
+
+    limits = np.array([[np.inf, -np.inf]] * 2)
+    for track_id in shown:
+        summary = summaries.query(track_id, t0, t1, points)
+        hours = (summary.time - origin) / 3600
+        if track_id not in artists:
+            label = f'ID: {track_id} {CLASS_NAMES.get(summaries.classes[track_id], summaries.classes[track_id])}'
+            line_x, = ax1.plot([], [], label = label, linewidth = 0.9)
+            line_y, = ax2.plot([], [], label = label, linewidth = 0.9)
+            band_x = ax1.fill_between([], [], [], color = line_x.get_color(), alpha = 0.2, linewidth = 0)
+            band_y = ax2.fill_between([], [], [], color = line_y.get_color(), alpha = 0.2, linewidth = 0)
+            artists[track_id] = (line_x, band_x, line_y, band_y)
+
+        line_x, band_x, line_y, band_y = artists[track_id]
+        line_x.set_data(hours, summary.mean[:, 0])
+        line_y.set_data(hours, summary.mean[:, 1])
+        band_x.set_verts(band(hours, summary.low[:, 0], summary.high[:, 0]))
+        band_y.set_verts(band(hours, summary.low[:, 1], summary.high[:, 1]))
+
+        if len(summary.time):
+            limits[:, 0] = np.minimum(limits[:, 0], summary.low.min(axis = 0))
+            limits[:, 1] = np.maximum(limits[:, 1], summary.high.max(axis = 0))
+
+    time_limits = ((t0 - origin) / 3600, (t1 - origin) / 3600)
+    if np.isfinite(limits).all():
+        set_limits(ax1, time_limits, limits[0])
+        set_limits(ax2, time_limits, limits[1])
+
+    # Legends list the most recently updated tracks only, and only change when that list changes
+    legend = sorted(shown[:args.legend])
+    if legend != legend_tracks:
+        legend_tracks = legend
+        for ax, column in ((ax1, 0), (ax2, 2)):
+            if legend:
+                ax.legend(handles = [artists[track_id][column] for track_id in legend], loc = 'upper left', fontsize = 'small')
+            elif ax.get_legend() is not None:
+                ax.get_legend().remove()
+
 
+class_box.on_clicked(on_classes)
+track_box.on_submit(on_tracks)
 
 # start animation
-ani = FuncAnimation(fig, update_plot, frames = 15, interval = 1000)  # update every 0.5 seconds
+ani = FuncAnimation(fig, update_plot, interval = args.interval, cache_frame_data = False)
 plt.show()
+tail.close()
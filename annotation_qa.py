@@ -0,0 +1,271 @@
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from dataset_cache import YoloDataset, DATASET_DIR
+from inference_cache import InferenceCache, CachedPredictor, model_fingerprint
+
+'''
+Annotation QA: which labelled frames disagree most with the current model?
+
+The model runs once over a dataset split in batches; for every frame the predicted instance polygons are compared
+with the label polygons (dataset_cache.py) in a process pool, while the model works on the next batch:
+
+    - every polygon is rasterised once, at full resolution but only inside its bounding box
+    - box overlaps of all label/prediction pairs are tested at once with numpy; only overlapping pairs get a pixel
+      intersection, on the crop the two boxes share
+    - per class, pairs are matched greedily by IoU; the frame score of a class is
+      sum(matched IoU) / (labels + predictions - matches), so misses and extra detections count as 0
+
+The report ranks the worst frames per class (CSV with --output). --benchmark_kernel compares the IoU kernel with
+the naive per-pair approach (full resolution masks, one pair at a time) on the dataset's own polygons.
+With --cache DIR the predictions come from the inference cache (inference_cache.py) when the same model saw the frame.
+
+    python3 annotation_qa.py --weights weights/1024.pt --split valid --worst 10 --output qa_valid.csv
+    python3 annotation_qa.py --benchmark_kernel
+'''
+
+def rasterize_boxes(polygons):
+    '''
+    list of (k, 2) pixel polygons --> ((n, 4) int boxes x1, y1, x2, y2, list of uint8 masks of each box)
+    Every polygon is filled only inside its own bounding box.
+    '''
+    boxes = np.zeros((len(polygons), 4), dtype = np.int64)
+    masks = []
+    for index, polygon in enumerate(polygons):
+        points = np.round(np.asarray(polygon)).astype(np.int32).reshape(-1, 2)
+        if len(points) == 0:
+            masks.append(np.zeros((0, 0), dtype = np.uint8))
+            continue
+        x1, y1 = points.min(axis = 0)
+        x2, y2 = points.max(axis = 0) + 1
+        mask = np.zeros((y2 - y1, x2 - x1), dtype = np.uint8)
+        cv2.fillPoly(mask, [points - (x1, y1)], 1)
+        boxes[index] = (x1, y1, x2, y2)
+        masks.append(mask)
+    return boxes, masks
+
+
+def iou_matrix(label_polygons, pred_polygons):
+    '''
+    (n, m) mask IoU of all label/prediction pairs at full resolution. Box overlaps of all pairs are tested at once;
+    only overlapping pairs (a few per object) get a pixel intersection, on the crop both boxes share.
+    '''
+    ious = np.zeros((len(label_polygons), len(pred_polygons)), dtype = np.float32)
+    if len(label_polygons) == 0 or len(pred_polygons) == 0:
+        return ious
+
+    label_boxes, label_masks = rasterize_boxes(label_polygons)
+    pred_boxes, pred_masks = rasterize_boxes(pred_polygons)
+    label_areas = np.array([np.count_nonzero(mask) for mask in label_masks])
+    pred_areas = np.array([np.count_nonzero(mask) for mask in pred_masks])
+
+    top_left = np.maximum(label_boxes[:, None, :2], pred_boxes[None, :, :2])
+    bottom_right = np.minimum(label_boxes[:, None, 2:], pred_boxes[None, :, 2:])
+    overlapping = np.all(bottom_right > top_left, axis = 2)
+
+    for i, j in zip(*np.nonzero(overlapping)):
+        (x1, y1), (x2, y2) = top_left[i, j], bottom_right[i, j]
+        lx, ly = label_boxes[i, :2]
+        px, py = pred_boxes[j, :2]
+        intersection = np.count_nonzero(label_masks[i][y1 - ly:y2 - ly, x1 - lx:x2 - lx] &
+                                        pred_masks[j][y1 - py:y2 - py, x1 - px:x2 - px])
+        union = label_areas[i] + pred_areas[j] - intersection
+        ious[i, j] = intersection / union if union else 0.0
+    return ious
+
+
+def naive_iou_matrix(label_polygons, pred_polygons, shape):
+    '''
+    Reference: every pair rasterised at full resolution and compared one at a time
+    '''
+    ious = np.zeros((len(label_polygons), len(pred_polygons)), dtype = np.float32)
+    for i, label in enumerate(label_polygons):
+        for j, pred in enumerate(pred_polygons):
+            a = np.zeros(shape[:2], dtype = np.uint8)
+            b = np.zeros(shape[:2], dtype = np.uint8)
+            cv2.fillPoly(a, [np.round(label).astype(np.int32)], 1)
+            cv2.fillPoly(b, [np.round(pred).astype(np.int32)], 1)
+            union = np.logical_or(a, b).sum()
+            ious[i, j] = np.logical_and(a, b).sum() / union if union else 0.0
+    return ious
+
+
+def greedy_match(ious):
+    '''
+    Match pairs by decreasing IoU (> 0), each row and column at most once. Returns the matched IoUs.
+    '''
+    ious = ious.copy()
+    matched = []
+    for _ in range(min(ious.shape)):
+        i, j = np.unravel_index(np.argmax(ious), ious.shape)
+        if ious[i, j] <= 0:
+            break
+        matched.append(ious[i, j])
+        ious[i, :] = 0
+        ious[:, j] = 0
+    return np.array(matched, dtype = np.float32)
+
+
+def compare_frame(label_classes, label_polygons, pred_classes, pred_polygons):
+    '''
+    Per class agreement of one frame --> {class ID: (labels, predictions, matches, mean matched IoU, score)}
+    '''
+    ious = iou_matrix(label_polygons, pred_polygons)
+
+    label_classes = np.asarray(label_classes, dtype = np.int64)
+    pred_classes = np.asarray(pred_classes, dtype = np.int64)
+    report = {}
+    for class_id in np.union1d(label_classes, pred_classes).tolist():
+        rows = np.flatnonzero(label_classes == class_id)
+        columns = np.flatnonzero(pred_classes == class_id)
+        matched = greedy_match(ious[np.ix_(rows, columns)])
+        denominator = len(rows) + len(columns) - len(matched)
+        score = float(matched.sum() / denominator) if denominator else 1.0
+        report[class_id] = (len(rows), len(columns), len(matched),
+                            float(matched.mean()) if len(matched) else 0.0, score)
+    return report
+
+
+def prediction_polygons(result):
+    '''
+    ultralytics result --> (classes, list of (k, 2) pixel polygons)
+    '''
+    if result.masks is None:
+        return np.empty(0, dtype = np.int64), []
+    return result.boxes.cls.cpu().numpy().astype(np.int64), [np.asarray(polygon) for polygon in result.masks.xy]
+
+
+def run_qa(model, dataset, batch_size = 16, workers = None, conf = 0.5, cache = None, model_id = None):
+    '''
+    Compare the model with the labels of every image of the dataset --> list of rows
+    (frame, class ID, labels, predictions, matches, mean IoU, score)
+    cache, model_id --> optional InferenceCache and model_fingerprint() of the model
+    '''
+    if cache is not None:
+        predict = CachedPredictor(model, cache, model_id, conf = conf).predict
+    else:
+        predict = lambda paths: model.predict(source = paths, conf = conf, verbose = False, stream = False)
+
+    rows = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        pending = []
+        for first in range(0, len(dataset), batch_size):
+            indices = range(first, min(first + batch_size, len(dataset)))
+            results = predict([dataset.image_path(index) for index in indices])
+
+            # IoU of this batch is computed in the pool while the model runs the next batch
+            for index, result in zip(indices, results):
+                shape = result.orig_shape
+                label_classes, label_polygons = dataset.labels(index)
+                scale = np.array([shape[1], shape[0]], dtype = np.float32)
+                pred_classes, pred_polygons = prediction_polygons(result)
+                pending.append((dataset.names[index],
+                                pool.submit(compare_frame, label_classes,
+                                            [polygon * scale for polygon in label_polygons],
+                                            pred_classes, pred_polygons)))
+
+        for name, future in pending:
+            for class_id, values in future.result().items():
+                rows.append((name, class_id) + values)
+
+    elapsed = time.perf_counter() - start
+    print (f'Compared {len(dataset)} frames in {elapsed:.1f} s --> {len(dataset) / elapsed:.2f} frames/sec')
+    return rows
+
+
+def print_report(rows, class_names, worst = 10):
+    by_class = {}
+    for row in rows:
+        by_class.setdefault(row[1], []).append(row)
+
+    for class_id in sorted(by_class):
+        class_rows = sorted(by_class[class_id], key = lambda row: row[6])
+        scores = np.array([row[6] for row in class_rows])
+        name = class_names[class_id] if class_id < len(class_names) else str(class_id)
+        print (f'\n{name}: mean score {scores.mean():.3f} over {len(class_rows)} frames, worst {min(worst, len(class_rows))}:')
+        for frame, _, labels, predictions, matches, mean_iou, score in class_rows[:worst]:
+            print (f'    {score:.3f}  {frame}  labels {labels}, predicted {predictions}, matched {matches}, '
+                   f'mean IoU {mean_iou:.2f}')
+
+
+def write_report(path, rows, class_names):
+    with open(path, 'w', newline = '') as file:
+        writer = csv.writer(file)
+        writer.writerow(['frame', 'class', 'labels', 'predictions', 'matches', 'mean_iou', 'score'])
+        for frame, class_id, *values in sorted(rows, key = lambda row: (row[1], row[6])):
+            writer.writerow([frame, class_names[class_id] if class_id < len(class_names) else class_id] + values)
+
+
+def benchmark_kernel(dataset, num_frames = 20, shift = 3.0):
+    '''
+    Naive per-pair IoU vs the box-pruned kernel, on label polygons against shifted copies
+    '''
+    rng = np.random.default_rng(0)
+    shape = dataset.image(0).shape[:2]
+    frames = []
+    for sample in dataset.iter(range(min(num_frames, len(dataset))), images = False):
+        scale = np.array([shape[1], shape[0]], dtype = np.float32)
+        labels = [polygon * scale for polygon in sample.polygons]
+        preds = [polygon + rng.normal(0, shift, 2) for polygon in labels]
+        frames.append((shape, labels, preds))
+
+    pairs = sum(len(labels) * len(preds) for _, labels, preds in frames)
+    start = time.perf_counter()
+    naive = [naive_iou_matrix(labels, preds, shape) for shape, labels, preds in frames]
+    naive_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast = [iou_matrix(labels, preds) for _, labels, preds in frames]
+    fast_time = time.perf_counter() - start
+
+    # Differences only come from shifted polygons leaving the frame, which the full-frame masks clip
+    error = max((np.abs(a - b).max() for a, b in zip(naive, fast) if a.size), default = 0.0)
+    print (f'{len(frames)} frames, {pairs} polygon pairs')
+    print (f'naive per pair:       {naive_time * 1000:8.1f} ms ({naive_time / max(pairs, 1) * 1e6:.1f} us/pair)')
+    print (f'box-pruned kernel:    {fast_time * 1000:8.1f} ms ({fast_time / max(pairs, 1) * 1e6:.1f} us/pair), '
+           f'{naive_time / fast_time:.0f}x faster, max IoU difference {error:.3f}')
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Annotation QA')
+
+    # Arguments
+    parser.add_argument('--weights', type = str, default = 'weights/1024.pt', help = 'Model weights, default = weights/1024.pt')
+    parser.add_argument('--dataset', type = str, default = DATASET_DIR, help = f'Dataset folder, default = {DATASET_DIR}')
+    parser.add_argument('--split', type = str, default = 'valid', help = 'Split to check, default = valid')
+    parser.add_argument('--batch_size', type = int, default = 16, help = 'Images per model call, default = 16')
+    parser.add_argument('--workers', type = int, default = None, help = 'Processes for the IoU computation, default = number of CPUs')
+    parser.add_argument('--conf', type = float, default = 0.5, help = 'Confidence threshold, default = 0.5')
+    parser.add_argument('--worst', type = int, default = 10, help = 'Frames to list per class, default = 10')
+    parser.add_argument('--output', type = str, default = None, help = 'Write the full ranked report as CSV')
+    parser.add_argument('--cache', type = str, default = None, help = 'Inference cache folder; frames seen by the same model skip inference')
+    parser.add_argument('--benchmark_kernel', action = 'store_true', help = 'Only time the IoU kernel against the naive per-pair version')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    dataset = YoloDataset(args.split, args.dataset)
+
+    if args.benchmark_kernel:
+        benchmark_kernel(dataset)
+    else:
+        from inference_backend import load_model
+        model = load_model(args.weights)
+        cache = InferenceCache(args.cache) if args.cache else None
+        rows = run_qa(model, dataset, batch_size = args.batch_size, workers = args.workers, conf = args.conf,
+                      cache = cache, model_id = model_fingerprint(args.weights, conf = args.conf))
+        print_report(rows, dataset.class_names, args.worst)
+        if args.output:
+            write_report(args.output, rows, dataset.class_names)
@@ -0,0 +1,484 @@
+import os
+import re
+import json
+import glob
+import time
+import calendar
+import argparse
+from collections import namedtuple
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import h5py
+import torch
+import numpy as np
+
+from frame_index import FrameIndex, TIMESTAMP_FORMAT
+from hdf5_writer import BufferedDatasetWriter
+from time_series_schema import CompactTrackingWriter, UTC_OFFSET_HOURS, split_timestamps
+from frame_records import frame_detections
+from tracking_reader import column_index
+from weather_history import WeatherHistory
+from inference_backend import add_backend_arguments, load_model
+from multi_stream_tracker import make_tracker, track_result
+from inference_cache import InferenceCache, CachedPredictor, model_fingerprint
+
+'''
+Offline backfill: re-run tracking over archived captures (Data/<date>/<stream>/*_Live_stream_N.mp4 written by
+capture_video.py, *_Segment_N.mp4 by capture_daemon.py) and append the results to the same time-series store as
+generate_time_series.py, much faster than real time:
+
+    - every video is split into independent chunks of --chunk_seconds; chunks are tracked in a process pool,
+      each worker with its own model instance (inference_backend.load_model) and a fresh tracker per chunk
+    - every chunk starts --overlap sampled frames early; the parent matches the detections of these warm-up frames
+      with the end of the previous chunk (same class, nearest centroid, majority over the frames) and carries the
+      track IDs across, so a track keeps one ID over the whole video. IDs are unique over the whole job and start
+      above the largest track ID already in the store.
+    - frame times come from the day's frame index (first sampled frame of the video), or the file modification
+      time minus the video length for videos that are not indexed
+    - weather for every frame comes from the locally cached hourly history (weather_history.py), not the live API
+    - chunks are written in video order; after every chunk the progress (chunks done per video, the stitching
+      tail, next track ID) is saved in the store's 'backfill_state' attribute, so an interrupted job resumes where
+      it stopped when started again with the same arguments; --restart only accepts an empty (new) --output
+    - with --cache DIR the workers share the inference cache (inference_cache.py): re-tracking frames a model has
+      already seen (e.g. a new tracker config) skips the model
+
+Do not run it on a file that generate_time_series.py is writing to at the same time (use --output).
+
+    python3 backfill_time_series.py --dates 08_11_2023 10_11_2023 --workers 4 --frame_step 5
+    python3 backfill_time_series.py --backend openvino --int8 --output Raw_Time_Series_Data/backfill.h5
+'''
+
+VIDEO_PATTERN = re.compile(r'_(?:Live_stream|Segment)_(\d+)\.mp4$')
+
+STATE_ATTRIBUTE = 'backfill_state'
+
+# Chunking parameters a resumed job must keep
+CHUNK_OPTIONS = ['chunk_seconds', 'frame_step', 'overlap']
+
+# first_frame: decoding starts here (warm-up frames for stitching), start_frame/stop_frame: frames written
+Chunk = namedtuple('Chunk', ['video', 'index', 'first_frame', 'start_frame', 'stop_frame', 'fps', 'start_us'])
+
+# Per detection arrays; frame is the video frame number
+ChunkResult = namedtuple('ChunkResult', ['chunk', 'frames', 'frame', 'track_id', 'cls', 'x', 'y'])
+
+
+def to_unix_us(timestamp):
+    '''GMT+1 wall clock datetime --> unix microseconds (UTC)'''
+    utc = timestamp - timedelta(hours = UTC_OFFSET_HOURS)
+    return calendar.timegm(utc.timetuple()) * 1000000 + utc.microsecond
+
+
+def find_videos(data_folder = 'Data', stream = 'PPS3', dates = None):
+    '''
+    Archived videos of a stream, sorted by day and video number --> list of paths
+    '''
+    videos = []
+    for day_folder in sorted(glob.glob(os.path.join(data_folder, '*'))):
+        day = os.path.basename(day_folder)
+        if not os.path.isdir(day_folder) or (dates and day not in dates):
+            continue
+        paths = [path for path in glob.glob(os.path.join(day_folder, stream, '*.mp4')) if VIDEO_PATTERN.search(path)]
+        day_key = datetime.strptime(day, '%d_%m_%Y') if re.fullmatch(r'\d\d_\d\d_\d{4}', day) else datetime.max
+        videos += [(day_key, int(VIDEO_PATTERN.search(path).group(1)), os.path.normpath(path)) for path in paths]
+    return [path for _, _, path in sorted(videos)]
+
+
+def video_info(path):
+    '''
+    (frame count, fps, start time in unix microseconds) of an archived video
+    '''
+    capture = cv2.VideoCapture(path)
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    capture.release()
+
+    stream_folder = os.path.dirname(path)
+    first = None
+    if os.path.exists(os.path.join(os.path.dirname(stream_folder), 'frame_index.sqlite')):
+        with FrameIndex(os.path.dirname(stream_folder)) as index:
+            first, _ = index.video_time_range(os.path.basename(stream_folder), os.path.basename(path))
+
+    if first is not None:
+        start = datetime.strptime(first, TIMESTAMP_FORMAT) if '.' in first else datetime.strptime(first, '%Y-%m-%d %H:%M:%S')
+        return num_frames, fps, to_unix_us(start)
+
+    # Not indexed: the file was last written when the recording ended
+    print (f'{path}: no frame index entries, start time taken from the file modification time')
+    return num_frames, fps, int((os.path.getmtime(path) - num_frames / fps) * 1000000)
+
+
+def make_chunks(path, num_frames, fps, start_us, chunk_seconds = 60, frame_step = 5, overlap = 10):
+    '''
+    Split a video into chunks of chunk_seconds, aligned to frame_step so neighbouring chunks sample the same frames
+    '''
+    chunk_frames = max(frame_step, int(round(chunk_seconds * fps / frame_step)) * frame_step)
+    chunks = []
+    for index, start in enumerate(range(0, num_frames, chunk_frames)):
+        first = max(0, start - overlap * frame_step)
+        chunks.append(Chunk(path, index, first, start, min(start + chunk_frames, num_frames), fps, start_us))
+    return chunks
+
+
+# ---- worker processes ----------------------------------------------------------------------------------------
+
+_worker = {}
+
+
+def init_worker(weights, backend, int8, tracker_config, conf, device, threads, cache_dir = None):
+    if threads:
+        torch.set_num_threads(threads)
+    model = load_model(weights, backend, int8)
+    if cache_dir:
+        predictor = CachedPredictor(model, InferenceCache(cache_dir),
+                                    model_fingerprint(weights, backend = backend, int8 = int8, conf = conf),
+                                    conf = conf, device = device)
+        predict = predictor.predict
+    else:
+        predict = lambda frames: model.predict(source = frames, conf = conf, device = device, verbose = False, stream = False)
+    _worker.update(predict = predict, tracker_config = tracker_config)
+
+
+def track_chunk(chunk, frame_step = 5, batch_size = 8):
+    '''
+    Track one chunk with a fresh tracker --> ChunkResult (local track IDs, warm-up frames included)
+    '''
+    tracker = make_tracker(_worker['tracker_config'], chunk.fps / frame_step)
+
+    capture = cv2.VideoCapture(chunk.video)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, chunk.first_frame)
+
+    frames, detections = [], []
+    position = chunk.first_frame
+    try:
+        while position < chunk.stop_frame:
+            # Decode a batch of sampled frames, skipped frames are only grabbed
+            batch, numbers = [], []
+            while position < chunk.stop_frame and len(batch) < batch_size:
+                if (position - chunk.first_frame) % frame_step == 0:
+                    ok, frame = capture.read()
+                    if ok:
+                        batch.append(frame)
+                        numbers.append(position)
+                else:
+                    ok = capture.grab()
+                if not ok:
+                    position = chunk.stop_frame
+                    break
+                position += 1
+            if not batch:
+                break
+
+            results = _worker['predict'](batch)
+            for number, frame, result in zip(numbers, batch, results):
+                result = track_result(tracker, result, frame)
+                frames.append(number)
+                ids, classes, x_centers, y_centers = frame_detections(result)
+                if len(ids):
+                    detections.append(np.column_stack((np.full(len(ids), number), ids, classes, x_centers, y_centers)))
+    finally:
+        capture.release()
+
+    data = np.concatenate(detections) if detections else np.empty((0, 5))
+    return ChunkResult(chunk, np.array(frames, dtype = np.int64), data[:, 0].astype(np.int64),
+                       data[:, 1].astype(np.int64), data[:, 2].astype(np.int64), data[:, 3], data[:, 4])
+
+
+# ---- parent: stitching and storage ---------------------------------------------------------------------------
+
+class TrackStitcher:
+    '''
+    Maps the local track IDs of a chunk to job-wide IDs, continuing the tracks of the previous chunk.
+
+    next_id --> first unused job-wide ID
+    max_distance --> pixels between the centroids of the same object seen by both chunks
+    min_votes --> warm-up frames two tracks must agree on to be joined
+    '''
+    def __init__(self, next_id = 1, max_distance = 40.0, min_votes = 2):
+        self.next_id = next_id
+        self.max_distance = max_distance
+        self.min_votes = min_votes
+
+    def stitch(self, tail, result):
+        '''
+        tail --> (k, 5) array frame, global ID, class, x, y of the previous chunk's last frames (empty for the first)
+        result --> ChunkResult
+        Returns the job-wide ID of every detection of result.
+        '''
+        votes = {}
+        for number in np.intersect1d(tail[:, 0].astype(np.int64), result.frame[result.frame < result.chunk.start_frame]):
+            previous = tail[tail[:, 0] == number]
+            current = np.flatnonzero(result.frame == number)
+            distance = np.hypot(previous[:, 3, None] - result.x[current][None, :],
+                                previous[:, 4, None] - result.y[current][None, :])
+            distance[previous[:, 2, None] != result.cls[current][None, :]] = np.inf
+
+            # Nearest pairs first, each detection used once per frame
+            used_rows = np.zeros(distance.shape[0], dtype = bool)
+            used_columns = np.zeros(distance.shape[1], dtype = bool)
+            for flat in np.argsort(distance, axis = None):
+                i, j = np.unravel_index(flat, distance.shape)
+                if distance[i, j] > self.max_distance:
+                    break
+                if used_rows[i] or used_columns[j]:
+                    continue
+                key = (int(previous[i, 1]), int(result.track_id[current[j]]))
+                votes[key] = votes.get(key, 0) + 1
+                used_rows[i] = used_columns[j] = True
+
+        mapping = {}
+        used = set()
+        for (global_id, local_id), count in sorted(votes.items(), key = lambda item: -item[1]):
+            if count >= self.min_votes and local_id not in mapping and global_id not in used:
+                mapping[local_id] = global_id
+                used.add(global_id)
+
+        for local_id in np.unique(result.track_id).tolist():
+            if local_id not in mapping:
+                mapping[local_id] = self.next_id
+                self.next_id += 1
+
+        if len(result.track_id) == 0:
+            return np.empty(0, dtype = np.int64)
+        local_ids, inverse = np.unique(result.track_id, return_inverse = True)
+        return np.array([mapping[local_id] for local_id in local_ids.tolist()], dtype = np.int64)[inverse]
+
+
+def stored_rows(file):
+    '''Rows already in the store (detections for the compact schema)'''
+    for name in ('tracking_data', 'detections'):
+        if name in file:
+            return file[name].shape[0]
+    return 0
+
+
+def max_track_id(file, block_rows = 1 << 20):
+    '''
+    Largest track ID in the store (live or earlier backfill rows), 0 if it is empty. Read block by block.
+    '''
+    largest = 0
+    if 'tracking_data' in file:
+        dataset = file['tracking_data']
+        column = column_index(dataset.shape[1])['track_id']
+        for start in range(0, dataset.shape[0], block_rows):
+            block = dataset[start:start + block_rows, column]
+            if len(block):
+                largest = max(largest, int(np.nanmax(block)))
+    elif 'detections' in file:
+        dataset = file['detections']
+        for start in range(0, dataset.shape[0], block_rows):
+            block = dataset[start:start + block_rows]['track_id']
+            if len(block):
+                largest = max(largest, int(block.max()))
+    return largest
+
+
+class BackfillJob:
+    '''
+    Owns the store while the job runs: writes finished chunks in order and keeps the resumable state.
+
+    file --> open h5py.File of the store
+    schema --> 'flat' or 'compact', as in generate_time_series.py
+    history --> WeatherHistory
+    options --> {option: value} of CHUNK_OPTIONS, must match a stored state to resume
+    restart --> ignore saved progress; only allowed on an empty store, as the rows already written would be duplicated
+
+    Track IDs continue above the largest ID already in the store, so backfilled tracks never share an ID with
+    live ones.
+    '''
+    def __init__(self, file, schema, history, options, chunk_rows = 2048, compression = 'gzip', restart = False):
+        self.file = file
+        self.schema = schema
+        self.history = history
+
+        if restart and stored_rows(file):
+            raise ValueError(f'--restart would append duplicates of the {stored_rows(file)} rows already in '
+                             f'{file.filename}; write to a new --output instead')
+
+        if schema == 'compact':
+            self.writer = CompactTrackingWriter(file, chunk_rows = chunk_rows, compression = compression,
+                                                flush_interval = None)
+        else:
+            self.writer = BufferedDatasetWriter(file, 'tracking_data', row_shape = (16,), dtype = np.float64,
+                                                chunk_rows = chunk_rows, compression = compression, flush_interval = None)
+
+        state = None if restart or STATE_ATTRIBUTE not in file.attrs else json.loads(file.attrs[STATE_ATTRIBUTE])
+        if state is not None and state['options'] != options:
+            raise ValueError(f'The store holds a backfill started with {state["options"]}; use the same options '
+                             f'to resume or --restart to start over')
+        self.state = state or {'options': options, 'next_track_id': 1, 'videos': {}}
+        self.state['next_track_id'] = max(self.state['next_track_id'], max_track_id(file) + 1)
+        self.stitcher = TrackStitcher(self.state['next_track_id'])
+        self.overlap_frames = options['overlap'] * options['frame_step']
+
+        # (video, chunk index) --> ChunkResult finished out of order
+        self._finished = {}
+
+    def done(self, video):
+        '''Chunks of the video already in the store'''
+        return self.state['videos'].get(video, {}).get('done', 0)
+
+    def add(self, result):
+        '''
+        Accept a finished chunk; writes it and every following chunk of the video that is ready
+        '''
+        video = result.chunk.video
+        self._finished[(video, result.chunk.index)] = result
+        while (video, self.done(video)) in self._finished:
+            self._write(self._finished.pop((video, self.done(video))))
+
+    def _write(self, result):
+        chunk = result.chunk
+        entry = self.state['videos'].setdefault(chunk.video, {'done': 0, 'tail': []})
+        tail = np.array(entry['tail'], dtype = np.float64).reshape(-1, 5)
+        global_ids = self.stitcher.stitch(tail, result)
+
+        # Warm-up frames belong to the previous chunk
+        keep = result.frame >= chunk.start_frame
+        frames = result.frames[result.frames >= chunk.start_frame]
+        timestamps_us = chunk.start_us + np.round(frames / chunk.fps * 1000000).astype(np.int64)
+        detection_us = chunk.start_us + np.round(result.frame[keep] / chunk.fps * 1000000).astype(np.int64)
+
+        if self.schema == 'compact':
+            frame_of = np.searchsorted(frames, result.frame[keep])
+            for position, timestamp_us in enumerate(timestamps_us.tolist()):
+                rows = np.flatnonzero(keep)[frame_of == position]
+                self.writer.append_frame(timestamp_us, self.history.observation(timestamp_us / 1e6), global_ids[rows],
+                                         result.cls[rows], result.x[rows], result.y[rows])
+        elif keep.any():
+            data = np.empty((np.count_nonzero(keep), 16), dtype = np.float64)
+            data[:, 0:6] = np.column_stack(split_timestamps(detection_us))
+            data[:, 6] = global_ids[keep]
+            data[:, 7] = result.cls[keep]
+            data[:, 8] = result.x[keep]
+            data[:, 9] = result.y[keep]
+            data[:, 10:16] = self.history.values(detection_us / 1e6)
+            self.writer.append(data)
+
+        # Data first, then the state that says it is there
+        tail_rows = result.frame >= chunk.stop_frame - self.overlap_frames
+        entry['tail'] = np.column_stack((result.frame[tail_rows], global_ids[tail_rows], result.cls[tail_rows],
+                                         result.x[tail_rows], result.y[tail_rows])).tolist()
+        entry['done'] = chunk.index + 1
+        self.state['next_track_id'] = self.stitcher.next_id
+        self.writer.flush()
+        self.file.attrs[STATE_ATTRIBUTE] = json.dumps(self.state)
+        self.file.flush()
+
+    def finish_video(self, video, num_chunks):
+        entry = self.state['videos'].get(video)
+        if entry is not None and entry['done'] >= num_chunks:
+            entry['tail'] = []
+            entry['complete'] = True
+            self.file.attrs[STATE_ATTRIBUTE] = json.dumps(self.state)
+            self.file.flush()
+
+
+def run_backfill(videos, job, frame_step = 5, chunk_seconds = 60, overlap = 10, workers = 2, batch_size = 8,
+                 worker_args = ()):
+    '''
+    Track all remaining chunks of the videos in a process pool and hand them to the job in order
+    '''
+    chunks, num_chunks = [], {}
+    for video in videos:
+        if job.state['videos'].get(video, {}).get('complete'):
+            continue
+        num_frames, fps, start_us = video_info(video)
+        video_chunks = make_chunks(video, num_frames, fps, start_us, chunk_seconds, frame_step, overlap)
+        num_chunks[video] = len(video_chunks)
+        chunks += video_chunks[job.done(video):]
+        job.finish_video(video, len(video_chunks))
+
+    if not chunks:
+        print ('Nothing to do, every video is in the store')
+        return
+
+    # All weather needed by the job, fetched (or read from the cache) once up front
+    starts = [chunk.start_us / 1e6 for chunk in chunks]
+    ends = [(chunk.start_us + chunk.stop_frame / chunk.fps * 1000000) / 1e6 for chunk in chunks]
+    job.history.prefetch(min(starts), max(ends))
+
+    total_frames = sum((chunk.stop_frame - chunk.start_frame) // frame_step for chunk in chunks)
+    print (f'{len(chunks)} chunks of {len(num_chunks)} videos, ~{total_frames} sampled frames, {workers} workers')
+
+    start = time.perf_counter()
+    processed = 0
+    with ProcessPoolExecutor(max_workers = workers, initializer = init_worker, initargs = worker_args) as pool:
+        futures = [pool.submit(track_chunk, chunk, frame_step, batch_size) for chunk in chunks]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                job.add(result)
+                processed += len(result.frames)
+                if job.done(result.chunk.video) == num_chunks[result.chunk.video]:
+                    job.finish_video(result.chunk.video, num_chunks[result.chunk.video])
+                    print (f'{result.chunk.video}: done')
+                elapsed = time.perf_counter() - start
+                print (f'{processed} frames in {elapsed:.0f} s --> {processed / elapsed:.1f} frames/sec', end = '\r')
+        except KeyboardInterrupt:
+            print ('\nInterrupted, stopping workers. Finished chunks are kept, run again to resume.')
+            pool.shutdown(wait = False, cancel_futures = True)
+            raise
+    print ()
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Backfill Time Series Data')
+
+    # Arguments
+    parser.add_argument('--data', type = str, default = 'Data', help = 'Capture folder with one sub-folder per day, default = Data')
+    parser.add_argument('--stream', type = str, default = 'PPS3', help = 'Stream sub-folder to process, default = PPS3')
+    parser.add_argument('--dates', type = str, nargs = '+', default = None, help = 'Day folders to process (e.g. 08_11_2023), default = all')
+    parser.add_argument('--weights', type = str, default = 'weights/last.pt', help = 'Model weights, default = weights/last.pt')
+    parser.add_argument('--tracker', type = str, default = 'botsort.yaml', help = 'Tracker config, default = botsort.yaml')
+    parser.add_argument('--conf', type = float, default = 0.7, help = 'Confidence threshold, default = 0.7')
+    parser.add_argument('--workers', type = int, default = 2, help = 'Worker processes, each with its own model, default = 2')
+    parser.add_argument('--batch_size', type = int, default = 8, help = 'Frames per model call in a worker, default = 8')
+    parser.add_argument('--frame_step', type = int, default = 5, help = 'Track every (FRAME_STEP)th video frame, default = 5')
+    parser.add_argument('--chunk_seconds', type = float, default = 60, help = 'Video seconds per chunk, default = 60')
+    parser.add_argument('--overlap', type = int, default = 10, help = 'Sampled frames shared by neighbouring chunks to stitch track IDs, default = 10')
+    parser.add_argument('--schema', type = str, default = 'flat', choices = ['flat', 'compact'], help = 'Storage layout as in generate_time_series.py, default = flat')
+    parser.add_argument('--output', type = str, default = None, help = 'Store to append to, default = the store of generate_time_series.py for --schema')
+    parser.add_argument('--weather_cache', type = str, default = os.path.join('Raw_Time_Series_Data', 'weather_history'), help = 'Folder of the cached weather history, default = Raw_Time_Series_Data/weather_history')
+    parser.add_argument('--offline', action = 'store_true', help = 'Only use cached weather history, never call the API')
+    parser.add_argument('--cache', type = str, default = None, help = 'Inference cache folder shared by the workers; frames seen by the same model skip inference')
+    parser.add_argument('--restart', action = 'store_true', help = 'Ignore the saved progress and process every video again; needs an empty (new) --output')
+    add_backend_arguments(parser)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    device = '0' if torch.cuda.is_available() else 'cpu'
+    threads = max(1, (os.cpu_count() or 1) // args.workers)
+
+    folder_path = 'Raw_Time_Series_Data'
+    os.makedirs(folder_path, exist_ok = True)
+    output = args.output or os.path.join(folder_path, 'tracking_data_compact.h5' if args.schema == 'compact' else 'tracking_data.h5')
+
+    videos = find_videos(args.data, args.stream, args.dates)
+    print (f'Found {len(videos)} archived videos in {args.data}/*/{args.stream}')
+
+    options = {name: getattr(args, name) for name in CHUNK_OPTIONS}
+    history = WeatherHistory(args.weather_cache, offline = args.offline)
+    with h5py.File(output, 'a', libver = 'latest') as file:
+        try:
+            job = BackfillJob(file, args.schema, history, options, restart = args.restart)
+        except ValueError as error:
+            raise SystemExit(error)
+        try:
+            run_backfill(videos, job, frame_step = args.frame_step, chunk_seconds = args.chunk_seconds,
+                         overlap = args.overlap, workers = args.workers, batch_size = args.batch_size,
+                         worker_args = (args.weights, args.backend, args.int8, args.tracker, args.conf, device, threads,
+                                        args.cache))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            job.writer.flush()
+            print (f'Store: {output}, next track ID {job.stitcher.next_id}')
@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+
+import cv2
+import h5py
+import numpy as np
+import torch
+from ultralytics import YOLO
+
+from weather_provider import WeatherObservation
+from hdf5_writer import BufferedDatasetWriter
+from time_series_schema import CompactTrackingWriter, UTC_OFFSET_HOURS
+from frame_records import FrameRecordBuilder, frame_detections
+from multi_stream_tracker import make_tracker, track_result
+from storage_queue import BoundedQueue, StorageStage, POLICIES
+from turnaround_events import TurnaroundDetector, write_events
+
+'''
+End-to-end benchmark of the capture --> inference --> storage pipeline of generate_time_series.py, run offline.
+
+The live stream is replaced by a recorded MP4 or a folder of frames (e.g. the dataset's valid/images), the weather
+API by a fixed observation. Every frame goes through the same stages as the live loop, each timed separately.
+On the inference thread:
+
+    decode     read / decode the next frame
+    inference  model.predict on the frame
+    tracking   tracker update, BoT-SORT (with camera motion compensation) as in the live loop unless --tracker
+    weather    weather lookup (stub)
+    enqueue    per-frame record handed to the storage queue (BoundedQueue, --queue_size / --backpressure)
+
+and on the storage thread (StorageStage, as in generate_time_series.py):
+
+    events     turnaround event detection and CSV append (only with --events)
+    build      per-frame rows (one timestamp, written in place into the row buffer, see frame_records.py)
+    storage    buffered HDF5 append, including the periodic resize + flush
+
+The live loop also decodes on its own thread (newest frame wins); here decoding is timed inline, as a recorded
+source has no frames to drop. The storage stages overlap with inference, so their share is of the summed stage
+time, not of the wall time. Reports p50/p95/p99/max per stage, frames/sec, storage queue stats, peak RSS and bytes
+written, and saves everything as JSON (with the git commit) so runs can be compared across commits:
+
+    python3 benchmark_pipeline.py --source Gdansk_Airport_Data_Annotation.v4i.yolov8/valid/images
+    python3 benchmark_pipeline.py --source Data/Videos/6/Gdansk_Live_Stream_6.mp4 --max_frames 500 --compare Benchmarks/old.json
+'''
+
+STAGES = ['decode', 'inference', 'tracking', 'weather', 'enqueue', 'events', 'build', 'storage']
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class StageTimer:
+    '''
+    Collects the duration of every run of every stage (seconds, perf_counter)
+    '''
+    def __init__(self, stages = STAGES):
+        self.durations = {stage: [] for stage in stages}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        '''
+        {stage: count, total / mean / p50 / p95 / p99 / max in ms}
+        '''
+        report = {}
+        for stage, durations in self.durations.items():
+            if not durations:
+                continue
+            values = np.array(durations) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            report[stage] = {'count': len(values), 'total_ms': float(values.sum()), 'mean_ms': float(values.mean()),
+                             'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99),
+                             'max_ms': float(values.max())}
+        return report
+
+
+class StubWeatherProvider:
+    '''
+    Stands in for WeatherProvider: always returns the same, fresh observation
+    '''
+    def __init__(self, values = (5.0, 80.0, 0.0, 0.0, 0.0, 50.0)):
+        self.values = tuple(values)
+
+    def start(self):
+        pass
+
+    def stop(self, timeout = None):
+        pass
+
+    def current(self, now = None):
+        now = time.time() if now is None else now
+        return WeatherObservation(self.values, now, now, False)
+
+
+def local_frames(source, max_frames = None):
+    '''
+    Frames of a video file or of the images in a folder (sorted by name), decoded one at a time
+    '''
+    count = 0
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for name in names:
+            if max_frames is not None and count >= max_frames:
+                return
+            frame = cv2.imread(os.path.join(source, name))
+            if frame is None:
+                continue
+            count += 1
+            yield frame
+    else:
+        capture = cv2.VideoCapture(source)
+        try:
+            while max_frames is None or count < max_frames:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                count += 1
+                yield frame
+        finally:
+            capture.release()
+
+
+def source_fps(source, default = 30):
+    '''
+    Frame rate the tracker is created with: the video's own, or the live stream's default for a folder of frames
+    '''
+    if os.path.isdir(source):
+        return default
+    capture = cv2.VideoCapture(source)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps or default
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL,
+                                       cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_pipeline(model, source, output_file, max_frames = None, schema = 'flat', chunk_rows = 2048,
+                 compression = 'gzip', flush_interval = 1.0, conf = 0.7, device = 'cpu',
+                 tracker_config = 'botsort.yaml', frame_rate = None, events = False, queue_size = 256,
+                 backpressure = 'block', warmup = 3):
+    '''
+    Run the pipeline over a local source, writing to output_file (and turnaround_events.csv next to it with events).
+    frame_rate --> frame rate of the tracker, default = the source's (see source_fps). Returns the report dict.
+    '''
+    timer = StageTimer()
+    weather_provider = StubWeatherProvider()
+    tracker = make_tracker(tracker_config, frame_rate or source_fps(source))
+    frames = local_frames(source, max_frames)
+
+    work_folder = os.path.dirname(os.path.abspath(output_file))
+    events_file_path = os.path.join(work_folder, 'turnaround_events.csv')
+    detector = TurnaroundDetector() if events else None
+
+    # Warm up the model (first calls allocate / compile) so it does not skew the percentiles
+    for frame in local_frames(source, warmup):
+        model.predict(source = frame, conf = conf, device = device, verbose = False)
+
+    def persist(record):
+        '''
+        Storage stage, the same steps as persist() in generate_time_series.py
+        '''
+        timestamp_us, weather, track_id, obj_class, x_centers, y_centers = record
+
+        if detector is not None:
+            with timer.time('events'):
+                found = detector.update(timestamp_us / 1e6 + UTC_OFFSET_HOURS * 3600, track_id, obj_class,
+                                        x_centers, y_centers)
+                write_events(events_file_path, found)
+
+        if schema == 'compact':
+            with timer.time('storage'):
+                writer.append_frame(timestamp_us, weather, track_id, obj_class, x_centers, y_centers)
+            return
+
+        with timer.time('build'):
+            writer.add(timestamp_us, weather, track_id, obj_class, x_centers, y_centers)
+        with timer.time('storage'):
+            if writer.due():
+                writer.hand_over()
+
+    detections = 0
+    num_frames = 0
+    with h5py.File(output_file, 'w', libver = 'latest') as file:
+        if schema == 'compact':
+            writer = CompactTrackingWriter(file, chunk_rows = chunk_rows, compression = compression,
+                                           flush_interval = flush_interval)
+        else:
+            rows = BufferedDatasetWriter(file, 'tracking_data', row_shape = (16,), dtype = np.float64,
+                                         chunk_rows = chunk_rows, compression = compression,
+                                         flush_interval = flush_interval)
+            writer = FrameRecordBuilder(rows, flush_interval = flush_interval)
+        start = time.perf_counter()
+        with writer:
+            file.swmr_mode = True
+            queue = BoundedQueue(queue_size, backpressure, os.path.join(work_folder, 'spill'))
+            storage = StorageStage(persist, queue, idle = writer.flush, idle_interval = flush_interval)
+            with storage:
+                while True:
+                    with timer.time('decode'):
+                        frame = next(frames, None)
+                    if frame is None:
+                        break
+                    num_frames += 1
+
+                    with timer.time('inference'):
+                        result = model.predict(source = frame, conf = conf, device = device, verbose = False)[0]
+
+                    with timer.time('tracking'):
+                        result = track_result(tracker, result, frame)
+
+                    with timer.time('weather'):
+                        weather = weather_provider.current()
+
+                    with timer.time('enqueue'):
+                        timestamp_us = time.time_ns() // 1000
+                        track_id, obj_class, x_centers, y_centers = frame_detections(result)
+                        detections += len(track_id)
+                        storage.put((timestamp_us, weather, track_id, obj_class, x_centers, y_centers))
+
+            # Draining the queue (closing the stage) and the final flush belong to the run as well
+            with timer.time('storage'):
+                writer.flush()
+        elapsed = time.perf_counter() - start
+
+    return {
+        'commit': git_commit(),
+        'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'source': source,
+        'schema': schema,
+        'tracker': tracker_config,
+        'events': events,
+        'chunk_rows': chunk_rows,
+        'compression': compression,
+        'device': str(device),
+        'frames': num_frames,
+        'detections': detections,
+        'elapsed_s': elapsed,
+        'fps': num_frames / elapsed if elapsed > 0 else 0.0,
+        'queue': queue.stats(),
+        'peak_rss_mb': peak_rss_bytes() / 1e6,
+        'bytes_written': os.path.getsize(output_file),
+        'stages': timer.summary(),
+    }
+
+
+def print_report(report, baseline = None):
+    print (f"{report['frames']} frames, {report['detections']} detections in {report['elapsed_s']:.1f} s --> "
+           f"{report['fps']:.2f} frames/sec, peak RSS {report['peak_rss_mb']:.0f} MB, "
+           f"{report['bytes_written'] / 1e6:.2f} MB written (commit {report['commit']})")
+    if 'queue' in report:
+        queue = report['queue']
+        print (f"tracker {report['tracker']}, storage queue: {queue['dropped']} dropped, {queue['spilled']} spilled, "
+               f"{queue['blocked_s']:.2f} s blocked")
+    header = f"{'stage':<10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'share':>7}"
+    if baseline is not None:
+        header += f" {'p50 vs ' + baseline['commit']:>16}"
+    print (header)
+
+    total = sum(stage['total_ms'] for stage in report['stages'].values()) or 1.0
+    for name, stage in report['stages'].items():
+        line = (f"{name:<10} {stage['p50_ms']:>9.2f} {stage['p95_ms']:>9.2f} {stage['p99_ms']:>9.2f} "
+                f"{stage['max_ms']:>9.2f} {100 * stage['total_ms'] / total:>6.1f}%")
+        old = None if baseline is None else baseline['stages'].get(name)
+        if old is not None and old['p50_ms'] > 0:
+            line += f" {100 * (stage['p50_ms'] / old['p50_ms'] - 1):>+15.1f}%"
+        print (line)
+    if baseline is not None:
+        print (f"frames/sec: {baseline['fps']:.2f} --> {report['fps']:.2f}")
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Pipeline Benchmark')
+
+    # Arguments
+    parser.add_argument('--source', type = str, default = os.path.join('Gdansk_Airport_Data_Annotation.v4i.yolov8', 'valid', 'images'), help = 'Recorded MP4 or folder of frames, default = dataset valid/images')
+    parser.add_argument('--weights', type = str, default = 'weights/last.pt', help = 'Model weights, default = weights/last.pt')
+    parser.add_argument('--max_frames', type = int, default = None, help = 'Stop after this many frames, default = all')
+    parser.add_argument('--schema', type = str, default = 'flat', choices = ['flat', 'compact'], help = 'Storage layout, default = flat')
+    parser.add_argument('--chunk_rows', type = int, default = 2048, help = 'Rows per HDF5 chunk and write batch, default = 2048')
+    parser.add_argument('--compression', type = str, default = 'gzip', choices = ['gzip', 'lzf', 'none'], help = 'HDF5 compression filter, default = gzip')
+    parser.add_argument('--conf', type = float, default = 0.7, help = 'Confidence threshold, default = 0.7')
+    parser.add_argument('--tracker', type = str, default = 'botsort.yaml', help = 'Tracker config, default = botsort.yaml (as the live loop)')
+    parser.add_argument('--fps', type = float, default = None, help = 'Frame rate of the tracker, default = the frame rate of the video, 30 for a folder of frames')
+    parser.add_argument('--events', action = 'store_true', help = 'Run turnaround event detection on the storage thread')
+    parser.add_argument('--queue_size', type = int, default = 256, help = 'Frames queued in memory between inference and storage, default = 256')
+    parser.add_argument('--backpressure', type = str, default = 'block', choices = POLICIES, help = 'When the storage queue is full: wait, drop the oldest frame or spill to disk, default = block')
+    parser.add_argument('--output', type = str, default = None, help = 'Report JSON, default = Benchmarks/benchmark_{date}_{commit}.json')
+    parser.add_argument('--compare', type = str, default = None, help = 'Earlier report JSON to compare against')
+    parser.add_argument('--keep_data', action = 'store_true', help = 'Keep the HDF5 file written during the run')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    device = '0' if torch.cuda.is_available() else 'cpu'
+
+    model = YOLO(args.weights)
+    work_folder = tempfile.mkdtemp(prefix = 'benchmark_')
+    output_file = os.path.join(work_folder, 'tracking_data.h5')
+    try:
+        report = run_pipeline(model, args.source, output_file, max_frames = args.max_frames, schema = args.schema,
+                              chunk_rows = args.chunk_rows,
+                              compression = None if args.compression == 'none' else args.compression,
+                              conf = args.conf, device = device, tracker_config = args.tracker, frame_rate = args.fps,
+                              events = args.events, queue_size = args.queue_size, backpressure = args.backpressure)
+        report['weights'] = args.weights
+    finally:
+        if args.keep_data:
+            print (f'Data written to {output_file}')
+        else:
+            shutil.rmtree(work_folder, ignore_errors = True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+
+    report_path = args.output
+    if report_path is None:
+        os.makedirs('Benchmarks', exist_ok = True)
+        report_path = os.path.join('Benchmarks', f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['commit']}.json")
+    with open(report_path, 'w') as file:
+        json.dump(report, file, indent = 2)
+    print (f'Report saved to {report_path}')
@@ -0,0 +1,316 @@
+import os
+import re
+import json
+import time
+import subprocess
+from collections import deque
+from datetime import datetime, timedelta
+
+from capture_video import SHOWINFO_PATTERN, write_frame_infos
+from frame_index import FrameIndex, migrate_folder
+
+'''
+Continuous, segmented capture of a live stream (python3 capture_video.py --continuous).
+
+One long-running ffmpeg per stream and day writes
+    - time segmented MP4 files, Data/{date}/{stream}/{stream}_Segment_{N}.mp4 (segment_duration seconds each)
+    - JPEG frames every frame_interval seconds (Frame_{ID}.jpg), indexed per segment in the day's frame index
+ffmpeg is restarted at midnight (new day folder) and, with exponential backoff, whenever the stream drops.
+Retention deletes the oldest segments and their frames once the disk budget or the maximum age is exceeded.
+Health metrics (segments written/dropped, segment latency, bytes written, reconnects) are printed per segment and
+written to Data/{stream}_capture_health.json. Dropped segments are measured, not estimated: the wall-clock gap between
+the last segment closed and the first segment of the next session (also across daemon restarts) is added to
+seconds_missed, and every full segment_duration of it counts as a dropped segment.
+'''
+
+# Segment muxer opens every new segment with "[segment @ 0x..] Opening 'path.mp4' for writing"
+SEGMENT_PATTERN = re.compile(r"Opening '(.+?\.mp4)' for writing")
+SEGMENT_NAME_PATTERN = re.compile(r'_Segment_(\d+)\.mp4$')
+
+DATE_FORMAT = '%d_%m_%Y'
+
+
+def gmt1_now():
+    return datetime.utcnow() + timedelta(hours=1)
+
+
+class CaptureHealth:
+    '''
+    Counters reported by the capture daemon
+    '''
+    def __init__(self):
+        self.segments_written = 0
+        self.segments_dropped = 0
+        self.seconds_missed = 0.0
+        self.bytes_written = 0
+        self.frames_written = 0
+        self.reconnects = 0
+        self.last_segment_latency = 0.0
+        self.max_segment_latency = 0.0
+        self.segments_deleted = 0
+        self.bytes_deleted = 0
+
+    def record_segment(self, size, frames_size, num_frames, latency):
+        self.segments_written += 1
+        self.bytes_written += size + frames_size
+        self.frames_written += num_frames
+        self.last_segment_latency = latency
+        self.max_segment_latency = max(self.max_segment_latency, latency)
+
+    def to_dict(self):
+        return dict(vars(self), updated = gmt1_now().strftime('%Y-%m-%d %H:%M:%S'))
+
+
+class SegmentedCapture:
+    '''
+    url --> HLS chunklist of the stream
+    stream --> stream name, used as sub-folder (PPS3, WestPier)
+    segment_duration --> seconds per MP4 segment (a multiple of frame_interval keeps frames aligned to segments)
+    max_disk_bytes --> delete the oldest segments once segments + frames of this stream exceed it (None: no limit)
+    max_age_days --> delete segments older than this (None: no limit)
+    '''
+    def __init__(self, url, stream, data_folder = 'Data', segment_duration = 300, frame_interval = 10,
+                 max_disk_bytes = None, max_age_days = None, backoff_initial = 1.0, backoff_max = 60.0):
+        self.url = url
+        self.stream = stream
+        self.data_folder = data_folder
+        self.segment_duration = segment_duration
+        self.frame_interval = frame_interval
+        self.max_disk_bytes = max_disk_bytes
+        self.max_age_days = max_age_days
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+
+        self.health = CaptureHealth()
+        self.health_file = os.path.join(data_folder, f'{stream}_capture_health.json')
+
+        # (mtime, path, bytes incl. frames) of every segment on disk, oldest first
+        self.segments = deque()
+        self.disk_bytes = 0
+        self._process = None
+
+        # Wall-clock time (time.time()) the last segment was closed, None before the first one
+        self._last_closed = None
+
+    # ---- retention -------------------------------------------------------------------------------------------
+
+    def _scan_segments(self):
+        '''
+        Find the segments already on disk (once, at startup)
+        '''
+        found = []
+        if os.path.isdir(self.data_folder):
+            for day in os.listdir(self.data_folder):
+                folder = os.path.join(self.data_folder, day, self.stream)
+                if not os.path.isdir(folder):
+                    continue
+                with FrameIndex(os.path.join(self.data_folder, day)) as index:
+                    with os.scandir(folder) as entries:
+                        for entry in entries:
+                            if entry.is_file() and SEGMENT_NAME_PATTERN.search(entry.name):
+                                stat = entry.stat()
+                                frames_size = sum(size or 0 for _, size in index.frames_of_video(self.stream, entry.name))
+                                found.append((stat.st_mtime, entry.path, stat.st_size + frames_size))
+        found.sort()
+        self.segments = deque(found)
+        self.disk_bytes = sum(size for _, _, size in found)
+
+        # A segment's mtime is when it was closed
+        if found:
+            self._last_closed = found[-1][0]
+
+    def _delete_segment(self, path):
+        folder = os.path.dirname(path)
+        with FrameIndex(os.path.dirname(folder)) as index:
+            frames = index.frames_of_video(self.stream, os.path.basename(path))
+            for frame_id, _ in frames:
+                try:
+                    os.remove(os.path.join(folder, f'Frame_{frame_id}.jpg'))
+                except FileNotFoundError:
+                    pass
+            index.remove_frames(self.stream, [frame_id for frame_id, _ in frames])
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def enforce_retention(self, now = None):
+        now = time.time() if now is None else now
+        # Never delete the segment that is currently being written
+        while len(self.segments) > 1:
+            mtime, path, size = self.segments[0]
+            too_old = self.max_age_days is not None and now - mtime > self.max_age_days * 86400
+            too_big = self.max_disk_bytes is not None and self.disk_bytes > self.max_disk_bytes
+            if not (too_old or too_big):
+                break
+
+            self.segments.popleft()
+            self._delete_segment(path)
+            self.disk_bytes -= size
+            self.health.segments_deleted += 1
+            self.health.bytes_deleted += size
+
+    # ---- capture ---------------------------------------------------------------------------------------------
+
+    def _write_health(self):
+        with open(self.health_file, 'w') as file:
+            json.dump(self.health.to_dict(), file, indent = 2)
+
+    def _record_gap(self, opened):
+        '''
+        Count what is missing between the last segment closed and the first segment of a session, opened at `opened`
+        '''
+        if self._last_closed is None:
+            return
+        gap = max(0.0, opened - self._last_closed)
+        dropped = int(gap // self.segment_duration)
+        self.health.seconds_missed += gap
+        self.health.segments_dropped += dropped
+        if dropped:
+            print (f'[{self.stream}] {gap:.0f} s without video, {dropped} segment(s) dropped')
+
+    def _finish_segment(self, index, output_folder, segment_path, opened_at, frames):
+        '''
+        Index the frames sampled during a completed segment, update health and retention
+        '''
+        segment_name = os.path.basename(segment_path)
+        rows = []
+        frames_size = 0
+        for frame_id, frame_time in frames:
+            frame_path = os.path.join(output_folder, f'Frame_{frame_id}.jpg')
+            size = os.path.getsize(frame_path) if os.path.exists(frame_path) else None
+            frames_size += size or 0
+            rows.append((frame_id, frame_time, segment_name, size))
+        index.add_frames(self.stream, rows)
+        write_frame_infos(os.path.join(output_folder, 'frame_infos.csv'), frames)
+
+        size = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+        latency = max(0.0, time.monotonic() - opened_at - self.segment_duration)
+        self.health.record_segment(size, frames_size, len(frames), latency)
+
+        self._last_closed = time.time()
+        self.segments.append((self._last_closed, segment_path, size + frames_size))
+        self.disk_bytes += size + frames_size
+        self.enforce_retention()
+        self._write_health()
+
+        print (f'[{self.stream}] {segment_name}: {len(frames)} frames, {(size + frames_size) / 1e6:.1f} MB, '
+               f'latency {latency:.1f} s, written {self.health.segments_written}, dropped {self.health.segments_dropped}')
+
+    def run_session(self, session_end):
+        '''
+        Capture until session_end (GMT+1 datetime) with one ffmpeg process. Returns True if the stream
+        lasted until session_end, False if ffmpeg stopped early (stream dropped).
+        '''
+        start_time = gmt1_now()
+        day_folder = os.path.join(self.data_folder, start_time.strftime(DATE_FORMAT))
+        output_folder = os.path.join(day_folder, self.stream)
+        os.makedirs(output_folder, exist_ok = True)
+
+        with FrameIndex(day_folder) as index:
+            if self.stream not in index.streams():
+                migrate_folder(day_folder, self.stream, index)
+            # Reserve the IDs of the whole session (upper bounds, the unused tails are released at the end), so a
+            # capture_video.py run on the same stream at the same time never gets the same frame or video IDs
+            session_seconds = max(1, int((session_end - start_time).total_seconds()))
+            num_frames = session_seconds // self.frame_interval + 2
+            num_segments = session_seconds // self.segment_duration + 2
+            start_number = index.reserve_frame_ids(self.stream, num_frames)
+            segment_number = index.reserve_video_ids(self.stream, num_segments)
+            command = [
+                'ffmpeg', '-hide_banner',
+                '-i', self.url,
+                '-t', str(session_seconds),
+                # Output 1: stream copy, cut into segments
+                '-map', '0:v', '-c:v', 'copy',
+                '-f', 'segment', '-segment_time', str(self.segment_duration),
+                '-segment_start_number', str(segment_number), '-reset_timestamps', '1',
+                os.path.join(output_folder, f'{self.stream}_Segment_%d.mp4'),
+                # Output 2: one frame every frame_interval seconds
+                '-t', str(session_seconds),
+                '-vf', f'fps=1/{self.frame_interval},showinfo',
+                '-start_number', str(start_number),
+                os.path.join(output_folder, 'Frame_%d.jpg')
+            ]
+
+            self._process = subprocess.Popen(command, stdin = subprocess.DEVNULL, stderr = subprocess.PIPE,
+                                             universal_newlines = True, errors = 'replace')
+            segment_path, opened_at, frames = None, None, []
+            first_pts_time = None
+            last_segment_number = segment_number - 1
+            last_frame_id = start_number - 1
+            try:
+                for line in self._process.stderr:
+                    match = SEGMENT_PATTERN.search(line)
+                    if match is not None:
+                        if segment_path is not None:
+                            self._finish_segment(index, output_folder, segment_path, opened_at, frames)
+                        else:
+                            self._record_gap(time.time())
+                        segment_path, opened_at, frames = match.group(1), time.monotonic(), []
+                        last_segment_number = int(SEGMENT_NAME_PATTERN.search(segment_path).group(1))
+                        continue
+
+                    match = SHOWINFO_PATTERN.search(line)
+                    if match is not None:
+                        pts_time = float(match.group(3))
+                        if first_pts_time is None:
+                            first_pts_time = pts_time
+                        frame_id = start_number + int(match.group(1))
+                        last_frame_id = max(last_frame_id, frame_id)
+                        frames.append((frame_id, start_time + timedelta(seconds = pts_time - first_pts_time)))
+            finally:
+                self._process.wait()
+                self._process = None
+                if segment_path is not None:
+                    self._finish_segment(index, output_folder, segment_path, opened_at, frames)
+                index.release_frame_ids(self.stream, start_number, start_number + num_frames, last_frame_id + 1)
+                index.release_video_ids(self.stream, segment_number, segment_number + num_segments,
+                                        last_segment_number + 1)
+
+        return gmt1_now() >= session_end - timedelta(seconds = self.segment_duration / 10)
+
+    def run(self):
+        '''
+        Capture forever: one session per day, reconnecting with exponential backoff when the stream drops
+        '''
+        self._scan_segments()
+        self.enforce_retention()
+        backoff = self.backoff_initial
+
+        try:
+            while True:
+                # Sessions end at midnight so every day gets its own folder and frame index
+                now = gmt1_now()
+                session_end = datetime(now.year, now.month, now.day) + timedelta(days = 1)
+
+                started = time.monotonic()
+                completed = self.run_session(session_end)
+                if completed:
+                    backoff = self.backoff_initial
+                    continue
+
+                # Stream dropped: wait, then reconnect. The segments lost are counted from the gap once the next
+                # session opens its first segment
+                if time.monotonic() - started > self.segment_duration:
+                    backoff = self.backoff_initial
+                self.health.reconnects += 1
+                self._write_health()
+                print (f'[{self.stream}] stream dropped, reconnecting in {backoff:.0f} s')
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+        except KeyboardInterrupt:
+            if self._process is not None:
+                self._process.terminate()
+            print (f'[{self.stream}] capture stopped: {self.health.to_dict()}')
+
+
+def run_continuous(url, stream, args):
+    '''
+    Entry point for capture_video.py --continuous (one process per stream)
+    '''
+    capture = SegmentedCapture(url, stream, segment_duration = args.segment_duration,
+                               frame_interval = args.frame_interval,
+                               max_disk_bytes = None if args.max_disk_gb is None else int(args.max_disk_gb * 1e9),
+                               max_age_days = args.max_age_days)
+    capture.run()
@@ -3,8 +3,9 @@ from multiprocessing import Process, freeze_support
 import os
 from datetime import datetime, timedelta
 import csv
-import glob
 import argparse
+import re
+from frame_index import FrameIndex, migrate_folder
 
 '''
 This script captures live stream video/image frames and stores them in Data/{Current Date}/ (PPS3 or WestPier)
@@ -20,72 +21,131 @@ def parse_arguments():
     # Arguments
     parser.add_argument('--frame_interval', type = int, default = 10, help = 'Extract frames every (FRAME_INTERVAL) seconds, default = 10')
     parser.add_argument('--record_duration', type = int, default = 60, help = 'Specify the length of recording in seconds, default = 60')
+    parser.add_argument('--continuous', action = 'store_true', help = 'Record continuously into time segmented files instead of one --record_duration run')
+    parser.add_argument('--segment_duration', type = int, default = 300, help = 'Length of each video segment in seconds with --continuous, default = 300')
+    parser.add_argument('--max_disk_gb', type = float, default = None, help = 'Delete the oldest segments once a stream uses more than MAX_DISK_GB with --continuous')
+    parser.add_argument('--max_age_days', type = float, default = None, help = 'Delete segments older than MAX_AGE_DAYS with --continuous')
 
     args = parser.parse_args()
     return args
 
 
-def capture_video(chunklist_url, duration, video_file_path):
-    '''
-        Run video capture process
-    '''
-    command = [
-        'ffmpeg',
-        '-i', chunklist_url,
-        '-t', str(duration),
-        '-c:v', 'copy', video_file_path
-    ]
+# showinfo prints one line per sampled frame, e.g. "[Parsed_showinfo_1 @ 0x..] n:   3 pts:      3 pts_time:30 ..."
+SHOWINFO_PATTERN = re.compile(r'n:\s*(\d+)\s+pts:\s*(-?\d+)\s+pts_time:\s*(-?[\d.]+)')
 
-    subprocess.run(command)
-    
 
-def capture_frames(chunklist_url, duration, frame_interval, frame_output_path, start_number):
+def capture_stream(chunklist_url, duration, frame_interval, video_file_path, frame_output_path, start_number, reserved_stop, csv_file):
     '''
-        Run Image Frame capture process
+        Run a single ffmpeg process per stream: the stream is downloaded and demuxed once and fanned out to
+        the stream-copy MP4 and the sampled image frames. Frame timestamps are taken from the presentation
+        timestamps (PTS) reported by the showinfo filter, relative to the first sampled frame.
+        Frame IDs [start_number, reserved_stop) were reserved in the frame index, the captured frames are
+        added to it afterwards.
     '''
     command = [
-        'ffmpeg',
+        'ffmpeg', '-hide_banner',
         '-i', chunklist_url,
         '-t', str(duration),
-        '-vf', f'fps=1/{frame_interval}', 
+        # Output 1: video stream copy
+        '-c:v', 'copy', video_file_path,
+        # Output 2: one frame every frame_interval seconds
+        '-t', str(duration),
+        '-vf', f'fps=1/{frame_interval},showinfo',
         '-start_number', str(start_number),
         frame_output_path
     ]
 
-    subprocess.run(command)
+    # GMT+1 wall clock time at which the capture started, anchors the stream PTS
+    start_time = datetime.utcnow() + timedelta(hours=1)
 
+    frame_times = []
+    first_pts_time = None
+    process = subprocess.Popen(command, stderr = subprocess.PIPE, universal_newlines = True, errors = 'replace')
+    for line in process.stderr:
+        match = SHOWINFO_PATTERN.search(line)
+        if match is None:
+            continue
 
-def setup_and_record(url, output_folder, args, processes):
+        frame_number, pts_time = int(match.group(1)), float(match.group(3))
+        if first_pts_time is None:
+            first_pts_time = pts_time
+        frame_times.append((start_number + frame_number, start_time + timedelta(seconds = pts_time - first_pts_time)))
+    process.wait()
+
+    write_frame_infos(csv_file, frame_times)
+    index_frames(video_file_path, frame_output_path, frame_times, start_number, reserved_stop)
+    return frame_times
 
-    output_filename = f'{os.path.basename(output_folder)}_Live_stream.mp4'
 
-    # Continuing/Starting number for Frame ID
-    existing_frames = glob.glob(os.path.join(output_folder, 'Frame_*.jpg'))
-    existing_indices = [int(os.path.splitext(os.path.basename(frame))[0].split('_')[1]) for frame in existing_frames]
+def index_frames(video_file_path, frame_output_path, frame_times, start_number, reserved_stop):
+    '''
+        Add the captured frames to the day's frame index and hand back the unused frame IDs
+    '''
+    output_folder = os.path.dirname(video_file_path)
+    stream = os.path.basename(output_folder)
+
+    frames = []
+    for frame_id, frame_time in frame_times:
+        frame_path = frame_output_path % frame_id
+        if os.path.exists(frame_path):
+            frames.append((frame_id, frame_time, os.path.basename(video_file_path), os.path.getsize(frame_path)))
+
+    with FrameIndex(os.path.dirname(output_folder)) as index:
+        index.add_frames(stream, frames)
+        next_unused = max((frame[0] for frame in frames), default = start_number - 1) + 1
+        index.release_frame_ids(stream, start_number, reserved_stop, next_unused)
+
+
+def write_frame_infos(csv_file, frame_times):
+    '''
+        Append (frame ID, timestamp) pairs to frame_infos.csv, creating it with a header if needed
+    '''
+    frame_prefix = 'Frame'
+    new_file = not os.path.exists(csv_file)
 
-    global start_number
-    start_number = max(existing_indices, default = -1) + 1 # start from the next index
-    
+    with open(csv_file, 'a', newline = '') as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(['Date', 'HH', 'MM', 'SS', 'FrameID'])
 
-    # Add new video file everytime this routine is called
-    existing_videos = glob.glob(os.path.join(output_folder, output_filename.rsplit('.', 1)[0] + '_*.mp4'))
-    existing_indices = [int(os.path.splitext(os.path.basename(video))[0].rsplit('_', 1)[1]) for video in existing_videos]
-    next_index = max(existing_indices, default=-1) + 1
-    
+        for frame_id, frame_time in frame_times:
+            writer.writerow([
+                frame_time.strftime('%d-%m-%y'),
+                frame_time.strftime('%H'),
+                frame_time.strftime('%M'),
+                frame_time.strftime('%S'),
+                f'{frame_prefix}_{frame_id}.jpg'
+            ])
+
+
+def setup_and_record(url, output_folder, args, processes):
+
+    stream = os.path.basename(output_folder)
+    output_filename = f'{stream}_Live_stream.mp4'
+
+    # Continuing/Starting number for Frame ID and new video file everytime this routine is called,
+    # allocated from the day's frame index instead of scanning the folder
+    with FrameIndex(os.path.dirname(output_folder)) as index:
+        if stream not in index.streams():
+            # Folder captured before the index existed: index it once
+            migrate_folder(os.path.dirname(output_folder), stream, index)
+
+        num_frames = args.record_duration // args.frame_interval + 2       # upper bound, unused IDs are released
+        start_number = index.reserve_frame_ids(stream, num_frames)
+        next_index = index.allocate_video_id(stream)
 
     # Construct ffmpeg command for video and frame capture
     base_filename = output_filename.rsplit('.', 1)[0]
     video_file_path = os.path.join(output_folder, f'{base_filename}_{next_index}.mp4')
     frame_output_path = os.path.join(output_folder, 'Frame_%d.jpg')
+    csv_file = os.path.join(output_folder, 'frame_infos.csv')
 
-    video_process = Process(target = capture_video, args = (url, args.record_duration, video_file_path), daemon = True)
-    frame_process = Process(target = capture_frames, args = (url, args.record_duration, args.frame_interval, frame_output_path, start_number), daemon = True)
-
-    video_process.start()
-    frame_process.start()
+    # One process (and one ffmpeg) per stream; it also logs the frame timestamps once ffmpeg is done
+    stream_process = Process(target = capture_stream, args = (url, args.record_duration, args.frame_interval, video_file_path, frame_output_path, start_number, start_number + num_frames, csv_file), daemon = True)
+    stream_process.start()
 
     # Store process references in a list for later joining
-    processes.extend([video_process, frame_process])
+    processes.append(stream_process)
 
 
 
@@ -108,39 +168,6 @@ def record_stream(args, url_folders_dict):
     for process in processes:
         process.join()
 
-    # Deferred logging: reduces I/O operations during recording
-    for url, subfolder_name in url_folders_dict.items():
-        if url:
-            output_folder = os.path.join(video_folder, subfolder_name)
-            csv_file = os.path.join(output_folder, 'frame_infos.csv')
-
-
-            if not os.path.exists(csv_file):
-                with open(csv_file, 'w', newline = '') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(['Date', 'HH', 'MM', 'SS', 'FrameID'])
-
-            
-            # Continuing/Starting number for Frame ID
-            existing_frames = glob.glob(os.path.join(output_folder, 'Frame_*.jpg'))
-            existing_indices = [int(os.path.splitext(os.path.basename(frame))[0].split('_')[1]) for frame in existing_frames]
-
-            # Calculate frame timestamps and write to CSV
-            frame_prefix = 'Frame'
-            num_frames = args.record_duration // args.frame_interval
-
-            with open(csv_file, 'a', newline = '') as file:
-                writer = csv.writer(file)
-                for i in range(start_number, max(existing_indices)+1):
-                    frame_time = current_time + timedelta(seconds = (i-start_number) * args.frame_interval)
-                    writer.writerow([
-                        frame_time.strftime('%d-%m-%y'),
-                        frame_time.strftime('%H'),
-                        frame_time.strftime('%M'),
-                        frame_time.strftime('%S'),
-                        f'{frame_prefix}_{i}.jpg'
-                    ])
-
 
 if __name__ == '__main__':
     freeze_support()            # For Windows support
@@ -152,4 +179,18 @@ if __name__ == '__main__':
     # e.g. url_dict = {pps3_url: 'PPS3, None: 'WestPier}
     url_dict = {pps3_url: 'PPS3', None: 'WestPier'}
 
-    record_stream(args, url_dict)
+    if args.continuous:
+        # Long running capture: one daemon process per stream, stopped with Ctrl+C
+        from capture_daemon import run_continuous
+
+        processes = [Process(target = run_continuous, args = (url, subfolder_name, args)) for url, subfolder_name in url_dict.items() if url]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.join()
+    else:
+        record_stream(args, url_dict)
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import shutil
+import argparse
+
+import h5py
+import numpy as np
+
+from time_series_schema import read_tracking_data, is_compact
+
+'''
+Columnar export of the tracking data for analysis.
+
+Loading Raw_Time_Series_Data/tracking_data.h5 with dataset[:] (or a CSV dump) reads every row and column into memory.
+export() instead streams the HDF5 file in chunks of CHUNK_ROWS into partitions
+
+    Exports/tracking_data/stream=PPS3/date=20231108/part-000000000000-000001048576/
+        date.npy  hour.npy  ...  cloud_cover.npy        one typed array per column (COLUMNS)
+        hour_offsets.npy                                rows are sorted by time of day: hour h is rows
+                                                        hour_offsets[h]:hour_offsets[h + 1]
+        track_ids.npy                                   sorted unique track IDs of the part
+        meta.json                                       rows, classes present, min/max per column
+
+Parts are named after the source rows they hold, so a re-run after a crash rewrites the same parts. The number of
+exported source rows is kept in _export.json; running export() again only adds the new rows (both layouts of
+time_series_schema.py are read).
+
+query() pushes the predicates down: stream/date prune directories, classes and track IDs prune parts from their
+metadata, hours become a row slice, and only the requested columns (plus those needed to filter) are memory-mapped.
+scan() yields one part at a time, so month-scale aggregations run in bounded memory.
+
+    python3 columnar_export.py --source Raw_Time_Series_Data/tracking_data.h5 --output Exports/tracking_data
+    python3 columnar_export.py --output Exports/tracking_data --dates 20231108 20231130 --hours 8 12 --classes 0 4 --columns track_id x y
+
+    store = ColumnarStore('Exports/tracking_data')
+    data = store.query(['track_id', 'x', 'y'], dates = (20231108, 20231130), hours = (8, 12), classes = [0, 4])
+    frame = store.to_pandas(['x', 'y'], track_ids = [17])
+'''
+
+# Column name, dtype, column of the flat 16-column layout
+COLUMNS = [('date', np.uint32, 0), ('hour', np.uint8, 1), ('minute', np.uint8, 2), ('seconds', np.uint8, 3),
+           ('microseconds', np.uint32, 4), ('time_norm', np.float64, 5), ('track_id', np.uint32, 6),
+           ('cls', np.uint8, 7), ('x', np.float32, 8), ('y', np.float32, 9), ('temp', np.float32, 10),
+           ('humidity', np.float32, 11), ('rain', np.float32, 12), ('showers', np.float32, 13),
+           ('snowfall', np.float32, 14), ('cloud_cover', np.float32, 15)]
+COLUMN_NAMES = [name for name, _, _ in COLUMNS]
+
+CHUNK_ROWS = 1 << 20
+
+STATE_FILE = '_export.json'
+
+
+def write_part(folder, rows):
+    '''
+    Write flat rows of one date as a part folder (atomically, replacing an existing part of the same name)
+    '''
+    # Time of day order, so every hour is one contiguous row range
+    order = np.lexsort((rows[:, 4], rows[:, 3], rows[:, 2], rows[:, 1]))
+    rows = rows[order]
+
+    tmp = folder + '.tmp'
+    shutil.rmtree(tmp, ignore_errors = True)
+    os.makedirs(tmp)
+
+    meta = {'rows': len(rows), 'min': {}, 'max': {}}
+    for name, dtype, column in COLUMNS:
+        values = rows[:, column]
+        np.save(os.path.join(tmp, f'{name}.npy'), values.astype(dtype))
+        finite = values[np.isfinite(values)]
+        meta['min'][name] = float(finite.min()) if len(finite) else None
+        meta['max'][name] = float(finite.max()) if len(finite) else None
+
+    hours = rows[:, 1].astype(np.int64)
+    np.save(os.path.join(tmp, 'hour_offsets.npy'), np.searchsorted(hours, np.arange(25)).astype(np.int64))
+    np.save(os.path.join(tmp, 'track_ids.npy'), np.unique(rows[:, 6]).astype(np.uint32))
+    meta['classes'] = np.unique(rows[:, 7]).astype(int).tolist()
+    with open(os.path.join(tmp, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+
+    shutil.rmtree(folder, ignore_errors = True)
+    os.rename(tmp, folder)
+
+
+def export(source, output, stream = 'PPS3', chunk_rows = CHUNK_ROWS):
+    '''
+    Append the rows of source added since the last export to the partitions of output. Returns the rows exported.
+    '''
+    os.makedirs(output, exist_ok = True)
+    state_path = os.path.join(output, STATE_FILE)
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as file:
+            state = json.load(file)
+    key = f'{os.path.abspath(source)}:{stream}'
+    offset = state.get(key, 0)
+
+    exported = 0
+    with h5py.File(source, 'r', libver = 'latest', swmr = True) as file:
+        total = file['detections'].shape[0] if is_compact(file) else file['tracking_data'].shape[0]
+        for start in range(offset, total, chunk_rows):
+            stop = min(start + chunk_rows, total)
+            rows = read_tracking_data(file, start, stop)
+            dates = rows[:, 0].astype(np.int64)
+            for date in np.unique(dates).tolist():
+                folder = os.path.join(output, f'stream={stream}', f'date={date}', f'part-{start:012d}-{stop:012d}')
+                os.makedirs(os.path.dirname(folder), exist_ok = True)
+                write_part(folder, rows[dates == date])
+
+            # Parts first, then the offset that says they exist
+            state[key] = stop
+            with open(state_path + '.tmp', 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(state_path + '.tmp', state_path)
+            exported += stop - start
+    return exported
+
+
+def _matches(values, spec):
+    '''
+    spec --> None (all), (low, high) inclusive range, or a list / single value
+    '''
+    if spec is None:
+        return np.ones(len(values), dtype = bool)
+    if isinstance(spec, tuple) and len(spec) == 2:
+        return (values >= spec[0]) & (values <= spec[1])
+    return np.isin(values, np.atleast_1d(spec))
+
+
+def _selected(value, spec):
+    return bool(_matches(np.array([value]), spec)[0])
+
+
+class ColumnarStore:
+    '''
+    Read side of an export folder
+    '''
+    def __init__(self, folder):
+        self.folder = folder
+
+    def streams(self):
+        return sorted(name.split('=', 1)[1] for name in os.listdir(self.folder) if name.startswith('stream='))
+
+    def partitions(self, stream = None, dates = None):
+        '''
+        (stream, date, part folder) of the parts that can hold rows of the stream(s) and dates
+        '''
+        parts = []
+        for name in self.streams():
+            if stream is not None and not _selected(name, stream):
+                continue
+            stream_folder = os.path.join(self.folder, f'stream={name}')
+            for date_name in sorted(os.listdir(stream_folder)):
+                date = int(date_name.split('=', 1)[1])
+                if dates is not None and not _selected(date, dates):
+                    continue
+                date_folder = os.path.join(stream_folder, date_name)
+                parts += [(name, date, os.path.join(date_folder, part)) for part in sorted(os.listdir(date_folder))
+                          if part.startswith('part-') and not part.endswith('.tmp')]
+        return parts
+
+    def scan(self, columns = None, stream = None, dates = None, hours = None, classes = None, track_ids = None):
+        '''
+        Yield {column: array} for every part with matching rows; only the needed columns are read
+        '''
+        columns = list(columns or COLUMN_NAMES)
+        for _, _, folder in self.partitions(stream, dates):
+            with open(os.path.join(folder, 'meta.json')) as file:
+                meta = json.load(file)
+
+            # Part pruning on its metadata
+            if classes is not None and not _matches(np.array(meta['classes']), classes).any():
+                continue
+            if track_ids is not None:
+                if not _matches(np.load(os.path.join(folder, 'track_ids.npy'), mmap_mode = 'r'), track_ids).any():
+                    continue
+
+            # Hours are a row range
+            offsets = np.load(os.path.join(folder, 'hour_offsets.npy'))
+            first, last = 0, meta['rows']
+            if hours is not None:
+                wanted = np.flatnonzero(_matches(np.arange(24), hours))
+                if len(wanted) == 0:
+                    continue
+                first, last = int(offsets[wanted[0]]), int(offsets[wanted[-1] + 1])
+            if first == last:
+                continue
+
+            def load(name):
+                return np.load(os.path.join(folder, f'{name}.npy'), mmap_mode = 'r')[first:last]
+
+            mask = None
+            for name, spec in (('hour', None if isinstance(hours, tuple) else hours), ('cls', classes),
+                               ('track_id', track_ids)):
+                if spec is not None:
+                    match = _matches(load(name), spec)
+                    mask = match if mask is None else mask & match
+            if mask is not None and not mask.any():
+                continue
+
+            yield {name: (np.asarray(load(name)) if mask is None else load(name)[mask]) for name in columns}
+
+    def query(self, columns = None, **predicates):
+        '''
+        All matching rows as {column: array} (see scan for the predicates)
+        '''
+        columns = list(columns or COLUMN_NAMES)
+        parts = list(self.scan(columns, **predicates))
+        dtypes = dict((name, dtype) for name, dtype, _ in COLUMNS)
+        if not parts:
+            return {name: np.empty(0, dtype = dtypes[name]) for name in columns}
+        return {name: np.concatenate([part[name] for part in parts]) for name in columns}
+
+    def to_pandas(self, columns = None, **predicates):
+        import pandas as pd
+        return pd.DataFrame(self.query(columns, **predicates))
+
+
+def benchmark(source, store, **predicates):
+    '''
+    Same query from the HDF5 file (read everything, filter in memory) and from the export
+    '''
+    start = time.perf_counter()
+    with h5py.File(source, 'r', libver = 'latest', swmr = True) as file:
+        rows = read_tracking_data(file)
+    mask = np.ones(len(rows), dtype = bool)
+    for name, column in (('dates', 0), ('hours', 1), ('track_ids', 6), ('classes', 7)):
+        if predicates.get(name) is not None:
+            mask &= _matches(rows[:, column], predicates[name])
+    hdf5_rows = int(mask.sum())
+    hdf5_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    data = store.query(['track_id', 'x', 'y'], **predicates)
+    export_time = time.perf_counter() - start
+
+    print (f'HDF5 read + filter:  {hdf5_time * 1000:8.1f} ms, {hdf5_rows} rows, {rows.nbytes / 1e6:.1f} MB in memory')
+    print (f'columnar query:      {export_time * 1000:8.1f} ms, {len(data["track_id"])} rows '
+           f'({hdf5_time / max(export_time, 1e-9):.1f}x faster)')
+
+
+def _range_or_list(values):
+    '''CLI values: two values are an inclusive range, otherwise a list'''
+    if values is None:
+        return None
+    return tuple(values) if len(values) == 2 else list(values)
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Columnar Export')
+
+    # Arguments
+    parser.add_argument('--source', type = str, default = None, help = 'Tracking HDF5 file to export (flat or compact); without it only query the export')
+    parser.add_argument('--output', type = str, default = os.path.join('Exports', 'tracking_data'), help = 'Export folder, default = Exports/tracking_data')
+    parser.add_argument('--stream', type = str, default = 'PPS3', help = 'Stream the source file belongs to, default = PPS3')
+    parser.add_argument('--chunk_rows', type = int, default = CHUNK_ROWS, help = f'Source rows read per chunk, default = {CHUNK_ROWS}')
+    parser.add_argument('--dates', type = int, nargs = '+', default = None, help = 'YYYYMMDD: two values are a range, otherwise a list')
+    parser.add_argument('--hours', type = int, nargs = '+', default = None, help = 'Hours: two values are a range, otherwise a list')
+    parser.add_argument('--classes', type = int, nargs = '+', default = None, help = 'Object class IDs')
+    parser.add_argument('--tracks', type = int, nargs = '+', default = None, help = 'Track IDs')
+    parser.add_argument('--columns', type = str, nargs = '+', default = ['track_id', 'cls', 'x', 'y'], choices = COLUMN_NAMES, help = 'Columns to read, default = track_id cls x y')
+    parser.add_argument('--benchmark', action = 'store_true', help = 'Time the query against reading the --source HDF5 file')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.source and not args.benchmark:
+        start = time.perf_counter()
+        rows = export(args.source, args.output, args.stream, args.chunk_rows)
+        print (f'Exported {rows} rows to {args.output} in {time.perf_counter() - start:.1f} s')
+
+    store = ColumnarStore(args.output)
+    predicates = {'dates': _range_or_list(args.dates), 'hours': _range_or_list(args.hours),
+                  'classes': args.classes, 'track_ids': args.tracks}
+    if args.benchmark:
+        benchmark(args.source, store, **predicates)
+    elif any(value is not None for value in predicates.values()):
+        start = time.perf_counter()
+        data = store.query(args.columns, **predicates)
+        elapsed = time.perf_counter() - start
+        print (f'{len(data[args.columns[0]])} rows in {elapsed * 1000:.1f} ms')
+        for name in args.columns:
+            print (f'{name}: {data[name][:10]}')
@@ -0,0 +1,320 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+'''
+Packed, memory-mapped label cache for the YOLOv8 segmentation dataset (Gdansk_Airport_Data_Annotation.v4i.yolov8).
+
+The polygon label .txt files of a split are parsed once into {split}/.cache/:
+    vertices.npy          float32 (V, 2)   normalised polygon vertices of all polygons, back to back
+    polygon_offsets.npy   int64   (P + 1)  vertices of polygon p are vertices[polygon_offsets[p]:polygon_offsets[p + 1]]
+    polygon_classes.npy   uint8   (P,)
+    polygon_boxes.npy     float32 (P, 4)   normalised x1, y1, x2, y2
+    polygon_areas.npy     float32 (P,)     normalised polygon area (shoelace)
+    image_offsets.npy     int64   (N + 1)  polygons of image i are image_offsets[i]:image_offsets[i + 1]
+    meta.json                              image names + fingerprint
+Arrays are opened with mmap_mode = 'r', so opening the cache costs nothing and statistics / filtering are numpy
+operations over the packed arrays. The fingerprint hashes name, size and mtime of every label and image file; any
+change rebuilds the cache. Images are decoded only when asked for; thumbnails (letterboxed to a fixed size) are kept
+in one memory-mapped uint8 array once built.
+
+    dataset = YoloDataset('train')
+    dataset.class_counts()                              # polygons per class
+    for sample in dataset.iter(dataset.filter(classes = [5, 6]), images = True):
+        sample.image, sample.classes, sample.polygons   # polygons: list of (k, 2) arrays in pixels if image loaded
+
+    python3 dataset_cache.py --split all --stats
+'''
+
+DATASET_DIR = 'Gdansk_Airport_Data_Annotation.v4i.yolov8'
+SPLITS = ['train', 'valid', 'test']
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+CACHE_VERSION = 1
+ARRAYS = ['vertices', 'polygon_offsets', 'polygon_classes', 'polygon_boxes', 'polygon_areas', 'image_offsets']
+
+Sample = namedtuple('Sample', ['index', 'name', 'classes', 'polygons', 'image'])
+
+
+def class_names(dataset_dir = DATASET_DIR):
+    '''
+    names from data.yaml (parsed without a yaml dependency: names: ['a', 'b', ...])
+    '''
+    with open(os.path.join(dataset_dir, 'data.yaml')) as file:
+        for line in file:
+            if line.startswith('names:'):
+                return [name.strip().strip('\'"') for name in line.split(':', 1)[1].strip().strip('[]').split(',')]
+    return []
+
+
+def label_path(labels_dir, image_name):
+    return os.path.join(labels_dir, os.path.splitext(image_name)[0] + '.txt')
+
+
+def fingerprint(images_dir, labels_dir):
+    '''
+    (sorted image names, hash over name / size / mtime of every image and label file)
+    '''
+    digest = hashlib.sha1(str(CACHE_VERSION).encode())
+    names = []
+    for folder in (images_dir, labels_dir):
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as entries:
+            stats = sorted((entry.name, entry.stat()) for entry in entries if entry.is_file())
+        for name, stat in stats:
+            digest.update(f'{folder}/{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+            if folder == images_dir and name.lower().endswith(IMAGE_EXTENSIONS):
+                names.append(name)
+    return names, digest.hexdigest()
+
+
+def parse_label_file(path):
+    '''
+    YOLO polygon label file --> list of (class ID, (k, 2) float32 vertices)
+    '''
+    polygons = []
+    if not os.path.exists(path):
+        return polygons
+    with open(path) as file:
+        for line in file:
+            values = line.split()
+            if len(values) < 7:
+                continue
+            coordinates = np.array(values[1:], dtype = np.float32)
+            polygons.append((int(values[0]), coordinates[:len(coordinates) // 2 * 2].reshape(-1, 2)))
+    return polygons
+
+
+def build_cache(images_dir, labels_dir, cache_dir, names, digest):
+    '''
+    Parse all label files of a split into the packed arrays. Written to a temporary folder first and swapped in,
+    so readers never see a half-written cache.
+    '''
+    vertices, counts, classes, image_counts = [], [], [], []
+    for name in names:
+        polygons = parse_label_file(label_path(labels_dir, name))
+        image_counts.append(len(polygons))
+        for class_id, polygon in polygons:
+            vertices.append(polygon)
+            counts.append(len(polygon))
+            classes.append(class_id)
+
+    vertices = np.concatenate(vertices) if vertices else np.empty((0, 2), dtype = np.float32)
+    polygon_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    starts = polygon_offsets[:-1]
+
+    if len(starts):
+        polygon_boxes = np.column_stack((np.minimum.reduceat(vertices, starts), np.maximum.reduceat(vertices, starts)))
+        # Shoelace per polygon: sum of x_i * y_(i+1) - x_(i+1) * y_i, the next vertex wrapping around inside the polygon
+        following = np.roll(vertices, -1, axis = 0)
+        following[polygon_offsets[1:] - 1] = vertices[starts]
+        cross = vertices[:, 0] * following[:, 1] - following[:, 0] * vertices[:, 1]
+        polygon_areas = np.abs(np.add.reduceat(cross, starts)) / 2
+    else:
+        polygon_boxes = np.empty((0, 4), dtype = np.float32)
+        polygon_areas = np.empty(0, dtype = np.float32)
+
+    arrays = {'vertices': vertices.astype(np.float32),
+              'polygon_offsets': polygon_offsets,
+              'polygon_classes': np.array(classes, dtype = np.uint8),
+              'polygon_boxes': polygon_boxes.astype(np.float32),
+              'polygon_areas': polygon_areas.astype(np.float32),
+              'image_offsets': np.concatenate(([0], np.cumsum(image_counts))).astype(np.int64)}
+
+    temporary = cache_dir + '.tmp'
+    shutil.rmtree(temporary, ignore_errors = True)
+    os.makedirs(temporary)
+    for name, array in arrays.items():
+        np.save(os.path.join(temporary, f'{name}.npy'), array)
+    with open(os.path.join(temporary, 'meta.json'), 'w') as file:
+        json.dump({'version': CACHE_VERSION, 'fingerprint': digest, 'names': names}, file)
+
+    shutil.rmtree(cache_dir, ignore_errors = True)
+    os.replace(temporary, cache_dir)
+
+
+class YoloDataset:
+    '''
+    split --> 'train', 'valid' or 'test'
+    dataset_dir --> dataset root (data.yaml, {split}/images, {split}/labels)
+    rebuild --> force re-parsing the labels
+    '''
+    def __init__(self, split = 'train', dataset_dir = DATASET_DIR, rebuild = False):
+        self.split = split
+        self.dataset_dir = dataset_dir
+        self.images_dir = os.path.join(dataset_dir, split, 'images')
+        self.labels_dir = os.path.join(dataset_dir, split, 'labels')
+        self.cache_dir = os.path.join(dataset_dir, split, '.cache')
+        self.class_names = class_names(dataset_dir)
+
+        names, digest = fingerprint(self.images_dir, self.labels_dir)
+        meta = self._read_meta()
+        self.rebuilt = rebuild or meta is None or meta.get('fingerprint') != digest
+        if self.rebuilt:
+            build_cache(self.images_dir, self.labels_dir, self.cache_dir, names, digest)
+            meta = self._read_meta()
+
+        self.names = meta['names']
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(self.cache_dir, f'{name}.npy'), mmap_mode = 'r'))
+        self._polygon_images = None
+
+    def _read_meta(self):
+        try:
+            with open(os.path.join(self.cache_dir, 'meta.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def polygon_images(self):
+        '''Image index of every polygon'''
+        if self._polygon_images is None:
+            self._polygon_images = np.repeat(np.arange(len(self.names)), np.diff(self.image_offsets))
+        return self._polygon_images
+
+    # ---- per image -------------------------------------------------------------------------------------------
+
+    def image_path(self, index):
+        return os.path.join(self.images_dir, self.names[index])
+
+    def image(self, index):
+        return cv2.imread(self.image_path(index))
+
+    def labels(self, index):
+        '''
+        (classes, list of (k, 2) normalised vertex arrays) of an image; the polygons are views into the cache
+        '''
+        first, last = self.image_offsets[index], self.image_offsets[index + 1]
+        offsets = self.polygon_offsets[first:last + 1]
+        polygons = [self.vertices[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+        return np.asarray(self.polygon_classes[first:last]), polygons
+
+    def iter(self, indices = None, images = False):
+        '''
+        Samples of the given images (all by default). With images = True the image is decoded and the polygons
+        are scaled to pixels; otherwise image is None and polygons stay normalised.
+        '''
+        for index in (range(len(self)) if indices is None else indices):
+            index = int(index)
+            classes, polygons = self.labels(index)
+            image = None
+            if images:
+                image = self.image(index)
+                scale = np.array([image.shape[1], image.shape[0]], dtype = np.float32)
+                polygons = [polygon * scale for polygon in polygons]
+            yield Sample(index, self.names[index], classes, polygons, image)
+
+    def __iter__(self):
+        return self.iter()
+
+    # ---- statistics and filtering ----------------------------------------------------------------------------
+
+    def class_counts(self):
+        '''Polygons per class'''
+        return np.bincount(self.polygon_classes, minlength = len(self.class_names))
+
+    def images_per_class(self):
+        '''Number of images containing each class'''
+        pairs = np.unique(self.polygon_images * 256 + self.polygon_classes)
+        return np.bincount(pairs % 256, minlength = len(self.class_names))
+
+    def stats(self):
+        counts = self.class_counts()
+        images = self.images_per_class()
+        vertices = np.diff(self.polygon_offsets)
+        report = {'images': len(self), 'polygons': int(len(self.polygon_classes)),
+                  'unlabelled_images': int(np.count_nonzero(np.diff(self.image_offsets) == 0)),
+                  'mean_vertices': float(vertices.mean()) if len(vertices) else 0.0, 'classes': {}}
+        for class_id, name in enumerate(self.class_names):
+            selected = self.polygon_classes == class_id
+            areas = self.polygon_areas[selected]
+            report['classes'][name] = {'polygons': int(counts[class_id]), 'images': int(images[class_id]),
+                                       'median_area': float(np.median(areas)) if len(areas) else 0.0}
+        return report
+
+    def filter(self, classes = None, min_area = None, max_area = None, min_polygons = None):
+        '''
+        Indices of images with at least min_polygons (default 1 if any criterion is given) polygons matching
+        the classes and the normalised area range
+        '''
+        selected = np.ones(len(self.polygon_classes), dtype = bool)
+        if classes is not None:
+            selected &= np.isin(self.polygon_classes, classes)
+        if min_area is not None:
+            selected &= self.polygon_areas >= min_area
+        if max_area is not None:
+            selected &= self.polygon_areas <= max_area
+        counts = np.bincount(self.polygon_images[selected], minlength = len(self))
+        return np.flatnonzero(counts >= (1 if min_polygons is None else min_polygons))
+
+    # ---- thumbnails ------------------------------------------------------------------------------------------
+
+    def thumbnails(self, size = 160):
+        '''
+        (N, size * 9 // 16, size, 3) uint8 memory-mapped array of letterboxed thumbnails, built on first use
+        '''
+        path = os.path.join(self.cache_dir, f'thumbnails_{size}.npy')
+        if not os.path.exists(path):
+            height = size * 9 // 16
+            temporary = path + '.tmp.npy'
+            array = np.lib.format.open_memmap(temporary, mode = 'w+', dtype = np.uint8, shape = (len(self), height, size, 3))
+            for index in range(len(self)):
+                image = self.image(index)
+                if image is None:
+                    continue
+                scale = min(size / image.shape[1], height / image.shape[0])
+                resized = cv2.resize(image, (max(1, round(image.shape[1] * scale)), max(1, round(image.shape[0] * scale))),
+                                     interpolation = cv2.INTER_AREA)
+                array[index, :resized.shape[0], :resized.shape[1]] = resized
+            array.flush()
+            del array
+            os.replace(temporary, path)
+        return np.load(path, mmap_mode = 'r')
+
+    def thumbnail(self, index, size = 160):
+        return self.thumbnails(size)[index]
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Dataset Cache')
+
+    # Arguments
+    parser.add_argument('--dataset', type = str, default = DATASET_DIR, help = f'Dataset folder, default = {DATASET_DIR}')
+    parser.add_argument('--split', type = str, default = 'all', choices = SPLITS + ['all'], help = 'Split to cache, default = all')
+    parser.add_argument('--rebuild', action = 'store_true', help = 'Re-parse the labels even if the cache is up to date')
+    parser.add_argument('--stats', action = 'store_true', help = 'Print class statistics')
+    parser.add_argument('--thumbnails', type = int, default = None, help = 'Also build the thumbnail cache with this width')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    for split in (SPLITS if args.split == 'all' else [args.split]):
+        if not os.path.isdir(os.path.join(args.dataset, split)):
+            continue
+        dataset = YoloDataset(split, args.dataset, rebuild = args.rebuild)
+        print (f'{split}: {len(dataset)} images, {len(dataset.polygon_classes)} polygons '
+               f'({"rebuilt" if dataset.rebuilt else "cached"})')
+        if args.thumbnails:
+            dataset.thumbnails(args.thumbnails)
+        if args.stats:
+            for name, values in dataset.stats()['classes'].items():
+                print (f"    {name:<16} {values['polygons']:>6} polygons in {values['images']:>5} images, "
+                       f"median area {values['median_area']:.4f}")
@@ -0,0 +1,274 @@
+import os
+import re
+import csv
+import sqlite3
+import argparse
+from datetime import datetime
+
+'''
+Per-day frame index for captured data: Data/{date}/frame_index.sqlite
+
+Stores frame ID, exact timestamp (GMT+1), stream, source video and size of every captured frame, plus per-stream
+counters so the next frame/video ID is allocated in O(1) instead of globbing and parsing every file name.
+SQLite in WAL mode with IMMEDIATE transactions makes concurrent writers (one capture process per stream) safe.
+
+    index = FrameIndex('Data/08_11_2023')
+    start = index.reserve_frame_ids('PPS3', 7)          # IDs start .. start+6 belong to this capture
+    index.add_frames('PPS3', [(frame_id, timestamp, video, size), ...])
+    index.release_frame_ids('PPS3', start, start + 7, next_unused)
+    index.frames_between('PPS3', datetime(2023, 11, 8, 8), datetime(2023, 11, 8, 9))
+
+Build the index for existing folders (reads frame_infos.csv, scans each folder once):
+    python3 frame_index.py --migrate Data
+'''
+
+INDEX_FILENAME = 'frame_index.sqlite'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+FRAME_PATTERN = re.compile(r'^Frame_(\d+)\.jpg$')
+VIDEO_PATTERN = re.compile(r'_(\d+)\.mp4$')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS frames (
+    stream TEXT NOT NULL,
+    frame_id INTEGER NOT NULL,
+    timestamp TEXT,
+    source_video TEXT,
+    size INTEGER,
+    PRIMARY KEY (stream, frame_id)
+);
+CREATE INDEX IF NOT EXISTS frames_by_time ON frames (stream, timestamp);
+CREATE TABLE IF NOT EXISTS counters (
+    stream TEXT PRIMARY KEY,
+    next_frame_id INTEGER NOT NULL DEFAULT 0,
+    next_video_id INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+
+def format_timestamp(timestamp):
+    return timestamp.strftime(TIMESTAMP_FORMAT) if isinstance(timestamp, datetime) else timestamp
+
+
+class FrameIndex:
+    '''
+    day_folder --> Data/{date}; the index file is created inside it.
+    Streams are the sub-folder names (PPS3, WestPier); '' for frames stored directly in the day folder.
+    '''
+    def __init__(self, day_folder, timeout = 30.0):
+        self.path = os.path.join(day_folder, INDEX_FILENAME)
+        self.connection = sqlite3.connect(self.path, timeout = timeout, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _transaction(self, statements):
+        '''
+        Run callable(statements(cursor)) inside an IMMEDIATE transaction (takes the write lock up front)
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            result = statements(cursor)
+            cursor.execute('COMMIT')
+            return result
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def _allocate(self, stream, column, count):
+        def allocate(cursor):
+            cursor.execute('INSERT OR IGNORE INTO counters (stream) VALUES (?)', (stream,))
+            start = cursor.execute(f'SELECT {column} FROM counters WHERE stream = ?', (stream,)).fetchone()[0]
+            cursor.execute(f'UPDATE counters SET {column} = ? WHERE stream = ?', (start + count, stream))
+            return start
+        return self._transaction(allocate)
+
+    def reserve_frame_ids(self, stream, count):
+        '''Reserve `count` consecutive frame IDs, returns the first one'''
+        return self._allocate(stream, 'next_frame_id', count)
+
+    def _release(self, stream, column, start, stop, next_unused):
+        def release(cursor):
+            cursor.execute(f'UPDATE counters SET {column} = ? WHERE stream = ? AND {column} = ?',
+                           (max(next_unused, start), stream, stop))
+        self._transaction(release)
+
+    def release_frame_ids(self, stream, start, stop, next_unused):
+        '''
+        Give back the unused tail [next_unused, stop) of a reservation [start, stop), if nobody reserved after it
+        '''
+        self._release(stream, 'next_frame_id', start, stop, next_unused)
+
+    def next_ids(self, stream):
+        '''(next frame ID, next video ID) of a stream without allocating them'''
+        row = self.connection.execute('SELECT next_frame_id, next_video_id FROM counters WHERE stream = ?',
+                                      (stream,)).fetchone()
+        return row if row is not None else (0, 0)
+
+    def allocate_video_id(self, stream):
+        return self._allocate(stream, 'next_video_id', 1)
+
+    def reserve_video_ids(self, stream, count):
+        '''Reserve `count` consecutive video IDs (e.g. the segments of one capture session), returns the first one'''
+        return self._allocate(stream, 'next_video_id', count)
+
+    def release_video_ids(self, stream, start, stop, next_unused):
+        '''Same as release_frame_ids, for a reservation of video IDs'''
+        self._release(stream, 'next_video_id', start, stop, next_unused)
+
+    def add_frames(self, stream, frames):
+        '''
+        frames --> iterable of (frame_id, timestamp (datetime or str), source_video, size in bytes)
+        '''
+        rows = [(stream, frame_id, format_timestamp(timestamp), source_video, size)
+                for frame_id, timestamp, source_video, size in frames]
+
+        def insert(cursor):
+            cursor.executemany('INSERT OR REPLACE INTO frames (stream, frame_id, timestamp, source_video, size) '
+                               'VALUES (?, ?, ?, ?, ?)', rows)
+            if rows:
+                # Keep the counter ahead of every indexed frame
+                cursor.execute('INSERT OR IGNORE INTO counters (stream) VALUES (?)', (stream,))
+                cursor.execute('UPDATE counters SET next_frame_id = MAX(next_frame_id, ?) WHERE stream = ?',
+                               (max(row[1] for row in rows) + 1, stream))
+        self._transaction(insert)
+
+    def set_next_video_id(self, stream, next_video_id):
+        def update(cursor):
+            cursor.execute('INSERT OR IGNORE INTO counters (stream) VALUES (?)', (stream,))
+            cursor.execute('UPDATE counters SET next_video_id = MAX(next_video_id, ?) WHERE stream = ?',
+                           (next_video_id, stream))
+        self._transaction(update)
+
+    def frames_between(self, stream, start, end):
+        '''
+        (frame_id, timestamp, source_video, size) of frames with start <= timestamp < end, ordered by time
+        '''
+        return self.connection.execute(
+            'SELECT frame_id, timestamp, source_video, size FROM frames '
+            'WHERE stream = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp',
+            (stream, format_timestamp(start), format_timestamp(end))).fetchall()
+
+    def frames_of_video(self, stream, source_video):
+        '''(frame_id, size) of the frames sampled from a video'''
+        return self.connection.execute('SELECT frame_id, size FROM frames WHERE stream = ? AND source_video = ?',
+                                       (stream, source_video)).fetchall()
+
+    def video_time_range(self, stream, source_video):
+        '''(first, last) timestamp of the frames sampled from a video, (None, None) if it has no indexed frames'''
+        return self.connection.execute('SELECT MIN(timestamp), MAX(timestamp) FROM frames WHERE stream = ? AND source_video = ?',
+                                       (stream, source_video)).fetchone()
+
+    def remove_frames(self, stream, frame_ids):
+        def delete(cursor):
+            cursor.executemany('DELETE FROM frames WHERE stream = ? AND frame_id = ?',
+                               [(stream, frame_id) for frame_id in frame_ids])
+        self._transaction(delete)
+
+    def frame(self, stream, frame_id):
+        return self.connection.execute(
+            'SELECT frame_id, timestamp, source_video, size FROM frames WHERE stream = ? AND frame_id = ?',
+            (stream, frame_id)).fetchone()
+
+    def streams(self):
+        return [row[0] for row in self.connection.execute('SELECT stream FROM counters ORDER BY stream')]
+
+
+def read_frame_infos(csv_file):
+    '''
+    frame_infos.csv --> {frame ID: datetime}
+    '''
+    timestamps = {}
+    if not os.path.exists(csv_file):
+        return timestamps
+
+    with open(csv_file, newline = '') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for row in reader:
+            if len(row) < 5:
+                continue
+            match = FRAME_PATTERN.match(row[4])
+            if match is None:
+                continue
+            try:
+                timestamp = datetime.strptime(f'{row[0]} {row[1]}:{row[2]}:{row[3]}', '%d-%m-%y %H:%M:%S')
+            except ValueError:
+                continue
+            timestamps[int(match.group(1))] = timestamp
+    return timestamps
+
+
+def migrate_folder(day_folder, stream, index):
+    '''
+    Index the frames and videos of one stream folder. Returns the number of indexed frames.
+    '''
+    folder = os.path.join(day_folder, stream)
+    timestamps = read_frame_infos(os.path.join(folder, 'frame_infos.csv'))
+
+    frames = []
+    video_ids = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            match = FRAME_PATTERN.match(entry.name)
+            if match is not None:
+                frame_id = int(match.group(1))
+                frames.append((frame_id, timestamps.get(frame_id), None, entry.stat().st_size))
+                continue
+            match = VIDEO_PATTERN.search(entry.name)
+            if match is not None:
+                video_ids.append(int(match.group(1)))
+
+    index.add_frames(stream, frames)
+    if video_ids:
+        index.set_next_video_id(stream, max(video_ids) + 1)
+    return len(frames)
+
+
+def migrate(data_folder):
+    '''
+    Build the index of every Data/{date} folder from the existing files and frame_infos.csv
+    '''
+    for day in sorted(os.listdir(data_folder)):
+        day_folder = os.path.join(data_folder, day)
+        if not os.path.isdir(day_folder):
+            continue
+
+        with FrameIndex(day_folder) as index:
+            # Older captures keep the frames directly in the day folder, newer ones in a folder per stream
+            streams = [''] + [entry.name for entry in os.scandir(day_folder) if entry.is_dir()]
+            for stream in streams:
+                count = migrate_folder(day_folder, stream, index)
+                if count:
+                    print (f'{day_folder}/{stream}: indexed {count} frames')
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Frame Index')
+
+    # Arguments
+    parser.add_argument('--migrate', type = str, metavar = 'DATA_FOLDER', help = 'Build the index for every day folder in DATA_FOLDER, e.g. Data')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    if args.migrate:
+        migrate(args.migrate)
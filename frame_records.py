@@ -0,0 +1,160 @@
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from time_series_schema import NUM_FLAT_COLUMNS, UTC_OFFSET_HOURS
+
+'''
+Per-frame record building for the flat 16 column layout (see time_series_schema.FLAT_COLUMNS).
+
+Every frame is stamped once (the frame's capture time, unix microseconds UTC), so date, hour, minute, seconds and
+microseconds always describe the same instant. The rows of a frame are written in place into a preallocated
+(n, 16) float64 buffer -- the time and weather columns broadcast from scalars, no per-frame temporaries -- and the
+buffer is handed to the HDF5 writer once flush_rows rows (or flush_interval seconds) have accumulated. Frames
+without tracks (result.boxes.id is None) add no rows.
+
+    with FrameRecordBuilder(BufferedDatasetWriter(file, 'tracking_data', row_shape = (16,))) as builder:
+        for timestamp_us, result in ...:
+            track_id, obj_class, x_centers, y_centers = frame_detections(result)
+            builder.append_frame(timestamp_us, weather, track_id, obj_class, x_centers, y_centers)
+
+append_frame has the signature of CompactTrackingWriter.append_frame, so both schemas are fed the same way.
+'''
+
+DAY_US = 86400 * 1000000
+
+EMPTY_DETECTIONS = (np.empty(0, dtype = np.float32),) * 4
+
+
+def frame_detections(result):
+    '''
+    Track IDs, classes and box centres of a tracked result as NumPy arrays (one device --> host copy).
+    Frames without tracks return empty arrays instead of failing on result.boxes.id being None.
+    '''
+    boxes = result.boxes
+    if boxes is None or boxes.id is None:
+        return EMPTY_DETECTIONS
+
+    # Tracked boxes: x1, y1, x2, y2, track_id, conf, cls
+    data = boxes.data.cpu().numpy()
+    x_centers = (data[:, 0] + data[:, 2]) / 2
+    y_centers = (data[:, 1] + data[:, 3]) / 2
+    return data[:, -3], data[:, -1], x_centers, y_centers
+
+
+class FrameRecordBuilder:
+    '''
+    writer --> BufferedDatasetWriter of the flat (16,) float64 dataset; closed together with the builder
+    flush_rows --> hand the buffered rows to the writer once this many are buffered
+    flush_interval --> ... or if this many seconds passed since the last hand over (None to disable)
+    utc_offset_hours --> time zone of the time columns, default GMT+1
+    '''
+    def __init__(self, writer, flush_rows = 512, flush_interval = 1.0, utc_offset_hours = UTC_OFFSET_HOURS):
+        self.writer = writer
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.offset_us = int(utc_offset_hours * 3600 * 1000000)
+
+        self._buffer = np.empty((2 * flush_rows, NUM_FLAT_COLUMNS), dtype = np.float64)
+        self._count = 0
+        self._last_hand_over = time.monotonic()
+
+        # The date column only changes once a day
+        self._day = None
+        self._date = None
+
+        self.frames = 0
+        self.empty_frames = 0
+
+    def __len__(self):
+        '''Rows buffered and not yet handed to the writer'''
+        return self._count
+
+    def time_columns(self, timestamp_us):
+        '''
+        Date (YYYYMMDD), hour, minute, seconds, microseconds and time normalized of one timestamp,
+        the same values as time_series_schema.split_timestamps
+        '''
+        day, us_of_day = divmod(int(timestamp_us) + self.offset_us, DAY_US)
+        if day != self._day:
+            local_date = date(1970, 1, 1) + timedelta(days = day)
+            self._day = day
+            self._date = float(local_date.year * 10000 + local_date.month * 100 + local_date.day)
+
+        seconds_of_day, microseconds = divmod(us_of_day, 1000000)
+        hour, rest = divmod(seconds_of_day, 3600)
+        minute, seconds = divmod(rest, 60)
+        time_normalized = (hour + minute/60.0 + seconds/3600.0 + microseconds/(60*60*1000000))/24
+        return self._date, float(hour), float(minute), float(seconds), float(microseconds), time_normalized
+
+    def add(self, timestamp_us, weather, track_ids, classes, x, y):
+        '''
+        Write the rows of one frame into the buffer. weather --> WeatherObservation or None (NaN).
+        Returns the number of rows added.
+        '''
+        self.frames += 1
+        n = len(track_ids)
+        if n == 0:
+            self.empty_frames += 1
+            return 0
+
+        end = self._count + n
+        if end > len(self._buffer):
+            # Only a frame with more detections than the free space grows the buffer
+            grown = np.empty((max(2 * len(self._buffer), end), NUM_FLAT_COLUMNS), dtype = np.float64)
+            grown[:self._count] = self._buffer[:self._count]
+            self._buffer = grown
+
+        rows = self._buffer[self._count:end]
+        rows[:, 0:6] = self.time_columns(timestamp_us)
+        rows[:, 6] = track_ids
+        rows[:, 7] = classes
+        rows[:, 8] = x
+        rows[:, 9] = y
+        rows[:, 10:16] = np.nan if weather is None else weather.values
+        self._count = end
+        return n
+
+    def due(self):
+        '''True if the buffered rows should be handed to the writer'''
+        if self._count >= self.flush_rows:
+            return True
+        return (self.flush_interval is not None and self._count > 0
+                and time.monotonic() - self._last_hand_over >= self.flush_interval)
+
+    def hand_over(self):
+        '''
+        Pass the buffered rows to the writer in one append (the writer copies them, the buffer is reused)
+        '''
+        if self._count:
+            self.writer.append(self._buffer[:self._count])
+            self._count = 0
+        self._last_hand_over = time.monotonic()
+
+    def append_frame(self, timestamp_us, weather, track_ids, classes, x, y, predicted = False):
+        '''
+        add() and hand the rows over when due. Same signature as CompactTrackingWriter.append_frame, but the flat
+        layout has no column for predicted (carried forward) frames, so they are refused instead of stored as
+        ordinary rows.
+        '''
+        if predicted:
+            raise ValueError('The flat layout cannot mark predicted frames, use the compact schema')
+        n = self.add(timestamp_us, weather, track_ids, classes, x, y)
+        if self.due():
+            self.hand_over()
+        return n
+
+    def flush(self):
+        self.hand_over()
+        self.writer.flush()
+
+    def close(self):
+        self.hand_over()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,19 +1,76 @@
-from ultralytics import YOLO
 import torch
 import h5py
 import os
-from datetime import datetime, timedelta
 import numpy as np
-from live_weather import get_current_weather
+import argparse
+from weather_provider import WeatherProvider
+from hdf5_writer import BufferedDatasetWriter
+from time_series_schema import CompactTrackingWriter, UTC_OFFSET_HOURS
+from frame_records import FrameRecordBuilder, frame_detections
+from motion_gate import MotionGate, gated_track
+from turnaround_events import TurnaroundDetector, describe, write_events, CLASS_NAMES
+from multi_stream_tracker import MultiStreamTracker
+from pipeline_metrics import PipelineMetrics, MetricsLogger, serve_metrics, DEFAULT_PORT
+from inference_backend import add_backend_arguments, load_model
+from tiled_inference import TiledPredictor, load_regions
+from storage_queue import BoundedQueue, StorageStage, POLICIES
 
 
 '''
     This script generates the time-series data from live-steam video in the following format -- float64 :-
     | Date(YYYYMMDD) | Hour | Minute | Seconds | Time Normalized | Track ID | Obj Class | Centroid_x | Centroid_y | Temp (C) 2m | Humidity (%) 2m |...
     ...| Rain (mm) | Showers (mm) | Cloud Cover (%) | 
+
+    With --schema compact, frames/detections/weather are stored in separate compact tables instead
+    (see time_series_schema.py, which can rebuild the layout above).
+
+    The inference loop only queues one record per frame; turnaround events, building the rows and the HDF5 writes
+    run on a separate storage thread behind a bounded queue (see storage_queue.py, --queue_size / --backpressure).
+    Every frame carries a single capture timestamp; its rows are built in place in a preallocated buffer and
+    handed to the writer in batches (see frame_records.py).
 '''
 
 
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Generate Time Series Data')
+
+    # Arguments
+    parser.add_argument('--weather_interval', type = int, default = 300, help = 'Refresh live weather every (WEATHER_INTERVAL) seconds, default = 300')
+    parser.add_argument('--weather_max_age', type = int, default = 1800, help = 'Weather older than (WEATHER_MAX_AGE) seconds is stored as NaN, default = 1800')
+    parser.add_argument('--chunk_rows', type = int, default = 2048, help = 'Rows per HDF5 chunk and per write batch for a new dataset, default = 2048')
+    parser.add_argument('--compression', type = str, default = 'gzip', choices = ['gzip', 'lzf', 'none'], help = 'HDF5 compression filter for a new dataset, default = gzip')
+    parser.add_argument('--schema', type = str, default = 'flat', choices = ['flat', 'compact'], help = 'Storage layout: flat 16 column rows or compact frame/detection/weather tables, default = flat')
+    parser.add_argument('--motion_gate', action = 'store_true', help = 'Only run the model on frames with motion, carry the last tracks forward otherwise')
+    parser.add_argument('--change_threshold', type = float, default = 0.002, help = 'Fraction of changed pixels that triggers inference with --motion_gate, default = 0.002')
+    parser.add_argument('--min_rate', type = float, default = 1.0, help = 'Minimum inferences per second with --motion_gate, default = 1.0')
+    parser.add_argument('--events', action = 'store_true', help = 'Detect turnaround events (vehicle arrivals/departures, pushback) and append them to Raw_Time_Series_Data/turnaround_events.csv')
+    parser.add_argument('--metrics_port', type = int, default = DEFAULT_PORT, help = f'Serve Prometheus metrics on localhost:(METRICS_PORT)/metrics, 0 to disable, default = {DEFAULT_PORT}')
+    parser.add_argument('--metrics_log', type = str, default = None, help = 'Append a metrics summary every --metrics_log_interval seconds to this rolling log file')
+    parser.add_argument('--metrics_log_interval', type = float, default = 60.0, help = 'Seconds between metrics log lines, default = 60')
+    parser.add_argument('--flush_interval', type = float, default = 1.0, help = 'Write buffered rows at least every (FLUSH_INTERVAL) seconds, default = 1.0')
+    parser.add_argument('--regions', type = str, default = None, help = 'Apron regions JSON; run tiled inference limited to these regions (see tiled_inference.py)')
+    parser.add_argument('--tile_size', type = int, default = 640, help = 'Tile size in pixels with --regions, default = 640')
+    parser.add_argument('--tile_overlap', type = float, default = 0.2, help = 'Fraction of overlap between tiles with --regions, default = 0.2')
+    parser.add_argument('--queue_size', type = int, default = 256, help = 'Frames queued in memory between inference and storage, default = 256')
+    parser.add_argument('--backpressure', type = str, default = 'block', choices = POLICIES, help = 'When the storage queue is full: wait, drop the oldest frame or spill to disk, default = block')
+    parser.add_argument('--spill_dir', type = str, default = os.path.join('Raw_Time_Series_Data', 'spill'), help = 'Folder for spilled frames with --backpressure spill, default = Raw_Time_Series_Data/spill')
+    add_backend_arguments(parser)
+
+    args = parser.parse_args()
+    if args.regions and args.motion_gate:
+        parser.error('--regions cannot be combined with --motion_gate')
+    if args.motion_gate and args.schema != 'compact':
+        # Carried-forward detections must stay distinguishable from inferred ones; only the compact frames table
+        # has a flag for them
+        parser.error('--motion_gate needs --schema compact')
+    return args
+
+
+args = parse_arguments()
+
 link = 'https://62abe29de64ab.streamlock.net:4444/EPGD/pps3.stream/chunklist_w2096451211.m3u8'
 #link = 'Data/Videos/6/Gdansk_Live_Stream_6.mp4'
 
@@ -26,8 +83,8 @@ if device == "0":
     torch.cuda.set_device(0)
 
 
-# Load the trained model (last epoch or best epoch)
-model = YOLO('weights/last.pt')
+# Load the trained model (last epoch or best epoch), exported to the selected CPU runtime if requested
+model = load_model('weights/last.pt', args.backend, args.int8)
 
 
 # create a path to store time-series data if it doesn't exist already
@@ -37,83 +94,131 @@ if not os.path.exists(folder_path):
 
 
 # Prepare CSV File
-hdf5_file_path = os.path.join(folder_path, 'tracking_data.h5')
-
+hdf5_file_name = 'tracking_data_compact.h5' if args.schema == 'compact' else 'tracking_data.h5'
+hdf5_file_path = os.path.join(folder_path, hdf5_file_name)
+events_file_path = os.path.join(folder_path, 'turnaround_events.csv')
+
+# Turnaround events are detected on the fly from the same per-frame detections
+detector = TurnaroundDetector() if args.events else None
+
+# Poll the weather in the background, frames only read the latest observation from memory
+weather_provider = WeatherProvider(refresh_interval = args.weather_interval, max_age = args.weather_max_age)
+weather_provider.start()
+
+# Always-on instrumentation: per-stage timings, capture lag, per-class detections, dropped frames
+metrics = PipelineMetrics(class_names = CLASS_NAMES)
+metrics_server = serve_metrics(metrics, port = args.metrics_port) if args.metrics_port else None
+metrics_logger = None
+if args.metrics_log:
+    metrics_logger = MetricsLogger(metrics, args.metrics_log, interval = args.metrics_log_interval)
+    metrics_logger.start()
+
+
+def persist(record):
+    '''
+    Storage stage (own thread): turnaround events, then the rows of one frame into the writer
+    '''
+    timestamp_us, weather, track_id, obj_class, x_centers, y_centers, predicted = record
+    t = metrics.clock()
+
+    if detector is not None:
+        # Detector time is the frame time on the GMT+1 wall clock, in seconds
+        events = detector.update(timestamp_us / 1e6 + UTC_OFFSET_HOURS * 3600, track_id, obj_class, x_centers, y_centers)
+        for event in events:
+            print (describe(event))
+        write_events(events_file_path, events)
+        t = metrics.lap('events', t)
+
+    if args.schema == 'compact':
+        # One frame row (UTC timestamp + weather reference) and one small row per detection
+        writer.append_frame(timestamp_us, weather, track_id, obj_class, x_centers, y_centers, predicted = predicted)
+        metrics.lap('storage', t)
+        return
+
+    # Time (GMT +1) and weather columns of the frame written in place into the row buffer
+    writer.add(timestamp_us, weather, track_id, obj_class, x_centers, y_centers)
+    t = metrics.lap('build', t)
+
+    # Batches reach the file within flush_interval -- crucial to visualize the tracking plots in real-time
+    # via live_tracker.py
+    if writer.due():
+        writer.hand_over()
+    metrics.lap('storage', t)
+
+
+gate = None
 try:
     # Create or open hdf5 file
-    with h5py.File(hdf5_file_path, 'a', libver = 'latest', swmr = True) as file:
-        # Enable Single Writer Multiple Reader (SWMR) Mode
-        file.swmr_mode = True
-
-        # Check if the dataset exists, create if not
-        if 'tracking_data' not in file:
-            # Create a resizable dataset to store tracking data
-            maxshape = (None, 16)# Maximum shape is unknown for the first dimension
-            dataset = file.create_dataset('tracking_data', (0, 16), maxshape = maxshape, dtype = np.float64)
+    # Rows are buffered and written in batches of chunk_rows (or every flush_interval seconds); the remaining
+    # buffer is written when the with-block exits, including on KeyboardInterrupt
+    compression = None if args.compression == 'none' else args.compression
+    with h5py.File(hdf5_file_path, 'a', libver = 'latest') as file:
+        if args.schema == 'compact':
+            writer = CompactTrackingWriter(file, chunk_rows = args.chunk_rows, compression = compression,
+                                           flush_interval = args.flush_interval)
         else:
-            dataset = file['tracking_data']
-
-        for result in model.track(source = link, show = False, 
-                                conf = 0.7, save = False, 
-                                line_width = 4, stream = True, 
-                                persist = True, save_txt = False,
-                                save_frames = True, show_labels = True, show_boxes = False):
-            
-            # GMT +1 Time
-            current_time = datetime.utcnow() + timedelta(hours=1)
-
-            # Get Live Weather Report
-            current_temperature_2m, current_relative_humidity_2m, current_rain, current_showers, current_snowfall, current_cloud_cover = get_current_weather()
-            
-            # Get Ids, classes and bounding boxes 
-            track_id = result.boxes.id.numpy()        
-            obj_class = result.boxes.cls.numpy()     
-            rectangle_bb = result.boxes.xyxy.numpy()
-
-            # Calculate centroid
-            x_centers = (rectangle_bb[:, 0] + rectangle_bb[:, 2])/2
-            y_centers = (rectangle_bb[:, 1] + rectangle_bb[:, 3])/2
-
-            # Time Component
-            date = float(current_time.strftime('%Y%m%d'))
-            hour = float(current_time.strftime('%H'))
-            minute = float((datetime.utcnow() + timedelta(hours=1)).minute)
-            seconds = float((datetime.utcnow() + timedelta(hours=1)).second)
-            microseconds = float((datetime.utcnow() + timedelta(hours=1)).microsecond)
-
-            time_normalized = (hour + minute/60.0 + seconds/3600.0 + microseconds/(60*60*1000000))/24
-
-            # Replicate the weather data for each detected object
-            replicated_temp = np.full(len(track_id), current_temperature_2m)
-            replicated_humidity = np.full(len(track_id), current_relative_humidity_2m)
-            replicated_rain = np.full(len(track_id), current_rain)
-            replicated_showers = np.full(len(track_id), current_showers)
-            replicated_snowfall = np.full(len(track_id), current_snowfall)
-            replicated_cloud_cover = np.full(len(track_id), current_cloud_cover)
-
-            data = np.column_stack((np.full(len(track_id), date),
-                                    np.full(len(track_id), hour),
-                                    np.full(len(track_id), minute),
-                                    np.full(len(track_id), seconds),
-                                    np.full(len(track_id), microseconds),
-                                    np.full(len(track_id), time_normalized),
-                                    track_id, obj_class, x_centers, y_centers,
-                                    replicated_temp, replicated_humidity, replicated_rain, replicated_showers, replicated_snowfall, replicated_cloud_cover))
-            
-            # Append data to dataset
-            new_size = dataset.shape[0] + len(data)
-            dataset.resize(new_size, axis = 0)
-            dataset[-len(data):] = data
-
-            # Flush data to disk -- crucial to visualize the tracking plots in real-time via live_tracker.py
-            file.flush()
+            rows = BufferedDatasetWriter(file, 'tracking_data', row_shape = (16,), dtype = np.float64,
+                                         chunk_rows = args.chunk_rows, compression = compression,
+                                         flush_interval = args.flush_interval)
+            # Frames accumulate in the builder and reach the dataset writer in batches
+            writer = FrameRecordBuilder(rows, flush_interval = args.flush_interval)
+        with writer:
+            # Enable Single Writer Multiple Reader (SWMR) Mode -- after the dataset has been created
+            file.swmr_mode = True
+
+            # From here on only the storage thread touches the writer and the file; it drains the queue when
+            # the with-block exits (also on KeyboardInterrupt) before the writer writes its last rows
+            queue = BoundedQueue(args.queue_size, args.backpressure, args.spill_dir)
+            metrics.watch_queue('storage', queue)
+            storage = StorageStage(persist, queue, idle = writer.flush, idle_interval = args.flush_interval)
+
+            if args.motion_gate:
+                gate = MotionGate(change_threshold = args.change_threshold, min_rate = args.min_rate)
+                results = gated_track(model, link, gate, metrics = metrics, conf = 0.7)
+            else:
+                # Decoding on its own thread (newest frame wins), predict and track timed separately
+                tiler = None
+                if args.regions:
+                    tiler = TiledPredictor(model, load_regions(args.regions), tile_size = args.tile_size,
+                                           overlap = args.tile_overlap, conf = 0.7, device = device)
+                tracker = MultiStreamTracker(model, {'PPS3': link}, tracker_config = 'botsort.yaml', conf = 0.7,
+                                             device = device, metrics = metrics, tiler = tiler)
+                results = ((stream_result.result, False, stream_result.timestamp_us) for stream_result in tracker)
+
+            with storage:
+                # predicted: the result was carried forward from the last inferred frame by the motion gate
+                # timestamp_us: capture time of the frame, unix microseconds UTC (one per frame)
+                for result, predicted, timestamp_us in results:
+
+                    t = metrics.clock()
+
+                    # Get Live Weather Report (NaN if missing or older than weather_max_age)
+                    weather = weather_provider.current()
+                    t = metrics.lap('weather', t)
+
+                    # Ids, classes and centroids (empty arrays for frames without tracks)
+                    track_id, obj_class, x_centers, y_centers = frame_detections(result)
+                    metrics.frame(obj_class, predicted = predicted)
+
+                    # Hand the frame to the storage thread
+                    storage.put((timestamp_us, weather, track_id, obj_class, x_centers, y_centers, predicted))
+                    metrics.lap('enqueue', t)
 
 except KeyboardInterrupt:
     print ('Interrupted by User, closing file and cleaning up. PLease wait...')
+    if gate is not None:
+        print (f'Motion gate: {gate.summary()}')
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
     print ('You might get this error: Segmentation fault (core dumped)')
 
+finally:
+    weather_provider.stop(timeout = 5)
+    if metrics_logger is not None:
+        metrics_logger.stop()
+    if metrics_server is not None:
+        metrics_server.stop()
+
 
 
 '''
@@ -132,6 +237,9 @@ with h5py.File(hdf5_file_path, 'r') as file:
     data = dataset[:]
     print(data)
 
+    # For larger files export once to columnar partitions and query only the rows/columns needed:
+    # python3 columnar_export.py --source Raw_Time_Series_Data/tracking_data.h5   (see columnar_export.py)
+
     # Optionally, convert to a pandas DataFrame for better visualization
     # import pandas as pd
     # df = pd.DataFrame(data, columns=['Date', 'Hour', 'Minute', 'Seconds', 'Track_ID', 'Object Class', 'X', 'Y'])
@@ -21,28 +21,124 @@ Output:
 
 Usage: 
 - Make a folder 'Annotations' store images with extension .rf.jpg. Call this module to generate contour plots. Make sure no image file has same name.
+
+Batch mode:
+- `annotate_directory` (or the command line) loads the model once, runs batched predictions over every image in a folder,
+  converts masks to polygons in a process pool (optionally simplified to at most --max_points points) and reports images/sec.
+  e.g. python3 get_contours.py --source Annotations --weights weights/1024.pt --batch_size 16 --workers 4 --max_points 200
+- With --cache DIR, predictions are kept in a content-addressed inference cache (inference_cache.py); images the same
+  model has already seen skip the model on the next run.
 '''
 
 import os
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import cv2
 from ultralytics import YOLO
+from inference_backend import add_backend_arguments, load_model
+from inference_cache import InferenceCache, CachedPredictor, model_fingerprint
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# A YOLO-seg polygon needs at least 3 points
+MIN_POLYGON_POINTS = 3
+
+
+def label_filename(image_path, annotations_dir = 'Annotations'):
+    '''
+    'Frame_1.jpg.rf.jpg' --> 'Annotations/Frame_1.jpg.rf.txt', any other image 'x.jpg' --> 'Annotations/x.txt'
+    '''
+    name = os.path.split(image_path)[1]
+    txt_rename = name[:-7] + '.rf.txt' if name.endswith('.rf.jpg') else os.path.splitext(name)[0] + '.txt'
+    return os.path.join(annotations_dir, txt_rename)
+
+
+def mask_to_polygon(mask, max_points = None):
+    '''
+    Largest contour of a uint8 mask as an (n, 2) float32 array normalised by the mask size, or None if the mask is empty.
+    With max_points (at least 3), the contour is simplified (Douglas-Peucker) until it has at most max_points points.
+    Contours that end up with fewer than 3 points are not valid labels and return None as well.
+    '''
+    if max_points is not None and max_points < MIN_POLYGON_POINTS:
+        raise ValueError(f'max_points must be at least {MIN_POLYGON_POINTS}, got {max_points}')
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    if len(contours) == 0:
+        return None
+
+    largest_contour = contours[0] if len(contours) == 1 else max(contours, key = cv2.contourArea)
+
+    if max_points is not None and len(largest_contour) > max_points:
+        epsilon = 0.001 * cv2.arcLength(largest_contour, True)
+        simplified = cv2.approxPolyDP(largest_contour, epsilon, True)
+        while len(simplified) > max_points:
+            epsilon *= 1.5
+            coarser = cv2.approxPolyDP(largest_contour, epsilon, True)
+            if len(coarser) < MIN_POLYGON_POINTS:
+                # One step too far (e.g. a box collapsing to a line): keep max_points evenly spaced points instead
+                simplified = simplified[np.linspace(0, len(simplified) - 1, max_points).astype(int)]
+                break
+            simplified = coarser
+        largest_contour = simplified
+
+    if len(largest_contour) < MIN_POLYGON_POINTS:
+        return None
+
+    # Normalize largest_contours
+    image_height, image_width = mask.shape
+    polygon = largest_contour.reshape(-1, 2).astype(np.float32)
+    polygon /= np.array([image_width, image_height], dtype = np.float32)
+    return polygon
+
+
+def format_label(class_id, polygon):
+    '''
+    One label line: class_id followed by the normalized x y coordinates, formatted in one vectorised call
+    '''
+    return f'{class_id} ' + ' '.join(np.char.mod('%.6f', polygon.ravel()))
+
+
+def masks_to_label_text(classes, masks, max_points = None):
+    '''
+    classes --> (n,) class IDs, masks --> (n, h, w) uint8 masks. Returns the content of the label file.
+    Runs in the worker processes of annotate_directory.
+    '''
+    lines = []
+    for class_id, mask in zip(classes, masks):
+        polygon = mask_to_polygon(mask, max_points)
+        if polygon is not None:
+            lines.append(format_label(int(class_id), polygon))
+    return ''.join(line + '\n' for line in lines)
+
 
-def annotate_image(image_path, model_weight):
+def result_to_arrays(result):
+    '''
+    Class IDs and uint8 masks of a prediction as NumPy arrays (cheap to send to a worker process)
+    '''
+    classes = result.boxes.cls.detach().cpu().numpy().astype(np.int64)
+    if result.masks is None or len(classes) == 0:
+        return classes[:0], np.zeros((0, 1, 1), dtype = np.uint8)
+    masks = (result.masks.data.detach().cpu().numpy() > 0.5).astype(np.uint8) * 255
+    return classes, masks
+
+
+def annotate_image(image_path, model_weight, max_points = None):
     '''
     image_path --> e.g. 'Data/Frame_1.jpg.rf.jpg'
-    model_weight --> e.g. 'weights/xxx.pt' 
+    model_weight --> e.g. 'weights/xxx.pt' or an already loaded YOLO model
     '''
     annotations_dir = 'Annotations'
 
     #if not os.path.exists(annotations_dir):
     #    os.makedirs(annotations_dir)
 
-    txt_rename = os.path.split(image_path)[1][:-7] + '.rf.txt'
-    txt_filename = os.path.join(annotations_dir, txt_rename)
+    txt_filename = label_filename(image_path, annotations_dir)
 
     # Load Model
-    model = YOLO(model_weight)
+    model = YOLO(model_weight) if isinstance(model_weight, str) else model_weight
 
     for result in model.predict(source = image_path, show = False,
                                 conf = 0.8, save = False,
@@ -50,49 +146,95 @@ def annotate_image(image_path, model_weight):
                                 show_labels = False, show_boxes = False):
         pass
 
-    
-    # Get all class IDs
-    classes = (result.boxes.cls).detach().cpu()
-
+    classes, masks = result_to_arrays(result)
 
     with open(txt_filename, 'w') as file:
-        for i in range(len(classes)):
-            class_id = int(classes[i].item())
-            mask = result.masks[i].data.detach().cpu().squeeze()
-
-            mask = 255 * mask.numpy()
-            mask = mask.astype(np.uint8)
-
-            contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-            image_height, image_width = mask.shape
-
-            if len(contours) > 1:
-                max_area = 0 
-                max_index = -1
+        file.write(masks_to_label_text(classes, masks, max_points))
 
-                for j, contr in enumerate(contours):
-                    area = cv2.contourArea(contr)
 
-                    if area > max_area:
-                        max_area = area
-                        max_index = j
-
-                largest_contour = contours[max_index] if max_index != -1 else None
-            elif len(contours) == 1:
-                largest_contour = contours[0]
-            else:
-                largest_contour = None
-
-            if largest_contour is not None and len(contours) > 0:
-                
-                # Normalize largest_contours
-                largest_contour = largest_contour.astype(np.float32)
-                largest_contour[:,0,0] = largest_contour[:,0,0] / image_width
-                largest_contour[:,0,1] = largest_contour[:,0,1] / image_height
-
-                # Prepare a line to write to the file: class_id followed by normalized coordinates
-                line = f'{class_id} ' + ' '.join([f'{x[0][0]} {x[0][1]}' for x in largest_contour])
-
-                # Write
-                file.write(line + '\n')
\ No newline at end of file
+def annotate_directory(image_dir, model_weight, annotations_dir = 'Annotations', batch_size = 16, workers = None,
+                       max_points = None, conf = 0.8, cache = None, model_id = None):
+    '''
+    Annotate every image in image_dir with a single model load and batched predictions.
+    Mask to polygon conversion runs in a pool of `workers` processes. Returns images/sec.
+    cache, model_id --> optional InferenceCache and model_fingerprint() of the model; cached images skip the model
+    '''
+    image_paths = sorted(path for path in glob.glob(os.path.join(image_dir, '*')) if path.lower().endswith(IMAGE_EXTENSIONS))
+    os.makedirs(annotations_dir, exist_ok = True)
+
+    model = YOLO(model_weight) if isinstance(model_weight, str) else model_weight
+    if cache is not None:
+        predictor = CachedPredictor(model, cache, model_id, conf = conf, save = False)
+        predict = predictor.predict
+    else:
+        predict = lambda batch: model.predict(source = batch, conf = conf, save = False, verbose = False, stream = False)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        pending = []
+        for i in range(0, len(image_paths), batch_size):
+            batch = image_paths[i:i + batch_size]
+            results = predict(batch)
+
+            # Contours of this batch are extracted in the pool while the model runs the next batch
+            for image_path, result in zip(batch, results):
+                classes, masks = result_to_arrays(result)
+                pending.append((label_filename(image_path, annotations_dir),
+                                pool.submit(masks_to_label_text, classes, masks, max_points)))
+
+            # Write finished label files as we go to bound memory
+            while pending and pending[0][1].done():
+                txt_filename, future = pending.pop(0)
+                with open(txt_filename, 'w') as file:
+                    file.write(future.result())
+
+        for txt_filename, future in pending:
+            with open(txt_filename, 'w') as file:
+                file.write(future.result())
+
+    elapsed = time.perf_counter() - start
+    images_per_second = len(image_paths) / elapsed if elapsed > 0 else 0.0
+    print (f'Annotated {len(image_paths)} images in {elapsed:.1f} s --> {images_per_second:.2f} images/sec')
+    if cache is not None:
+        print (f'Inference cache: {cache.hits} hits, {cache.misses} misses')
+    return images_per_second
+
+
+def polygon_points(value):
+    '''argparse type of --max_points'''
+    points = int(value)
+    if points < MIN_POLYGON_POINTS:
+        raise argparse.ArgumentTypeError(f'must be at least {MIN_POLYGON_POINTS}, got {points}')
+    return points
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Annotate Images With Contours')
+
+    # Arguments
+    parser.add_argument('--source', type = str, default = 'Annotations', help = 'Folder of images to annotate, default = Annotations')
+    parser.add_argument('--weights', type = str, default = 'weights/1024.pt', help = 'Model weights, default = weights/1024.pt')
+    parser.add_argument('--output', type = str, default = 'Annotations', help = 'Folder for the label files, default = Annotations')
+    parser.add_argument('--batch_size', type = int, default = 16, help = 'Images per model call, default = 16')
+    parser.add_argument('--workers', type = int, default = None, help = 'Processes for contour extraction, default = number of CPUs')
+    parser.add_argument('--max_points', type = polygon_points, default = None, help = 'Simplify polygons to at most MAX_POINTS points (at least 3)')
+    parser.add_argument('--conf', type = float, default = 0.8, help = 'Confidence threshold, default = 0.8')
+    parser.add_argument('--cache', type = str, default = None, help = 'Inference cache folder; images seen by the same model skip inference')
+    parser.add_argument('--cache_gb', type = float, default = 2.0, help = 'Size of the inference cache before old entries are evicted, default = 2.0')
+    add_backend_arguments(parser)
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    model = load_model(args.weights, args.backend, args.int8)
+    cache = InferenceCache(args.cache, max_bytes = args.cache_gb * 1e9) if args.cache else None
+    model_id = model_fingerprint(args.weights, backend = args.backend, int8 = args.int8, conf = args.conf)
+    annotate_directory(args.source, model, annotations_dir = args.output, batch_size = args.batch_size,
+                       workers = args.workers, max_points = args.max_points, conf = args.conf,
+                       cache = cache, model_id = model_id)
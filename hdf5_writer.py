@@ -0,0 +1,114 @@
+import time
+import numpy as np
+
+'''
+Buffered, batched writer for resizable HDF5 datasets.
+
+Rows are collected in a preallocated NumPy buffer and written to the dataset in large batches, instead of resizing
+and flushing the file for every frame. A batch is written when
+    - FLUSH_ROWS rows are buffered (defaults to one chunk, so full batches are chunk aligned), or
+    - FLUSH_INTERVAL seconds have passed since the last write and a new row arrives,
+so SWMR readers (e.g. Extras/live_tracker.py) see new data within roughly FLUSH_INTERVAL seconds.
+New datasets are created chunked and compressed. Closing the writer (or leaving its `with` block, also on
+KeyboardInterrupt) writes whatever is still buffered.
+
+Usage:
+    with h5py.File(path, 'a', libver = 'latest') as file:
+        with BufferedDatasetWriter(file, 'tracking_data', row_shape = (16,)) as writer:
+            file.swmr_mode = True
+            writer.append(rows)
+'''
+
+
+class BufferedDatasetWriter:
+    '''
+    file --> open h5py.File (or group)
+    name --> dataset name, created if it doesn't exist
+    row_shape --> shape of a single row, e.g. (16,) for the flat float64 layout or () for a structured dtype
+    dtype --> NumPy dtype of the dataset (plain or structured)
+    chunk_rows --> rows per HDF5 chunk for newly created datasets
+    compression, compression_opts, shuffle --> HDF5 filter settings for newly created datasets ('gzip', 'lzf' or None)
+    buffer_rows --> capacity of the in-memory buffer (at least flush_rows)
+    flush_rows --> write once this many rows are buffered, default = chunk_rows
+    flush_interval --> write buffered rows if this many seconds passed since the last write (None to disable)
+    '''
+    def __init__(self, file, name, row_shape = (), dtype = np.float64, chunk_rows = 2048,
+                 compression = 'gzip', compression_opts = 4, shuffle = True,
+                 buffer_rows = None, flush_rows = None, flush_interval = 1.0):
+        self.file = file
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.flush_rows = flush_rows or chunk_rows
+        self.flush_interval = flush_interval
+
+        if name not in file:
+            if compression != 'gzip':
+                compression_opts = None
+            file.create_dataset(name, shape = (0,) + self.row_shape, maxshape = (None,) + self.row_shape,
+                                chunks = (chunk_rows,) + self.row_shape, dtype = self.dtype,
+                                compression = compression, compression_opts = compression_opts,
+                                shuffle = shuffle and compression is not None)
+        self.dataset = file[name]
+
+        if self.dataset.shape[1:] != self.row_shape or self.dataset.dtype != self.dtype:
+            raise ValueError(f'Dataset {name} has shape {self.dataset.shape} and dtype {self.dataset.dtype}, '
+                             f'expected rows of shape {self.row_shape} and dtype {self.dtype}')
+
+        capacity = max(buffer_rows or 0, self.flush_rows)
+        self._buffer = np.empty((capacity,) + self.row_shape, dtype = self.dtype)
+        self._count = 0
+        self._last_write = time.monotonic()
+
+        self.rows_written = 0
+        self.batches_written = 0
+
+    def __len__(self):
+        '''Rows currently buffered and not yet in the file'''
+        return self._count
+
+    def append(self, rows):
+        '''
+        Buffer rows (array of shape (n,) + row_shape) and write a batch if a threshold is reached
+        '''
+        rows = np.asarray(rows)
+        n = len(rows)
+        start = 0
+
+        while start < n:
+            take = min(n - start, len(self._buffer) - self._count)
+            self._buffer[self._count:self._count + take] = rows[start:start + take]
+            self._count += take
+            start += take
+
+            if self._count == len(self._buffer):
+                self.flush()
+
+        if self._count >= self.flush_rows:
+            self.flush()
+        elif self.flush_interval is not None and self._count and time.monotonic() - self._last_write >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write all buffered rows with a single resize and flush the file so SWMR readers see them
+        '''
+        if self._count:
+            old_size = self.dataset.shape[0]
+            self.dataset.resize(old_size + self._count, axis = 0)
+            self.dataset[old_size:] = self._buffer[:self._count]
+            self.file.flush()
+
+            self.rows_written += self._count
+            self.batches_written += 1
+            self._count = 0
+
+        self._last_write = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.utils import yaml_load, yaml_save
+
+'''
+CPU inference backends for the segmentation model.
+
+The .pt weights run in eager-mode PyTorch, which is slow on the CPU-only processing nodes. load_model() exports the
+model once to ONNX (onnxruntime) or OpenVINO, optionally INT8-quantised with calibration images from the dataset's
+train/images, and loads the exported artifact through ultralytics, so predict/track/val work the same way.
+Artifacts are written next to the weights and re-exported only when the weights are newer:
+
+    weights/last.onnx                    weights/last_int8.onnx              (onnxruntime static quantisation)
+    weights/last_openvino_model/         weights/last_int8_openvino_model/   (OpenVINO + NNCF)
+
+The scripts take --backend {pytorch,onnx,openvino} and --int8, e.g.
+    python3 generate_time_series.py --backend openvino --int8
+
+Accuracy (mask mAP on valid/) and latency of every backend against the .pt model:
+    python3 inference_backend.py --weights weights/last.pt --compare
+'''
+
+BACKENDS = ['pytorch', 'onnx', 'openvino']
+
+DATASET_DIR = 'Gdansk_Airport_Data_Annotation.v4i.yolov8'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def artifact_path(weights, backend, int8 = False):
+    stem = os.path.splitext(weights)[0] + ('_int8' if int8 else '')
+    if backend == 'onnx':
+        return stem + '.onnx'
+    if backend == 'openvino':
+        return stem + '_openvino_model'
+    return weights
+
+
+def image_paths(folder, limit = None):
+    paths = sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.lower().endswith(IMAGE_EXTENSIONS))
+    return paths if limit is None else paths[:limit]
+
+
+def calibration_data_yaml(dataset_dir, folder):
+    '''
+    Data yaml whose val split points at the calibration images (ultralytics calibrates OpenVINO INT8 on 'val')
+    '''
+    names = yaml_load(os.path.join(dataset_dir, 'data.yaml'))['names']
+    folder = os.path.abspath(folder)
+    path = os.path.join(tempfile.mkdtemp(prefix = 'calibration_'), 'data.yaml')
+    yaml_save(path, {'train': folder, 'val': folder, 'nc': len(names), 'names': names})
+    return path
+
+
+def letterbox(image, size):
+    '''
+    Resize keeping the aspect ratio and pad to size x size (gray 114), as ultralytics does before inference
+    '''
+    height, width = image.shape[:2]
+    scale = min(size / height, size / width)
+    resized = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation = cv2.INTER_LINEAR)
+    top = (size - resized.shape[0]) // 2
+    left = (size - resized.shape[1]) // 2
+    padded = np.full((size, size, 3), 114, dtype = np.uint8)
+    padded[top:top + resized.shape[0], left:left + resized.shape[1]] = resized
+    return padded
+
+
+class CalibrationReader:
+    '''
+    onnxruntime CalibrationDataReader over a list of images, preprocessed like ultralytics (RGB, 0..1, NCHW)
+    '''
+    def __init__(self, input_name, paths, imgsz):
+        self.input_name = input_name
+        self.paths = iter(paths)
+        self.imgsz = imgsz
+
+    def get_next(self):
+        for path in self.paths:
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            blob = letterbox(image, self.imgsz)[:, :, ::-1].transpose(2, 0, 1)[None].astype(np.float32) / 255
+            return {self.input_name: np.ascontiguousarray(blob)}
+        return None
+
+
+def quantize_onnx(fp32_path, int8_path, calibration_images, imgsz):
+    '''
+    Static INT8 quantisation (QDQ, per-channel weights) of an exported ONNX model
+    '''
+    import onnxruntime
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+
+    session = onnxruntime.InferenceSession(fp32_path, providers = ['CPUExecutionProvider'])
+    input_name = session.get_inputs()[0].name
+    reader = CalibrationReader(input_name, calibration_images, imgsz)
+    quantize_static(fp32_path, int8_path, reader, quant_format = QuantFormat.QDQ, per_channel = True,
+                    weight_type = QuantType.QInt8, activation_type = QuantType.QUInt8)
+    return int8_path
+
+
+def export_model(weights, backend, int8 = False, dataset_dir = DATASET_DIR, num_calibration = 300, force = False):
+    '''
+    Export weights (.pt) to the backend, returns the artifact path. Reuses an artifact newer than the weights.
+    '''
+    if backend == 'pytorch':
+        return weights
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend}, expected one of {BACKENDS}')
+
+    target = artifact_path(weights, backend, int8)
+    if not force and os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(weights):
+        return target
+
+    model = YOLO(weights)
+    imgsz = model.model.args['imgsz']
+    calibration_folder = os.path.join(dataset_dir, 'train', 'images')
+    print (f'Exporting {weights} to {backend}{" INT8" if int8 else ""} ({imgsz}px) --> {target}')
+
+    if backend == 'onnx':
+        # Dynamic batch, so batched predictions (get_contours.py, multi_stream_tracker.py) still work
+        exported = model.export(format = 'onnx', dynamic = True, simplify = True)
+        if int8:
+            fp32 = exported
+            exported = quantize_onnx(fp32, target, image_paths(calibration_folder, num_calibration), imgsz)
+    else:
+        data = calibration_data_yaml(dataset_dir, calibration_folder) if int8 else None
+        exported = model.export(format = 'openvino', dynamic = True, int8 = int8, data = data)
+        if data is not None:
+            shutil.rmtree(os.path.dirname(data), ignore_errors = True)
+
+    exported = str(exported)
+    if os.path.abspath(exported) != os.path.abspath(target):
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        shutil.move(exported, target)
+    return target
+
+
+def load_model(weights, backend = 'pytorch', int8 = False, **export_kwargs):
+    '''
+    YOLO model for the backend, exporting the weights first if needed
+    '''
+    if backend == 'pytorch':
+        if int8:
+            print ('--int8 needs --backend onnx or openvino, running the PyTorch model')
+        return YOLO(weights)
+    return YOLO(export_model(weights, backend, int8, **export_kwargs), task = 'segment')
+
+
+def add_backend_arguments(parser):
+    '''
+    --backend / --int8 options shared by the run scripts
+    '''
+    parser.add_argument('--backend', type = str, default = 'pytorch', choices = BACKENDS, help = 'Inference runtime; onnx/openvino are exported once next to the weights, default = pytorch')
+    parser.add_argument('--int8', action = 'store_true', help = 'INT8 quantised model (calibrated on train/images), with --backend onnx or openvino')
+
+
+def measure_latency(model, paths, warmup = 3):
+    '''
+    Per image predict latency (ms) over paths: mean / p50 / p95
+    '''
+    images = [cv2.imread(path) for path in paths]
+    for image in images[:warmup]:
+        model.predict(source = image, device = 'cpu', verbose = False)
+
+    durations = []
+    for image in images:
+        start = time.perf_counter()
+        model.predict(source = image, device = 'cpu', verbose = False)
+        durations.append(time.perf_counter() - start)
+    durations = np.array(durations) * 1000
+    p50, p95 = np.percentile(durations, [50, 95])
+    return {'mean_ms': float(durations.mean()), 'p50_ms': float(p50), 'p95_ms': float(p95)}
+
+
+def compare(weights, dataset_dir = DATASET_DIR, configurations = None, num_latency = 50):
+    '''
+    Mask / box mAP on valid/ and CPU latency of every backend, relative to the PyTorch model
+    '''
+    configurations = configurations or [('pytorch', False), ('onnx', False), ('onnx', True),
+                                        ('openvino', False), ('openvino', True)]
+    data = os.path.join(dataset_dir, 'data.yaml')
+    latency_images = image_paths(os.path.join(dataset_dir, 'valid', 'images'), num_latency)
+
+    report = []
+    for backend, int8 in configurations:
+        name = backend + (' INT8' if int8 else '')
+        try:
+            model = load_model(weights, backend, int8, dataset_dir = dataset_dir)
+            metrics = model.val(data = data, split = 'val', batch = 1, device = 'cpu', plots = False, verbose = False)
+            row = {'backend': name, 'mask_map50_95': float(metrics.seg.map), 'mask_map50': float(metrics.seg.map50),
+                   'box_map50_95': float(metrics.box.map)}
+            row.update(measure_latency(model, latency_images))
+        except Exception as error:
+            # e.g. onnxruntime / openvino not installed
+            print (f'{name}: skipped ({error})')
+            continue
+        report.append(row)
+
+    base = report[0] if report and report[0]['backend'] == 'pytorch' else None
+    print (f"{'backend':<14} {'mask mAP50-95':>14} {'mask mAP50':>11} {'box mAP50-95':>13} {'p50 ms':>8} {'p95 ms':>8} {'speedup':>8}")
+    for row in report:
+        speedup = base['p50_ms'] / row['p50_ms'] if base is not None and row['p50_ms'] > 0 else float('nan')
+        delta = '' if base is None else f" ({row['mask_map50_95'] - base['mask_map50_95']:+.3f})"
+        print (f"{row['backend']:<14} {row['mask_map50_95']:>6.3f}{delta:<8} {row['mask_map50']:>11.3f} "
+               f"{row['box_map50_95']:>13.3f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {speedup:>7.2f}x")
+    return report
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Inference Backend')
+
+    # Arguments
+    parser.add_argument('--weights', type = str, default = 'weights/last.pt', help = 'Model weights, default = weights/last.pt')
+    add_backend_arguments(parser)
+    parser.add_argument('--dataset', type = str, default = DATASET_DIR, help = f'Dataset folder (data.yaml, train/, valid/), default = {DATASET_DIR}')
+    parser.add_argument('--num_calibration', type = int, default = 300, help = 'Calibration images for INT8, default = 300')
+    parser.add_argument('--force', action = 'store_true', help = 'Re-export even if the artifact is up to date')
+    parser.add_argument('--compare', action = 'store_true', help = 'mAP on valid/ and latency of every backend against the .pt model')
+    parser.add_argument('--output', type = str, default = None, help = 'Save the --compare report as JSON')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.compare:
+        report = compare(args.weights, dataset_dir = args.dataset)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(report, file, indent = 2)
+    else:
+        path = export_model(args.weights, args.backend, args.int8, dataset_dir = args.dataset,
+                            num_calibration = args.num_calibration, force = args.force)
+        print (f'Model ready: {path}')
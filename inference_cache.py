@@ -0,0 +1,431 @@
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+from collections import namedtuple
+
+import numpy as np
+
+'''
+Content-addressed cache of segmentation results, so frames the model has already seen are never run through it again.
+
+Entries are keyed by (image hash, model hash):
+    - image hash: BLAKE2b of the file bytes (image_key_file) or of the decoded pixels (image_key_array, video frames)
+    - model hash: BLAKE2b of the weights file plus everything that changes the output (backend, int8, conf, imgsz)
+and hold boxes (float32 xyxy), confidences, classes and the masks at model resolution, run-length encoded
+(an object mask takes a few hundred bytes to a few KB instead of the full bitmap).
+
+Storage is one append-only data file, read through a memory map, and a SQLite index (WAL, like frame_index.py) with
+the offset, size and last access time of every entry, so several processes can share the cache. Once the entries
+exceed max_bytes the least recently used ones are dropped; the data file is compacted when less than half of it is
+still referenced. The file of the previous generation is only deleted by the next compaction, so a reader that looked
+up its offsets just before a compaction can still open it.
+
+    cache = InferenceCache('.inference_cache', max_bytes = 2e9)
+    predictor = CachedPredictor(model, cache, model_fingerprint('weights/1024.pt', conf = 0.8), conf = 0.8)
+    results = predictor.predict(['Annotations/Frame_1.jpg', ...])     # ultralytics Results, hits skip the model
+
+get_contours.py, annotation_qa.py and backfill_time_series.py take --cache DIR.
+    python3 inference_cache.py --cache .inference_cache                # size and entries
+'''
+
+INDEX_FILENAME = 'index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    image TEXT NOT NULL,
+    model TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    PRIMARY KEY (image, model)
+);
+CREATE INDEX IF NOT EXISTS entries_by_access ON entries (last_access);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', 0), ('live_bytes', 0);
+'''
+
+# n, mask height, mask width, image height, image width, total runs
+HEADER = 6
+
+Detections = namedtuple('Detections', ['boxes', 'conf', 'cls', 'masks', 'orig_shape'])
+
+
+def _hash_file(path, digest_size = 16):
+    digest = hashlib.blake2b(digest_size = digest_size)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest
+
+
+def image_key_file(path):
+    '''Hash of an image file's bytes (no decoding)'''
+    return _hash_file(path).hexdigest()
+
+
+def image_key_array(image):
+    '''Hash of decoded pixels, e.g. a video frame'''
+    image = np.ascontiguousarray(image)
+    digest = hashlib.blake2b(digest_size = 16)
+    digest.update(str(image.shape).encode())
+    digest.update(image.data)
+    return digest.hexdigest()
+
+
+_weights_hashes = {}
+
+
+def model_fingerprint(weights, **params):
+    '''
+    Hash of the weights file and the prediction parameters that change the result (backend, int8, conf, imgsz ...)
+    '''
+    stat = os.stat(weights)
+    cached = _weights_hashes.get(weights)
+    if cached is None or cached[0] != (stat.st_mtime, stat.st_size):
+        cached = _weights_hashes[weights] = ((stat.st_mtime, stat.st_size), _hash_file(weights).hexdigest())
+
+    digest = hashlib.blake2b(cached[1].encode(), digest_size = 16)
+    digest.update(repr(sorted(params.items())).encode())
+    return digest.hexdigest()
+
+
+def rle_encode(mask):
+    '''
+    Binary mask --> uint32 run lengths, alternating 0 and 1 runs starting with 0 (possibly an empty first run)
+    '''
+    flat = np.asarray(mask, dtype = bool).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [len(flat)]))
+    runs = np.diff(bounds)
+    if len(flat) and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype(np.uint32)
+
+
+def rle_decode(runs, shape):
+    values = np.zeros(len(runs), dtype = np.uint8)
+    values[1::2] = 1
+    return np.repeat(values, runs).reshape(shape)
+
+
+def encode_entry(boxes, conf, cls, masks, orig_shape):
+    '''
+    Detections --> bytes: int32 header, float32 boxes / conf / cls, uint32 runs per mask, uint32 runs
+    masks --> (n, h, w) binary masks or None
+    '''
+    n = len(boxes)
+    runs = [rle_encode(mask) for mask in masks] if masks is not None else []
+    mask_shape = masks.shape[1:] if masks is not None and n else (0, 0)
+    # One run count per detection, also without masks, so decode_entry can always read n counts
+    counts = np.array([len(r) for r in runs], dtype = np.uint32) if masks is not None else np.zeros(n, dtype = np.uint32)
+    header = np.array([n, mask_shape[0], mask_shape[1], orig_shape[0], orig_shape[1], counts.sum()], dtype = np.int32)
+    parts = [header, np.asarray(boxes, dtype = np.float32).reshape(n, 4), np.asarray(conf, dtype = np.float32),
+             np.asarray(cls, dtype = np.float32), counts] + runs
+    return b''.join(np.ascontiguousarray(part).tobytes() for part in parts)
+
+
+def decode_entry(buffer):
+    header = np.frombuffer(buffer, dtype = np.int32, count = HEADER)
+    n, mask_h, mask_w, orig_h, orig_w, total_runs = header.tolist()
+    offset = HEADER * 4
+    values = np.frombuffer(buffer, dtype = np.float32, count = 6 * n, offset = offset)
+    boxes, conf, cls = values[:4 * n].reshape(n, 4), values[4 * n:5 * n], values[5 * n:]
+    offset += 6 * n * 4
+    counts = np.frombuffer(buffer, dtype = np.uint32, count = n, offset = offset)
+    offset += n * 4
+    runs = np.frombuffer(buffer, dtype = np.uint32, count = total_runs, offset = offset)
+
+    masks = None
+    if mask_h and mask_w:
+        masks = np.empty((n, mask_h, mask_w), dtype = np.uint8)
+        starts = np.concatenate(([0], np.cumsum(counts, dtype = np.int64)))
+        for i in range(n):
+            masks[i] = rle_decode(runs[starts[i]:starts[i + 1]], (mask_h, mask_w))
+    return Detections(boxes, conf, cls, masks, (orig_h, orig_w))
+
+
+class InferenceCache:
+    '''
+    folder --> cache folder (index.sqlite + data.<generation>.bin)
+    max_bytes --> size of all entries above which the least recently used are evicted
+    '''
+    def __init__(self, folder = '.inference_cache', max_bytes = 2_000_000_000, timeout = 30.0):
+        self.folder = folder
+        self.max_bytes = int(max_bytes)
+        os.makedirs(folder, exist_ok = True)
+
+        self.connection = sqlite3.connect(os.path.join(folder, INDEX_FILENAME), timeout = timeout, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode = WAL')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+
+        self._generation = None
+        self._map = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._map = None
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _data_path(self, generation):
+        return os.path.join(self.folder, f'data.{generation}.bin')
+
+    def _transaction(self, statements, mode = 'IMMEDIATE'):
+        '''
+        Run statements(cursor) inside a transaction (IMMEDIATE takes the write lock up front)
+        '''
+        cursor = self.connection.cursor()
+        cursor.execute(f'BEGIN {mode}')
+        try:
+            result = statements(cursor)
+            cursor.execute('COMMIT')
+            return result
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+
+    def _meta(self, cursor, key):
+        return cursor.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+
+    def _buffer(self, generation, end):
+        '''Memory map of the data file, re-opened after a compaction or when the file grew past the map'''
+        if self._generation != generation or self._map is None or len(self._map) < end:
+            path = self._data_path(generation)
+            self._map = np.memmap(path, dtype = np.uint8, mode = 'r') if os.path.getsize(path) else None
+            self._generation = generation
+        return self._map
+
+    def get_many(self, images, model):
+        '''
+        [image hash] --> [Detections or None]; hits are marked as recently used
+        '''
+        def lookup(cursor):
+            generation = self._meta(cursor, 'generation')
+            rows = {}
+            for start in range(0, len(images), 500):
+                keys = images[start:start + 500]
+                placeholders = ','.join('?' * len(keys))
+                for image, offset, length in cursor.execute(
+                        f'SELECT image, offset, length FROM entries WHERE model = ? AND image IN ({placeholders})',
+                        [model] + list(keys)):
+                    rows[image] = (offset, length)
+            # Copy out while the snapshot (and its generation) is valid
+            entries = {}
+            for image, (offset, length) in rows.items():
+                data = self._buffer(generation, offset + length)
+                entries[image] = decode_entry(bytes(data[offset:offset + length]))
+            return entries
+
+        entries = {}
+        for attempt in range(3):
+            try:
+                entries = self._transaction(lookup, mode = 'DEFERRED') if images else {}
+                break
+            except FileNotFoundError:
+                # Two compactions ran between reading the generation and opening its file: look up again
+                if attempt == 2:
+                    raise
+        if entries:
+            now = time.time()
+            self._transaction(lambda cursor: cursor.executemany(
+                'UPDATE entries SET last_access = ? WHERE image = ? AND model = ?',
+                [(now, image, model) for image in entries]))
+
+        self.hits += len(entries)
+        self.misses += len(images) - len(entries)
+        return [entries.get(image) for image in images]
+
+    def get(self, image, model):
+        return self.get_many([image], model)[0]
+
+    def put_many(self, items, model):
+        '''
+        items --> list of (image hash, Detections)
+        '''
+        payloads = [(image, encode_entry(*detections)) for image, detections in items]
+        if not payloads:
+            return
+
+        def append(cursor):
+            generation = self._meta(cursor, 'generation')
+            live_bytes = self._meta(cursor, 'live_bytes')
+            # Appends happen under the write lock, so processes never interleave in the data file
+            with open(self._data_path(generation), 'ab') as file:
+                offset = file.seek(0, os.SEEK_END)
+                now = time.time()
+                for image, payload in payloads:
+                    old = cursor.execute('SELECT length FROM entries WHERE image = ? AND model = ?',
+                                         (image, model)).fetchone()
+                    live_bytes -= old[0] if old else 0
+                    file.write(payload)
+                    cursor.execute('INSERT OR REPLACE INTO entries (image, model, offset, length, last_access) '
+                                   'VALUES (?, ?, ?, ?, ?)', (image, model, offset, len(payload), now))
+                    offset += len(payload)
+                    live_bytes += len(payload)
+            cursor.execute("UPDATE meta SET value = ? WHERE key = 'live_bytes'", (live_bytes,))
+            return live_bytes
+
+        if self._transaction(append) > self.max_bytes:
+            self.evict()
+
+    def put(self, image, model, detections):
+        self.put_many([(image, detections)], model)
+
+    def evict(self, target = 0.9):
+        '''
+        Drop least recently used entries until they take at most target * max_bytes; compact the data file
+        once less than half of it is referenced
+        '''
+        def drop(cursor):
+            live_bytes = self._meta(cursor, 'live_bytes')
+            limit = int(self.max_bytes * target)
+            victims = []
+            for image, model, length in cursor.execute('SELECT image, model, length FROM entries ORDER BY last_access'):
+                if live_bytes <= limit:
+                    break
+                victims.append((image, model))
+                live_bytes -= length
+            cursor.executemany('DELETE FROM entries WHERE image = ? AND model = ?', victims)
+            cursor.execute("UPDATE meta SET value = ? WHERE key = 'live_bytes'", (live_bytes,))
+            return live_bytes, self._meta(cursor, 'generation')
+
+        live_bytes, generation = self._transaction(drop)
+        if os.path.getsize(self._data_path(generation)) > 2 * max(live_bytes, 1 << 20):
+            self.compact()
+
+    def compact(self):
+        '''
+        Copy the referenced entries into a new data file (next generation). Readers holding the old file keep
+        their memory map; they switch when they see the new generation. The replaced file stays on disk until the
+        next compaction, for readers that read the old generation but have not opened its file yet.
+        '''
+        def rewrite(cursor):
+            generation = self._meta(cursor, 'generation')
+            old_path = self._data_path(generation)
+            old = np.memmap(old_path, dtype = np.uint8, mode = 'r') if os.path.getsize(old_path) else None
+            rows = cursor.execute('SELECT image, model, offset, length FROM entries ORDER BY offset').fetchall()
+            updates = []
+            with open(self._data_path(generation + 1), 'wb') as file:
+                for image, model, offset, length in rows:
+                    updates.append((file.tell(), image, model))
+                    file.write(old[offset:offset + length].tobytes())
+            cursor.executemany('UPDATE entries SET offset = ? WHERE image = ? AND model = ?', updates)
+            cursor.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (generation + 1,))
+            return generation
+
+        generation = self._transaction(rewrite)
+        try:
+            os.remove(self._data_path(generation - 1))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        entries, size = self.connection.execute('SELECT COUNT(*), COALESCE(SUM(length), 0) FROM entries').fetchone()
+        generation = self.connection.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0]
+        path = self._data_path(generation)
+        return {'entries': entries, 'live_bytes': size, 'file_bytes': os.path.getsize(path) if os.path.exists(path) else 0,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def result_to_detections(result):
+    '''
+    ultralytics Results --> Detections (binary masks at model resolution)
+    '''
+    boxes = result.boxes.data.detach().cpu().numpy()
+    masks = None
+    if result.masks is not None:
+        masks = (result.masks.data.detach().cpu().numpy() > 0.5).astype(np.uint8)
+    return Detections(boxes[:, :4], boxes[:, 4], boxes[:, 5], masks, tuple(result.orig_shape))
+
+
+def detections_to_result(detections, names, image = None, path = ''):
+    '''
+    Detections --> ultralytics Results. Without the image, orig_img is a blank (lazily allocated) frame of the right size.
+    '''
+    import torch
+    from ultralytics.engine.results import Results
+
+    if image is None:
+        image = np.zeros(tuple(detections.orig_shape) + (3,), dtype = np.uint8)
+    boxes = np.column_stack((detections.boxes, detections.conf, detections.cls)).reshape(-1, 6)
+    masks = torch.as_tensor(detections.masks.astype(np.float32)) if detections.masks is not None and len(boxes) else None
+    return Results(image, path = path, names = names, boxes = torch.as_tensor(boxes, dtype = torch.float32), masks = masks)
+
+
+class CachedPredictor:
+    '''
+    model.predict() with the cache in front: hits are rebuilt from the cache, only misses go to the model (batched)
+
+    model --> loaded YOLO model
+    model_id --> model_fingerprint(weights, ...) of that model and the predict arguments
+    predict_kwargs --> passed on to model.predict (conf, device, imgsz ...)
+    '''
+    def __init__(self, model, cache, model_id, **predict_kwargs):
+        self.model = model
+        self.cache = cache
+        self.model_id = model_id
+        self.predict_kwargs = predict_kwargs
+
+    def predict(self, sources):
+        '''
+        sources --> list of image paths or decoded images (BGR arrays). Returns one Results per source.
+        '''
+        keys = [image_key_file(source) if isinstance(source, str) else image_key_array(source) for source in sources]
+        cached = self.cache.get_many(keys, self.model_id)
+
+        results = [None] * len(sources)
+        for index, (source, detections) in enumerate(zip(sources, cached)):
+            if detections is not None:
+                image, path = (None, source) if isinstance(source, str) else (source, '')
+                results[index] = detections_to_result(detections, self.model.names, image, path)
+
+        missing = [index for index, detections in enumerate(cached) if detections is None]
+        if missing:
+            predicted = self.model.predict(source = [sources[index] for index in missing], verbose = False,
+                                           stream = False, **self.predict_kwargs)
+            items = []
+            for index, result in zip(missing, predicted):
+                results[index] = result
+                items.append((keys[index], result_to_detections(result)))
+            self.cache.put_many(items, self.model_id)
+        return results
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Inference Cache')
+
+    # Arguments
+    parser.add_argument('--cache', type = str, default = '.inference_cache', help = 'Cache folder, default = .inference_cache')
+    parser.add_argument('--max_gb', type = float, default = None, help = 'Evict least recently used entries down to MAX_GB')
+    parser.add_argument('--compact', action = 'store_true', help = 'Rewrite the data file without unreferenced entries')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    with InferenceCache(args.cache, max_bytes = (args.max_gb or 1e9) * 1e9) as cache:
+        if args.max_gb is not None:
+            cache.evict(target = 1.0)
+        if args.compact:
+            cache.compact()
+        stats = cache.stats()
+        print (f"{stats['entries']} entries, {stats['live_bytes'] / 1e6:.1f} MB referenced, "
+               f"{stats['file_bytes'] / 1e6:.1f} MB on disk")
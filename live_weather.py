@@ -2,12 +2,78 @@ import openmeteo_requests
 
 import requests_cache
 import pandas as pd
+import numpy as np
 from retry_requests import retry
 
 '''
 https://open-meteo.com/en/docs#latitude=54.3781&longitude=18.4682&current=temperature_2m,relative_humidity_2m,rain,snowfall,cloud_cover&hourly=&timezone=Europe%2FBerlin
 '''
 
+WEATHER_API_URL = 'https://api.open-meteo.com/v1/forecast'
+
+
+def fetch_current_weather(openmeteo, url = WEATHER_API_URL):
+    '''
+    Query the current weather with an already configured Open-Meteo client.
+    Returns (weather values, observation time in unix seconds). Raises on error.
+    '''
+    # Make sure all required weather variables are listed here
+    # The order of variables in hourly or daily is important to assign them correctly below
+    params = {
+        "latitude": 54.3781,
+        "longitude": 18.4682,
+        "current": ["temperature_2m", "relative_humidity_2m", "rain", "snowfall", "cloud_cover"],
+        "timezone": "Europe/Berlin"
+    }
+    responses = openmeteo.weather_api(url, params=params)
+
+    # Process first location. Add a for-loop for multiple locations or weather models
+    response = responses[0]
+    '''print(f"Coordinates {response.Latitude()}°E {response.Longitude()}°N")
+    print(f"Elevation {response.Elevation()} m asl")
+    print(f"Timezone {response.Timezone()} {response.TimezoneAbbreviation()}")
+    print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")'''
+
+    # Current values. The order of variables needs to be the same as requested.
+    current = response.Current()
+    current_temperature_2m = round(current.Variables(0).Value(),3)                           # C
+    current_relative_humidity_2m = round(current.Variables(1).Value(),3)                     # %
+    current_rain = round(current.Variables(2).Value(),3)                                     # mm 
+    current_showers = round(current.Variables(3).Value(),3)                                  # mm
+    current_snowfall = round(current.Variables(3).Value(),3)                                 # cm
+    current_cloud_cover = round(current.Variables(4).Value(),3)                              # %
+
+    values = (current_temperature_2m, current_relative_humidity_2m, current_rain, current_showers, current_snowfall, current_cloud_cover)
+    return values, float(current.Time())
+
+
+WEATHER_ARCHIVE_URL = 'https://archive-api.open-meteo.com/v1/archive'
+
+
+def fetch_hourly_weather(openmeteo, start_date, end_date, url = WEATHER_ARCHIVE_URL):
+    '''
+    Query the hourly weather history between two dates ('YYYY-MM-DD', inclusive, UTC days).
+    Returns (unix seconds of each hour, (hours, 6) weather values in the order of fetch_current_weather). Raises on error.
+    '''
+    params = {
+        "latitude": 54.3781,
+        "longitude": 18.4682,
+        "start_date": start_date,
+        "end_date": end_date,
+        "hourly": ["temperature_2m", "relative_humidity_2m", "rain", "snowfall", "cloud_cover"],
+        "timezone": "GMT"
+    }
+    responses = openmeteo.weather_api(url, params=params)
+    hourly = responses[0].Hourly()
+
+    times = np.arange(hourly.Time(), hourly.TimeEnd(), hourly.Interval(), dtype = np.float64)
+    temperature_2m, relative_humidity_2m, rain, snowfall, cloud_cover = [hourly.Variables(i).ValuesAsNumpy() for i in range(5)]
+
+    # Same columns as the live values: showers is filled from the snowfall variable there as well
+    values = np.column_stack((temperature_2m, relative_humidity_2m, rain, snowfall, snowfall, cloud_cover)).astype(np.float64)
+    return times, np.round(values, 3)
+
+
 def get_current_weather():
     try:
         # Setup the Open-Meteo API client with cache and retry on error
@@ -15,35 +81,9 @@ def get_current_weather():
         retry_session = retry(cache_session, retries = 5, backoff_factor = 0.2)
         openmeteo = openmeteo_requests.Client(session = retry_session)
 
-        # Make sure all required weather variables are listed here
-        # The order of variables in hourly or daily is important to assign them correctly below
-        url = "https://api.open-meteo.com/v1/forecast"
-        params = {
-            "latitude": 54.3781,
-            "longitude": 18.4682,
-            "current": ["temperature_2m", "relative_humidity_2m", "rain", "snowfall", "cloud_cover"],
-            "timezone": "Europe/Berlin"
-        }
-        responses = openmeteo.weather_api(url, params=params)
-
-        # Process first location. Add a for-loop for multiple locations or weather models
-        response = responses[0]
-        '''print(f"Coordinates {response.Latitude()}°E {response.Longitude()}°N")
-        print(f"Elevation {response.Elevation()} m asl")
-        print(f"Timezone {response.Timezone()} {response.TimezoneAbbreviation()}")
-        print(f"Timezone difference to GMT+0 {response.UtcOffsetSeconds()} s")'''
-
-        # Current values. The order of variables needs to be the same as requested.
-        current = response.Current()
-        current_temperature_2m = round(current.Variables(0).Value(),3)                           # C
-        current_relative_humidity_2m = round(current.Variables(1).Value(),3)                     # %
-        current_rain = round(current.Variables(2).Value(),3)                                     # mm 
-        current_showers = round(current.Variables(3).Value(),3)                                  # mm
-        current_snowfall = round(current.Variables(3).Value(),3)                                 # cm
-        current_cloud_cover = round(current.Variables(4).Value(),3)                              # %
-
-        return current_temperature_2m, current_relative_humidity_2m, current_rain, current_showers, current_snowfall, current_cloud_cover
+        values, _ = fetch_current_weather(openmeteo)
+        return values
 
     except Exception as e:
         print (f'An error occured while retrieving weather update: {e}')
-        return None
\ No newline at end of file
+        return None
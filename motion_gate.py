@@ -0,0 +1,121 @@
+import time
+import cv2
+import numpy as np
+
+from multi_stream_tracker import CaptureClock
+
+'''
+Motion-gated inference for the static apron camera.
+
+Consecutive frames are mostly identical (parked aircraft, idle conveyors, night time), so running segmentation on
+every frame wastes CPU. MotionGate compares a small, blurred grayscale copy of each frame with the copy taken at the
+last inference; only if enough pixels changed does the frame go through the model. Otherwise the last tracks are
+carried forward and flagged as predicted. A minimum inference rate (min_rate) bounds how long the gate can skip.
+
+    gate = MotionGate(change_threshold = 0.002, min_rate = 1.0)
+    for result, predicted, timestamp_us in gated_track(model, link, gate, conf = 0.7):
+        ...
+    print (gate.summary())
+'''
+
+
+class MotionGate:
+    '''
+    change_threshold --> fraction of (downscaled) pixels that must change to trigger inference
+    pixel_threshold --> absolute grayscale difference for a pixel to count as changed
+    width --> frames are downscaled to this width before comparing
+    min_rate --> run inference at least this many times per second, regardless of motion (None to disable)
+    '''
+    def __init__(self, change_threshold = 0.002, pixel_threshold = 25, width = 160, min_rate = 1.0):
+        self.change_threshold = change_threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.max_interval = None if not min_rate else 1.0 / min_rate
+
+        self._reference = None
+        self._last_inference = None
+
+        # Counters
+        self.processed = 0
+        self.skipped = 0
+        self.forced = 0
+        self.last_change = 0.0
+
+    def _small(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.width, max(1, round(height * self.width / width)))
+        small = cv2.resize(frame, size, interpolation = cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def should_infer(self, frame, now = None):
+        '''
+        Decide whether the frame needs full inference. Updates the counters accordingly.
+        '''
+        now = time.monotonic() if now is None else now
+        small = self._small(frame)
+
+        if self._reference is None or self._reference.shape != small.shape:
+            infer = True
+        else:
+            diff = cv2.absdiff(small, self._reference)
+            self.last_change = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+            infer = self.last_change >= self.change_threshold
+
+            if not infer and self.max_interval is not None and now - self._last_inference >= self.max_interval:
+                infer = True
+                self.forced += 1
+
+        if infer:
+            # Compare against the last inferred frame, so slow changes still add up and trigger eventually
+            self._reference = small
+            self._last_inference = now
+            self.processed += 1
+        else:
+            self.skipped += 1
+        return infer
+
+    def summary(self):
+        total = self.processed + self.skipped
+        skipped = 100.0 * self.skipped / total if total else 0.0
+        return (f'{total} frames: {self.processed} processed ({self.forced} forced by min_rate), '
+                f'{self.skipped} skipped ({skipped:.1f}%)')
+
+
+def gated_track(model, source, gate, metrics = None, **track_kwargs):
+    '''
+    Decode `source` and run model.track only on frames the gate lets through.
+    Yields (result, predicted, timestamp_us); predicted results are the last tracked result carried forward,
+    timestamp_us is the capture time of the current frame (see multi_stream_tracker.CaptureClock).
+    metrics --> optional PipelineMetrics; inference includes tracking here (one model.track call), capture_lag
+                is how far processing trails the stream's own clock
+    '''
+    capture = cv2.VideoCapture(source)
+    clock = CaptureClock()
+    last_result = None
+    stream_start = None
+    try:
+        while True:
+            t = time.perf_counter()
+            ok, frame = capture.read()
+            if not ok:
+                break
+            timestamp_us = clock.timestamp_us(capture)
+            if metrics is not None:
+                t = metrics.lap('decode_wait', t)
+                position = capture.get(cv2.CAP_PROP_POS_MSEC) / 1000
+                if stream_start is None:
+                    stream_start = t - position
+                metrics.capture_lag(t - stream_start - position)
+
+            if gate.should_infer(frame) or last_result is None:
+                # persist = True keeps the tracker state between the single-frame calls
+                last_result = model.track(source = frame, persist = True, verbose = False, **track_kwargs)[0]
+                if metrics is not None:
+                    metrics.lap('inference', t)
+                yield last_result, False, timestamp_us
+            else:
+                yield last_result, True, timestamp_us
+    finally:
+        capture.release()
@@ -0,0 +1,311 @@
+import threading
+import time
+import queue
+import argparse
+from collections import namedtuple
+
+import cv2
+import torch
+from ultralytics import YOLO
+from ultralytics.trackers.track import TRACKER_MAP
+from ultralytics.utils import IterableSimpleNamespace, yaml_load
+from ultralytics.utils.checks import check_yaml
+
+'''
+Runs detection + tracking on several live streams (or recorded videos) at once with a single loaded YOLO model.
+
+    - every source gets its own decoder thread (StreamReader)
+    - the latest frame of every source is collected into one batch and passed through the shared model in one call
+    - tracker state (BYTETrack/BoT-SORT) is kept per stream, so track IDs are independent for each stream
+    - results are yielded as StreamResult(stream_id, frame_index, timestamp_us, result); timestamp_us is the
+      frame's capture time (unix microseconds UTC) taken from the stream's own clock (PTS)
+
+Usage:
+    tracker = MultiStreamTracker('weights/last.pt', {'PPS3': pps3_url, 'WestPier': westpier_url})
+    for stream_id, frame_index, timestamp_us, result in tracker:
+        ...
+
+Throughput benchmark on recorded videos (frames/sec with 1, 2, ... streams):
+    python3 multi_stream_tracker.py --benchmark --sources Data/a.mp4 Data/b.mp4 --max_frames 300
+'''
+
+PPS3_URL = 'https://62abe29de64ab.streamlock.net:4444/EPGD/pps3.stream/chunklist_w2096451211.m3u8'
+WESTPIER_URL = 'https://62abe29de64ab.streamlock.net:4444/EPGD/pirs2.stream/chunklist_w1496307832.m3u8'
+
+StreamResult = namedtuple('StreamResult', ['stream_id', 'frame_index', 'timestamp_us', 'result'])
+
+
+class CaptureClock:
+    '''
+    Capture time of decoded frames in unix microseconds UTC. The stream position (PTS) of the first frame is
+    anchored to the wall clock, later frames are anchor + PTS, so frames that waited in a queue keep the time they
+    were captured. Sources without a usable position fall back to the wall clock at decode.
+    '''
+    def __init__(self):
+        self._anchor_us = None
+        self._last_us = None
+
+    def timestamp_us(self, capture):
+        now_us = time.time_ns() // 1000
+        position_us = int(capture.get(cv2.CAP_PROP_POS_MSEC) * 1000)
+        if position_us <= 0:
+            return now_us
+        if self._anchor_us is None:
+            self._anchor_us = now_us - position_us
+        timestamp_us = self._anchor_us + position_us
+        # A discontinuity (playlist reload, seek) re-anchors instead of jumping back in time
+        if self._last_us is not None and (timestamp_us < self._last_us or timestamp_us > now_us):
+            self._anchor_us = now_us - position_us
+            timestamp_us = now_us
+        self._last_us = timestamp_us
+        return timestamp_us
+
+
+class StreamReader(threading.Thread):
+    '''
+    Decodes one source on its own thread into a small frame queue.
+
+    drop_frames --> keep only the newest frames when inference falls behind (live streams);
+                    False blocks the decoder instead, so no frame of a recorded video is skipped
+    '''
+    def __init__(self, stream_id, source, queue_size = 2, drop_frames = True):
+        super().__init__(name = f'reader-{stream_id}', daemon = True)
+        self.stream_id = stream_id
+        self.source = source
+        self.drop_frames = drop_frames
+        self.frames = queue.Queue(maxsize = queue_size)
+        self.finished = threading.Event()
+        self.fps = 30
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        capture = cv2.VideoCapture(self.source)
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or 30
+        clock = CaptureClock()
+        try:
+            while not self._stop_event.is_set():
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                item = (self.frames_read, frame, clock.timestamp_us(capture))
+                self.frames_read += 1
+
+                if self.drop_frames:
+                    while True:
+                        try:
+                            self.frames.put_nowait(item)
+                            break
+                        except queue.Full:
+                            try:
+                                self.frames.get_nowait()
+                                self.frames_dropped += 1
+                            except queue.Empty:
+                                pass
+                else:
+                    while not self._stop_event.is_set():
+                        try:
+                            self.frames.put(item, timeout = 0.1)
+                            break
+                        except queue.Full:
+                            pass
+        finally:
+            capture.release()
+            self.finished.set()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def done(self):
+        '''True once the source is exhausted and every decoded frame has been consumed'''
+        return self.finished.is_set() and self.frames.empty()
+
+
+def make_tracker(tracker_config, frame_rate):
+    '''
+    Create a tracker the same way ultralytics does for model.track(..., tracker = tracker_config)
+    '''
+    cfg = IterableSimpleNamespace(**yaml_load(check_yaml(tracker_config)))
+    return TRACKER_MAP[cfg.tracker_type](args = cfg, frame_rate = frame_rate)
+
+
+def track_result(tracker, result, frame):
+    '''
+    Run a tracker on one predict() result (mirrors ultralytics' on_predict_postprocess_end)
+    '''
+    det = result.boxes.cpu().numpy()
+    if len(det) == 0:
+        return result
+
+    tracks = tracker.update(det, frame)
+    if len(tracks) == 0:
+        return result
+
+    idx = tracks[:, -1].astype(int)
+    result = result[idx]
+    result.update(boxes = torch.as_tensor(tracks[:, :-1]))
+    return result
+
+
+class MultiStreamTracker:
+    '''
+    model --> weights path or an already loaded YOLO model (shared by all streams)
+    sources --> {stream_id: url or video path}
+    tracker_config --> ultralytics tracker yaml, e.g. 'bytetrack.yaml' or 'botsort.yaml'
+    batch_timeout --> seconds to wait for the other streams once one frame is available
+    drop_frames --> see StreamReader; use False for recorded videos
+    metrics --> optional PipelineMetrics (decode_wait, inference, tracking, capture_lag, dropped frames)
+    tiler --> optional TiledPredictor; every frame is then predicted as one batch of its region tiles
+    '''
+    def __init__(self, model, sources, tracker_config = 'bytetrack.yaml', conf = 0.7, device = 'cpu',
+                 batch_timeout = 0.05, drop_frames = True, queue_size = 2, metrics = None, tiler = None):
+        self.model = YOLO(model) if isinstance(model, str) else model
+        self.sources = dict(sources)
+        self.tracker_config = tracker_config
+        self.conf = conf
+        self.device = device
+        self.batch_timeout = batch_timeout
+        self.drop_frames = drop_frames
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.tiler = tiler
+
+        self.readers = {}
+        self.trackers = {}
+        self.frames_processed = 0
+        self.batches = 0
+
+    def _collect_batch(self):
+        '''
+        Wait for a frame from any stream, then give the others batch_timeout to deliver one too
+        '''
+        batch = {}
+        deadline = None
+        while len(batch) < len(self.readers):
+            pending = [reader for stream_id, reader in self.readers.items() if stream_id not in batch and not reader.done()]
+            if not pending:
+                break
+
+            for reader in pending:
+                try:
+                    batch[reader.stream_id] = reader.frames.get_nowait()
+                except queue.Empty:
+                    pass
+
+            if batch and deadline is None:
+                deadline = time.monotonic() + self.batch_timeout
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if len(batch) < len(self.readers):
+                time.sleep(0.001)
+        return batch
+
+    def _track(self, stream_id, result, frame):
+        return track_result(self.trackers[stream_id], result, frame)
+
+    def start(self):
+        for stream_id, source in self.sources.items():
+            reader = StreamReader(stream_id, source, queue_size = self.queue_size, drop_frames = self.drop_frames)
+            reader.start()
+            self.readers[stream_id] = reader
+            self.trackers[stream_id] = None
+
+    def stop(self):
+        for reader in self.readers.values():
+            reader.stop()
+        for reader in self.readers.values():
+            reader.join(timeout = 2)
+
+    def __iter__(self):
+        self.start()
+        try:
+            metrics = self.metrics
+            while not all(reader.done() for reader in self.readers.values()):
+                t = time.perf_counter()
+                batch = self._collect_batch()
+                if not batch:
+                    continue
+
+                stream_ids = list(batch)
+                frames = [batch[stream_id][1] for stream_id in stream_ids]
+                if metrics is not None:
+                    t = metrics.lap('decode_wait', t)
+
+                # One forward pass for all streams (or, tiled, one per frame over all its tiles)
+                if self.tiler is not None:
+                    results = [self.tiler.predict(frame) for frame in frames]
+                else:
+                    results = self.model.predict(source = frames, conf = self.conf, device = self.device,
+                                                 verbose = False, stream = False)
+                self.batches += 1
+                if metrics is not None:
+                    t = metrics.lap('inference', t)
+
+                for stream_id, frame, result in zip(stream_ids, frames, results):
+                    if self.trackers[stream_id] is None:
+                        self.trackers[stream_id] = make_tracker(self.tracker_config, self.readers[stream_id].fps)
+                    self.frames_processed += 1
+                    result = self._track(stream_id, result, frame)
+                    if metrics is not None:
+                        t = metrics.lap('tracking', t)
+                        metrics.capture_lag(time.time() - batch[stream_id][2] / 1e6)
+                        metrics.dropped_frames = sum(reader.frames_dropped for reader in self.readers.values())
+                    yield StreamResult(stream_id, batch[stream_id][0], batch[stream_id][2], result)
+                    t = time.perf_counter()
+        finally:
+            self.stop()
+
+
+def benchmark(model_weight, videos, max_frames = 300, device = 'cpu'):
+    '''
+    Measure total frames/sec for 1..len(videos) concurrent streams over recorded videos, sharing one model
+    '''
+    model = YOLO(model_weight)
+    report = []
+    for num_streams in range(1, len(videos) + 1):
+        sources = {f'stream_{i}': video for i, video in enumerate(videos[:num_streams])}
+        tracker = MultiStreamTracker(model, sources, device = device, drop_frames = False)
+
+        frames = 0
+        start = time.perf_counter()
+        for _ in tracker:
+            frames += 1
+            if frames >= max_frames * num_streams:
+                break
+        elapsed = time.perf_counter() - start
+
+        fps = frames / elapsed if elapsed > 0 else 0.0
+        report.append((num_streams, frames, elapsed, fps))
+        print (f'{num_streams} stream(s): {frames} frames in {elapsed:.1f} s --> {fps:.2f} frames/sec '
+               f'({fps / num_streams:.2f} per stream, {frames / max(tracker.batches, 1):.2f} frames/batch)')
+    return report
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Multi-Stream Tracking')
+
+    # Arguments
+    parser.add_argument('--weights', type = str, default = 'weights/last.pt', help = 'Model weights, default = weights/last.pt')
+    parser.add_argument('--sources', type = str, nargs = '+', default = [PPS3_URL, WESTPIER_URL], help = 'Stream URLs or video files, default = PPS3 and WestPier live feeds')
+    parser.add_argument('--benchmark', action = 'store_true', help = 'Report frames/sec for 1..N streams over the given (recorded) sources')
+    parser.add_argument('--max_frames', type = int, default = 300, help = 'Frames per stream in benchmark mode, default = 300')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    device = '0' if torch.cuda.is_available() else 'cpu'
+
+    if args.benchmark:
+        benchmark(args.weights, args.sources, max_frames = args.max_frames, device = device)
+    else:
+        tracker = MultiStreamTracker(args.weights, {f'stream_{i}': source for i, source in enumerate(args.sources)}, device = device)
+        for stream_id, frame_index, timestamp_us, result in tracker:
+            track_ids = [] if result.boxes.id is None else result.boxes.id.int().tolist()
+            print (f'{stream_id} frame {frame_index}: {len(result.boxes)} detections, tracks {track_ids}')
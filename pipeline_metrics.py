@@ -0,0 +1,261 @@
+import json
+import time
+import logging
+import threading
+from bisect import bisect_left
+from logging.handlers import RotatingFileHandler
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+'''
+Always-on instrumentation of the live tracking loop (generate_time_series.py).
+
+The hot path only takes perf_counter() laps and bumps plain Python counters (no locks, no allocation); with a
+handful of stages per frame that is a few microseconds, far below 1% of a ~100 ms frame. Everything else happens off
+the hot path: the Prometheus text endpoint renders on request in its own thread, the optional rolling log is
+written by a background thread every log_interval seconds.
+
+    metrics = PipelineMetrics()
+    t = metrics.clock()
+    ...inference...
+    t = metrics.lap('inference', t)
+    metrics.frame(classes)
+
+    server = serve_metrics(metrics, port = DEFAULT_PORT)    # curl localhost:9471/metrics, None if the port is taken
+    MetricsLogger(metrics, 'Raw_Time_Series_Data/metrics.log').start()
+'''
+
+STAGES = ['decode_wait', 'inference', 'tracking', 'weather', 'enqueue', 'events', 'build', 'storage', 'capture_lag']
+
+# Histogram bucket upper bounds in seconds (Prometheus 'le' labels)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+NUM_CLASSES = 8
+
+# Away from 9100, which node_exporter usually holds on the same host
+DEFAULT_PORT = 9471
+
+
+class PipelineMetrics:
+    '''
+    stages --> names of the timed stages (histograms in seconds)
+    class_names --> {class ID: name} used as label of the per-class detection counters
+    '''
+    clock = staticmethod(time.perf_counter)
+
+    def __init__(self, stages = STAGES, buckets = BUCKETS, class_names = None, num_classes = NUM_CLASSES):
+        self.buckets = tuple(buckets)
+        self.class_names = class_names or {}
+        self.started = time.time()
+
+        # stage --> [bucket counts (+Inf last)], sum, count, max
+        self._counts = {stage: [0] * (len(self.buckets) + 1) for stage in stages}
+        self._sums = dict.fromkeys(stages, 0.0)
+        self._max = dict.fromkeys(stages, 0.0)
+
+        self.frames = 0
+        self.predicted_frames = 0
+        self.dropped_frames = 0
+        self.detections = np.zeros(num_classes, dtype = np.int64)
+        self.last_capture_lag = 0.0
+
+        # name --> object with stats() (storage_queue.BoundedQueue), read only when reporting
+        self.queues = {}
+
+    def watch_queue(self, name, queue):
+        self.queues[name] = queue
+
+    def observe(self, stage, seconds):
+        counts = self._counts.get(stage)
+        if counts is None:
+            counts = self._counts[stage] = [0] * (len(self.buckets) + 1)
+            self._sums[stage] = 0.0
+            self._max[stage] = 0.0
+        counts[bisect_left(self.buckets, seconds)] += 1
+        self._sums[stage] += seconds
+        if seconds > self._max[stage]:
+            self._max[stage] = seconds
+
+    def lap(self, stage, start):
+        '''
+        Record the time since start for stage; returns now, the start of the next lap
+        '''
+        now = time.perf_counter()
+        self.observe(stage, now - start)
+        return now
+
+    def capture_lag(self, seconds):
+        self.last_capture_lag = seconds
+        self.observe('capture_lag', max(seconds, 0.0))
+
+    def frame(self, classes = None, predicted = False):
+        '''
+        Count one processed frame and its detections (array of class IDs)
+        '''
+        self.frames += 1
+        if predicted:
+            self.predicted_frames += 1
+        if classes is not None and len(classes):
+            counts = np.bincount(np.asarray(classes, dtype = np.int64), minlength = len(self.detections))
+            if len(counts) > len(self.detections):
+                self.detections = np.concatenate((self.detections, np.zeros(len(counts) - len(self.detections), dtype = np.int64)))
+            self.detections += counts
+
+    # ---- reporting (off the hot path) --------------------------------------------------------------------------
+
+    def _quantile(self, counts, q):
+        '''Upper bucket bound containing the q-quantile (Prometheus histogram_quantile without interpolation)'''
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        uptime = time.time() - self.started
+        stages = {}
+        for stage, counts in list(self._counts.items()):
+            count = sum(counts)
+            if count == 0:
+                continue
+            stages[stage] = {'count': count, 'mean_ms': 1000 * self._sums[stage] / count,
+                             'max_ms': 1000 * self._max[stage],
+                             'p50_ms': 1000 * self._quantile(counts, 0.5),
+                             'p95_ms': 1000 * self._quantile(counts, 0.95),
+                             'p99_ms': 1000 * self._quantile(counts, 0.99)}
+        return {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'uptime_s': uptime, 'frames': self.frames,
+                'fps': self.frames / uptime if uptime > 0 else 0.0,
+                'predicted_frames': self.predicted_frames, 'dropped_frames': self.dropped_frames,
+                'capture_lag_s': self.last_capture_lag,
+                'detections': {self.class_names.get(i, str(i)): int(count) for i, count in enumerate(self.detections) if count},
+                'queues': {name: queue.stats() for name, queue in self.queues.items()},
+                'stages': stages}
+
+    def render(self):
+        '''
+        Prometheus text exposition format
+        '''
+        lines = ['# HELP tracking_stage_seconds Time spent per frame in each pipeline stage',
+                 '# TYPE tracking_stage_seconds histogram']
+        for stage, counts in list(self._counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'tracking_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'tracking_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+            lines.append(f'tracking_stage_seconds_sum{{stage="{stage}"}} {self._sums[stage]}')
+            lines.append(f'tracking_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        lines += ['# HELP tracking_frames_total Frames processed',
+                  '# TYPE tracking_frames_total counter',
+                  f'tracking_frames_total {self.frames}',
+                  '# HELP tracking_predicted_frames_total Frames skipped by the motion gate (tracks carried forward)',
+                  '# TYPE tracking_predicted_frames_total counter',
+                  f'tracking_predicted_frames_total {self.predicted_frames}',
+                  '# HELP tracking_dropped_frames_total Decoded frames dropped because inference fell behind',
+                  '# TYPE tracking_dropped_frames_total counter',
+                  f'tracking_dropped_frames_total {self.dropped_frames}',
+                  '# HELP tracking_capture_lag_seconds Gap between frame capture and processing of the last frame',
+                  '# TYPE tracking_capture_lag_seconds gauge',
+                  f'tracking_capture_lag_seconds {self.last_capture_lag}',
+                  '# HELP tracking_detections_total Detections per object class',
+                  '# TYPE tracking_detections_total counter']
+        for class_id, count in enumerate(self.detections.tolist()):
+            name = self.class_names.get(class_id, str(class_id))
+            lines.append(f'tracking_detections_total{{class="{name}"}} {count}')
+
+        queues = {name: queue.stats() for name, queue in self.queues.items()}
+        for metric, key, kind, text in (('queue_depth', 'depth', 'gauge', 'Records waiting between pipeline stages'),
+                                        ('queue_dropped_total', 'dropped', 'counter', 'Records dropped by the drop_oldest policy'),
+                                        ('queue_spilled_total', 'spilled', 'counter', 'Records spilled to disk by the spill policy')):
+            if queues:
+                lines += [f'# HELP tracking_{metric} {text}', f'# TYPE tracking_{metric} {kind}']
+            for name, stats in queues.items():
+                lines.append(f'tracking_{metric}{{queue="{name}"}} {stats[key]}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    '''
+    Serves metrics.render() at http://host:port/metrics from a daemon thread
+    '''
+    def __init__(self, metrics, port = DEFAULT_PORT, host = '127.0.0.1'):
+        self.metrics = metrics
+        metrics_ref = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics_ref.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target = self.server.serve_forever, name = 'metrics-server', daemon = True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def serve_metrics(metrics, port = DEFAULT_PORT, host = '127.0.0.1'):
+    '''
+    Start a MetricsServer; if the port cannot be bound (e.g. already in use) print a warning and return None,
+    instrumentation must never stop the pipeline
+    '''
+    try:
+        return MetricsServer(metrics, port = port, host = host).start()
+    except OSError as error:
+        print (f'Warning: metrics endpoint disabled, cannot listen on {host}:{port} ({error}); use --metrics_port')
+        return None
+
+
+class MetricsLogger(threading.Thread):
+    '''
+    Appends metrics.snapshot() as one JSON line every interval seconds to a rotating log file
+    '''
+    def __init__(self, metrics, path, interval = 60.0, max_bytes = 10_000_000, backup_count = 5):
+        super().__init__(name = 'metrics-logger', daemon = True)
+        self.metrics = metrics
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+        self.logger = logging.getLogger(f'pipeline_metrics.{path}')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        handler = RotatingFileHandler(path, maxBytes = max_bytes, backupCount = backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.logger.addHandler(handler)
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.log()
+
+    def log(self):
+        self.logger.info(json.dumps(self.metrics.snapshot()))
+
+    def stop(self):
+        self._stop_event.set()
+        self.log()
+        for handler in self.logger.handlers:
+            handler.close()
@@ -1,5 +1,6 @@
-from ultralytics import YOLO
 import torch
+import argparse
+from inference_backend import add_backend_arguments, load_model
 
 
 '''This scrpt simply runs the YOLO model'''
@@ -9,13 +10,30 @@ import torch
 link = 'https://62abe29de64ab.streamlock.net:4444/EPGD/pps3.stream/chunklist_w2096451211.m3u8'
 
 
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Run YOLO')
+
+    # Arguments
+    parser.add_argument('--weights', type = str, default = 'weights/1024.pt', help = 'Model weights, default = weights/1024.pt')
+    parser.add_argument('--source', type = str, default = link, help = 'Stream URL, video or image, default = PPS3 live feed')
+    add_backend_arguments(parser)
+
+    args = parser.parse_args()
+    return args
+
+
+args = parse_arguments()
+
 # clear cache
 #torch.cuda.empty_cache()
 
-# Load the trained model (last epoch or best epoch)
-model = YOLO('weights/1024.pt')
+# Load the trained model (last epoch or best epoch), exported to the selected CPU runtime if requested
+model = load_model(args.weights, args.backend, args.int8)
 
-for result in model.track(source = link, show = True, 
+for result in model.track(source = args.source, show = True, 
                                 conf = 0.7, save = False, 
                                 line_width = 4, stream = True, 
                                 persist = True, save_txt = False,
@@ -0,0 +1,294 @@
+import os
+import time
+import pickle
+import struct
+import threading
+from collections import deque
+
+'''
+Bounded queue between the inference loop and the persistence stage of generate_time_series.py.
+
+The inference thread only builds a small record per frame (timestamp, weather, track IDs, classes, centroids) and
+puts it on a BoundedQueue; a StorageStage thread takes records off the queue and does everything that touches the
+disk (turnaround events CSV, building the rows, HDF5 append/flush). A slow flush then delays the writer, not the
+next model.track() call. What happens when the writer falls behind and the queue is full is the backpressure policy:
+
+    block        the inference loop waits for a free slot (nothing is lost, the stream reader drops frames instead)
+    drop_oldest  the oldest queued record is discarded to make room (counted in `dropped`)
+    spill        records go to an append-only pickle file in spill_dir until the writer caught up (counted in
+                 `spilled`); they are read back in order, and a spill file left by a crash is replayed at start.
+                 The read offset is saved next to it once the handler persisted a record, so the replay starts
+                 after the records already written (at most the one being handled at the crash is repeated)
+
+Closing the stage drains the queue (and the spill file) before the writer is closed, also on KeyboardInterrupt.
+
+    with StorageStage(persist, queue = BoundedQueue(256, 'spill', 'Raw_Time_Series_Data/spill'),
+                      idle = writer.flush) as stage:
+        for result in results:
+            stage.put(record)
+'''
+
+POLICIES = ['block', 'drop_oldest', 'spill']
+
+SPILL_FILE = 'storage_spill.pkl'
+
+
+class SpillFile:
+    '''
+    Append-only pickle file read back in FIFO order. pop() only reads a record; commit() marks the records popped so
+    far as handled by saving the read offset in path + '.offset'. Both files are removed once every record was
+    handled. Records left by a previous run are read from the saved offset on.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + '.offset'
+        self._writer = None
+        self._reader = None
+        self._offset_file = None
+        self._count = 0
+
+        # Read offset: end of the last record handled, and of the last record popped
+        self._handled = 0
+        self._popped = None
+
+        # Records left over by a previous run that did not drain
+        if os.path.exists(path):
+            self._handled = self._saved_offset()
+            with open(path, 'r+b') as file:
+                file.seek(0, os.SEEK_END)
+                self._handled = min(self._handled, file.tell())
+                file.seek(self._handled)
+                end = self._handled
+                while True:
+                    try:
+                        pickle.load(file)
+                    except Exception:
+                        break
+                    self._count += 1
+                    end = file.tell()
+                # A record cut off by the crash is discarded, new records are appended after the last complete one
+                file.truncate(end)
+            if self._count == 0:
+                self._remove()
+        elif os.path.exists(self.offset_path):
+            os.remove(self.offset_path)
+
+    def _saved_offset(self):
+        try:
+            with open(self.offset_path, 'rb') as file:
+                return struct.unpack('<Q', file.read(8))[0]
+        except (OSError, struct.error):
+            return 0
+
+    def _remove(self):
+        self.close()
+        for path in (self.path, self.offset_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self._handled = 0
+
+    def __len__(self):
+        '''Records not popped yet'''
+        return self._count
+
+    def push(self, item):
+        if self._writer is None:
+            self._writer = open(self.path, 'ab')
+        pickle.dump(item, self._writer, protocol = pickle.HIGHEST_PROTOCOL)
+        self._writer.flush()
+        self._count += 1
+
+    def pop(self):
+        if self._reader is None:
+            self._reader = open(self.path, 'rb')
+            self._reader.seek(self._handled)
+        item = pickle.load(self._reader)
+        self._count -= 1
+        self._popped = self._reader.tell()
+        return item
+
+    def commit(self):
+        '''
+        The records popped so far are persisted: save the read offset, or remove the files if nothing is left
+        '''
+        if self._popped is None:
+            return
+        self._handled, self._popped = self._popped, None
+        if self._count == 0:
+            self._remove()
+            return
+        if self._offset_file is None:
+            self._offset_file = open(self.offset_path, 'r+b' if os.path.exists(self.offset_path) else 'wb')
+        self._offset_file.seek(0)
+        self._offset_file.write(struct.pack('<Q', self._handled))
+        self._offset_file.flush()
+
+    def close(self):
+        for file in (self._writer, self._reader, self._offset_file):
+            if file is not None:
+                file.close()
+        self._writer = self._reader = self._offset_file = None
+
+
+class BoundedQueue:
+    '''
+    maxsize --> records held in memory
+    policy --> 'block', 'drop_oldest' or 'spill' (see module docstring)
+    spill_dir --> folder of the spill file, required for 'spill'
+    '''
+    def __init__(self, maxsize = 256, policy = 'block', spill_dir = None):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown backpressure policy {policy}, expected one of {POLICIES}')
+        if policy == 'spill' and spill_dir is None:
+            raise ValueError('The spill policy needs a spill_dir')
+
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self._items = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        # The last get() came from the spill file, committed by done()
+        self._from_spill = False
+
+        self.spill = None
+        if policy == 'spill':
+            os.makedirs(spill_dir, exist_ok = True)
+            self.spill = SpillFile(os.path.join(spill_dir, SPILL_FILE))
+
+        self.dropped = 0
+        self.spilled = 0
+        self.blocked_seconds = 0.0
+
+    def __len__(self):
+        '''Records waiting, in memory and on disk'''
+        return len(self._items) + (len(self.spill) if self.spill is not None else 0)
+
+    def put(self, item):
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('put() on a closed queue')
+
+            if self.spill is not None:
+                # Once records are on disk, newer ones follow them there to keep the order
+                if len(self.spill) or len(self._items) >= self.maxsize:
+                    self.spill.push(item)
+                    self.spilled += 1
+                else:
+                    self._items.append(item)
+
+            elif len(self._items) >= self.maxsize:
+                if self.policy == 'drop_oldest':
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    start = time.perf_counter()
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._condition.wait()
+                    self.blocked_seconds += time.perf_counter() - start
+                self._items.append(item)
+
+            else:
+                self._items.append(item)
+
+            self._condition.notify_all()
+
+    def get(self, timeout = None):
+        '''
+        Next record --> (True, item); (False, None) on timeout or once the queue is closed and empty
+        '''
+        with self._condition:
+            if not len(self) and not self._closed:
+                self._condition.wait(timeout)
+            if self._items:
+                item = self._items.popleft()
+                self._from_spill = False
+                self._condition.notify_all()
+                return True, item
+            if self.spill is not None and len(self.spill):
+                self._from_spill = True
+                return True, self.spill.pop()
+            return False, None
+
+    def done(self):
+        '''
+        The consumer handled the record of its last get(); a spilled record only counts as read on disk from here on
+        '''
+        with self._condition:
+            if self._from_spill:
+                self.spill.commit()
+                self._from_spill = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        '''No more puts; get() keeps returning the remaining records'''
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def stats(self):
+        return {'depth': len(self), 'dropped': self.dropped, 'spilled': self.spilled,
+                'blocked_s': self.blocked_seconds}
+
+
+class StorageStage(threading.Thread):
+    '''
+    handler --> called with every record, on this thread only (owns the writer / HDF5 file after start)
+    queue --> BoundedQueue feeding the stage
+    idle --> called when no record arrived for idle_interval seconds, e.g. writer.flush so readers stay current
+    '''
+    def __init__(self, handler, queue = None, idle = None, idle_interval = 1.0):
+        super().__init__(name = 'storage-stage', daemon = True)
+        self.handler = handler
+        self.queue = queue if queue is not None else BoundedQueue()
+        self.idle = idle
+        self.idle_interval = idle_interval
+        self.error = None
+        self.processed = 0
+
+    def run(self):
+        try:
+            while True:
+                ok, item = self.queue.get(timeout = self.idle_interval)
+                if ok:
+                    self.handler(item)
+                    self.queue.done()
+                    self.processed += 1
+                elif self.queue.closed and not len(self.queue):
+                    break
+                elif self.idle is not None:
+                    self.idle()
+        except Exception as error:
+            # Reported to the producer on its next put()
+            self.error = error
+            self.queue.close()
+
+    def put(self, item):
+        if self.error is not None:
+            raise RuntimeError('Storage stage failed') from self.error
+        self.queue.put(item)
+
+    def close(self, timeout = None):
+        '''
+        Stop accepting records, wait until everything queued (or spilled) has been handled
+        '''
+        pending = len(self.queue)
+        if pending and self.is_alive():
+            print (f'Draining {pending} queued frames to storage...')
+        self.queue.close()
+        if self.is_alive():
+            self.join(timeout)
+        if self.queue.spill is not None:
+            self.queue.spill.close()
+        if self.error is not None:
+            raise RuntimeError('Storage stage failed') from self.error
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('torch')
+pytest.importorskip('ultralytics')
+
+from backfill_time_series import Chunk, ChunkResult, TrackStitcher
+
+
+def test_two_nearby_objects_keep_their_ids():
+    '''
+    Two objects of the same class 12 px apart must both continue their tracks across the chunk boundary, also when
+    the nearest pair of the second object is already taken by the first
+    '''
+    chunk = Chunk('video.mp4', 1, 90, 100, 200, 25.0, 0)
+
+    # Previous chunk's tail: frame, global ID, class, x, y
+    tail = np.array([[frame, track_id, 2, x, 50.0] for frame in (96, 98) for track_id, x in ((7, 100.0), (8, 112.0))])
+
+    # Warm-up frames of the new chunk (local IDs 1 and 2), then one frame of its own
+    frame = np.array([96, 96, 98, 98, 100, 100])
+    track_id = np.array([1, 2, 1, 2, 1, 2])
+    x = np.array([102.0, 123.0, 102.0, 123.0, 103.0, 122.0])
+    result = ChunkResult(chunk, np.array([96, 98, 100]), frame, track_id, np.full(6, 2), x, np.full(6, 50.0))
+
+    stitcher = TrackStitcher(next_id = 9)
+    assert stitcher.stitch(tail, result).tolist() == [7, 8, 7, 8, 7, 8]
+    assert stitcher.next_id == 9
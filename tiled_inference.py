@@ -0,0 +1,317 @@
+import os
+import json
+import time
+import argparse
+
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+from ultralytics.engine.results import Results
+
+from dataset_cache import parse_label_file, label_path
+from annotation_qa import iou_matrix, greedy_match
+
+'''
+Tiled / region-of-interest inference for the full resolution (3840x2160) apron frames.
+
+Resizing a whole frame to the model input loses Ground_Crew and Passengers, running at full resolution is too slow
+on CPU. TiledPredictor instead
+    - covers only the configured apron regions (stands) with overlapping tile_size x tile_size tiles,
+      computed once per frame size
+    - sends all tiles of a frame (plus, by default, one downscaled full frame for objects larger than a tile,
+      i.e. aircraft) through the model as one batch
+    - shifts the detections back to frame coordinates and merges them across tiles with class-wise NMS on
+      intersection over the smaller box; boxes cut by an inner tile edge are merged into the box that suppresses
+      them instead of being dropped
+The result is an ultralytics Results with boxes only (no masks), ready for the tracker.
+
+Regions file (pixels of the full frame):
+    [{"name": "Stand 1", "box": [1200, 300, 2600, 1200]}, {"name": "Stand 2", "box": [2400, 250, 3840, 1100]}]
+
+    tiler = TiledPredictor(model, load_regions('apron_regions.json'), tile_size = 640, overlap = 0.2)
+    result = tiler.predict(frame)
+
+Latency and detections per class against full-frame inference, on full resolution frames:
+    python3 tiled_inference.py --frames Data/08_11_2023 --regions apron_regions.json --max_frames 30
+
+Detection counts alone do not tell whether tiling helps (duplicates at tile seams count too). With --labels (YOLO
+polygon labels named like the frames) both modes are also scored per class: a detection is correct if its box
+matches the bounding box of a label of its class with IoU >= --iou (greedy matching as in annotation_qa.py), and
+precision / recall are reported next to the latency:
+    python3 tiled_inference.py --frames Gdansk_Airport_Data_Annotation.v4i.yolov8/valid/images \
+        --labels Gdansk_Airport_Data_Annotation.v4i.yolov8/valid/labels --regions apron_regions.json
+'''
+
+
+def load_regions(path):
+    '''
+    Regions file --> list of (name, (x1, y1, x2, y2))
+    '''
+    with open(path) as file:
+        regions = json.load(file)
+    return [(region.get('name', str(i)), tuple(int(v) for v in region['box'])) for i, region in enumerate(regions)]
+
+
+def _starts(low, high, tile, step):
+    '''Tile start positions covering [low, high) with at most `step` between tiles'''
+    length = high - low
+    if length <= tile:
+        return [low]
+    count = int(np.ceil((length - tile) / step)) + 1
+    return np.round(np.linspace(low, high - tile, count)).astype(int).tolist()
+
+
+def make_tiles(regions, frame_shape, tile_size = 640, overlap = 0.2):
+    '''
+    (N, 4) int array of tile boxes (x1, y1, x2, y2) covering the regions (whole frame if regions is empty)
+    '''
+    height, width = frame_shape[:2]
+    boxes = [box for _, box in regions] or [(0, 0, width, height)]
+    step = max(1, int(tile_size * (1 - overlap)))
+
+    tiles = []
+    for x1, y1, x2, y2 in boxes:
+        x1, y1, x2, y2 = max(0, x1), max(0, y1), min(width, x2), min(height, y2)
+        if x2 <= x1 or y2 <= y1:
+            continue
+        for top in _starts(y1, y2, tile_size, step):
+            for left in _starts(x1, x2, tile_size, step):
+                tiles.append((left, top, min(left + tile_size, x2), min(top + tile_size, y2)))
+    return np.unique(np.array(tiles, dtype = np.int64).reshape(-1, 4), axis = 0)
+
+
+def merge_detections(boxes, scores, classes, cut, threshold = 0.5):
+    '''
+    Class-wise greedy NMS on intersection over the smaller box. A kept box absorbs (union) the boxes it
+    suppresses if either was cut by a tile edge, so objects split across tiles come back whole.
+    Returns (boxes, scores, classes) of the kept detections.
+    '''
+    if len(boxes) == 0:
+        return boxes, scores, classes
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    top_left = np.maximum(boxes[:, None, :2], boxes[None, :, :2])
+    bottom_right = np.minimum(boxes[:, None, 2:], boxes[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis = 2)
+    smaller = np.minimum(areas[:, None], areas[None, :])
+    overlap = intersection / np.maximum(smaller, 1e-9)
+    overlap = np.where(classes[:, None] == classes[None, :], overlap, 0.0)
+
+    merged = boxes.copy()
+    suppressed = np.zeros(len(boxes), dtype = bool)
+    keep = []
+    for i in np.argsort(-scores):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        duplicates = np.flatnonzero((overlap[i] > threshold) & ~suppressed)
+        duplicates = duplicates[duplicates != i]
+        suppressed[duplicates] = True
+        partial = duplicates[cut[duplicates]] if not cut[i] else duplicates
+        if len(partial):
+            merged[i, :2] = np.minimum(merged[i, :2], boxes[partial, :2].min(axis = 0))
+            merged[i, 2:] = np.maximum(merged[i, 2:], boxes[partial, 2:].max(axis = 0))
+    keep = np.array(keep, dtype = np.int64)
+    return merged[keep], scores[keep], classes[keep]
+
+
+class TiledPredictor:
+    '''
+    model --> loaded YOLO model
+    regions --> list of (name, (x1, y1, x2, y2)) apron regions in frame pixels, empty for the whole frame
+    tile_size --> tile edge in pixels (and model input size)
+    overlap --> fraction of a tile shared with its neighbour
+    full_frame --> also run the downscaled full frame in the same batch (large objects)
+    merge_threshold --> intersection over the smaller box above which two detections are the same object
+    edge_margin --> boxes within this many pixels of an inner tile edge count as cut
+    '''
+    def __init__(self, model, regions = (), tile_size = 640, overlap = 0.2, conf = 0.7, device = 'cpu',
+                 full_frame = True, merge_threshold = 0.5, edge_margin = 4):
+        self.model = model
+        self.regions = list(regions)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.conf = conf
+        self.device = device
+        self.full_frame = full_frame
+        self.merge_threshold = merge_threshold
+        self.edge_margin = edge_margin
+
+        self._tiles = None
+        self._frame_shape = None
+
+    def tiles(self, frame_shape):
+        if self._frame_shape != frame_shape[:2]:
+            self._tiles = make_tiles(self.regions, frame_shape, self.tile_size, self.overlap)
+            self._frame_shape = frame_shape[:2]
+        return self._tiles
+
+    def _inside_regions(self, centers):
+        if not self.regions:
+            return np.ones(len(centers), dtype = bool)
+        inside = np.zeros(len(centers), dtype = bool)
+        for _, (x1, y1, x2, y2) in self.regions:
+            inside |= (centers[:, 0] >= x1) & (centers[:, 0] < x2) & (centers[:, 1] >= y1) & (centers[:, 1] < y2)
+        return inside
+
+    def predict(self, frame, path = ''):
+        height, width = frame.shape[:2]
+        tiles = self.tiles(frame.shape)
+        crops = [frame[y1:y2, x1:x2] for x1, y1, x2, y2 in tiles]
+        if self.full_frame:
+            crops.append(frame)
+
+        # All tiles of the frame in one forward pass
+        results = self.model.predict(source = crops, imgsz = self.tile_size, conf = self.conf, device = self.device,
+                                     verbose = False, stream = False)
+
+        boxes, scores, classes, cut = [], [], [], []
+        for index, result in enumerate(results):
+            data = result.boxes.data.cpu().numpy()
+            if len(data) == 0:
+                continue
+            xyxy = data[:, :4].astype(np.float64)
+            if index < len(tiles):
+                x1, y1, x2, y2 = tiles[index]
+                xyxy += (x1, y1, x1, y1)
+                # Cut by an inner tile edge (frame borders are not cuts)
+                margin = self.edge_margin
+                cut.append(((xyxy[:, 0] <= x1 + margin) & (x1 > 0)) | ((xyxy[:, 1] <= y1 + margin) & (y1 > 0)) |
+                           ((xyxy[:, 2] >= x2 - margin) & (x2 < width)) | ((xyxy[:, 3] >= y2 - margin) & (y2 < height)))
+            else:
+                cut.append(np.zeros(len(xyxy), dtype = bool))
+            boxes.append(xyxy)
+            scores.append(data[:, 4])
+            classes.append(data[:, 5])
+
+        if boxes:
+            boxes, scores, classes = merge_detections(np.concatenate(boxes), np.concatenate(scores),
+                                                      np.concatenate(classes), np.concatenate(cut),
+                                                      self.merge_threshold)
+            centers = (boxes[:, :2] + boxes[:, 2:]) / 2
+            inside = self._inside_regions(centers)
+            data = np.column_stack((boxes[inside], scores[inside], classes[inside]))
+        else:
+            data = np.empty((0, 6))
+
+        return Results(frame, path = path, names = self.model.names, boxes = torch.as_tensor(data, dtype = torch.float32))
+
+
+def box_polygons(boxes):
+    '''(n, 4) boxes x1, y1, x2, y2 --> list of (4, 2) corner polygons, the input of annotation_qa.iou_matrix'''
+    return [np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]]) for x1, y1, x2, y2 in boxes]
+
+
+def label_boxes(path, frame_shape):
+    '''
+    YOLO polygon label file --> (classes, (n, 4) bounding boxes in pixels of a frame of frame_shape)
+    '''
+    height, width = frame_shape[:2]
+    polygons = parse_label_file(path)
+    classes = np.array([class_id for class_id, _ in polygons], dtype = np.int64)
+    boxes = np.array([np.concatenate((vertices.min(axis = 0), vertices.max(axis = 0))) for _, vertices in polygons],
+                     dtype = np.float64).reshape(-1, 4)
+    return classes, boxes * (width, height, width, height)
+
+
+def count_matches(label_classes, label_boxes, pred_classes, pred_boxes, num_classes, iou_threshold = 0.5):
+    '''
+    Correct detections per class of one frame: predictions greedily matched to a label of their class with
+    box IoU >= iou_threshold, every label matched at most once
+    '''
+    ious = iou_matrix(box_polygons(label_boxes), box_polygons(pred_boxes))
+    matches = np.zeros(num_classes, dtype = np.int64)
+    for class_id in np.intersect1d(label_classes, pred_classes).tolist():
+        matched = greedy_match(ious[np.ix_(label_classes == class_id, pred_classes == class_id)])
+        matches[class_id] = np.count_nonzero(matched >= iou_threshold)
+    return matches
+
+
+def compare(model, frames_dir, regions, tile_size = 640, full_imgsz = 1280, max_frames = 30, conf = 0.7,
+            labels_dir = None, iou_threshold = 0.5):
+    '''
+    Latency and detections per class of tiled vs full-frame inference over full resolution frames.
+    labels_dir --> YOLO polygon labels of the frames; only labelled frames are used, and precision / recall per
+    class are reported for both modes. Returns {mode: {'p50_ms', 'p95_ms', 'detections', 'matches'}} (per class arrays).
+    '''
+    names = sorted(name for name in os.listdir(frames_dir) if name.lower().endswith('.jpg'))
+    if labels_dir is not None:
+        names = [name for name in names if os.path.exists(label_path(labels_dir, name))]
+    names = names[:max_frames]
+    frames = [cv2.imread(os.path.join(frames_dir, name)) for name in names]
+    tiler = TiledPredictor(model, regions, tile_size = tile_size, conf = conf)
+    print (f'{len(tiler.tiles(frames[0].shape))} tiles of {tile_size}px per {frames[0].shape[1]}x{frames[0].shape[0]} frame')
+
+    num_classes = len(model.names)
+    truth = None
+    if labels_dir is not None:
+        truth = [label_boxes(label_path(labels_dir, name), frame.shape) for name, frame in zip(names, frames)]
+        labels = sum(np.bincount(classes, minlength = num_classes) for classes, _ in truth)
+    else:
+        print ('No --labels: detection counts only, accuracy is not measured')
+
+    runs = {'full frame': lambda frame: model.predict(source = frame, imgsz = full_imgsz, conf = conf, verbose = False)[0],
+            'tiled': tiler.predict}
+    report = {}
+    for name, run in runs.items():
+        run(frames[0])
+        durations = []
+        counts = np.zeros(num_classes, dtype = np.int64)
+        matches = np.zeros(num_classes, dtype = np.int64)
+        for index, frame in enumerate(frames):
+            start = time.perf_counter()
+            result = run(frame)
+            durations.append(time.perf_counter() - start)
+
+            classes = result.boxes.cls.cpu().numpy().astype(int)
+            counts += np.bincount(classes, minlength = num_classes)
+            if truth is not None:
+                matches += count_matches(*truth[index], classes, result.boxes.xyxy.cpu().numpy(), num_classes,
+                                         iou_threshold)
+        durations = np.array(durations) * 1000
+        per_class = ', '.join(f'{model.names[i]}: {count}' for i, count in enumerate(counts) if count)
+        print (f'{name:<10} p50 {np.percentile(durations, 50):.0f} ms, p95 {np.percentile(durations, 95):.0f} ms | {per_class}')
+        report[name] = {'p50_ms': float(np.percentile(durations, 50)), 'p95_ms': float(np.percentile(durations, 95)),
+                        'detections': counts, 'matches': matches}
+
+    if truth is not None:
+        print (f"{'class':<18} {'labels':>7} " + ' '.join(f'{name + " P":>12} {name + " R":>12}' for name in runs))
+        for class_id in range(num_classes):
+            if not labels[class_id] and not any(report[name]['detections'][class_id] for name in runs):
+                continue
+            line = f'{model.names[class_id]:<18} {labels[class_id]:>7} '
+            for name in runs:
+                detections, matched = report[name]['detections'][class_id], report[name]['matches'][class_id]
+                precision = matched / detections if detections else float('nan')
+                recall = matched / labels[class_id] if labels[class_id] else float('nan')
+                line += f'{precision:>12.2f} {recall:>12.2f} '
+            print (line.rstrip())
+    return report
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Tiled Inference')
+
+    # Arguments
+    parser.add_argument('--weights', type = str, default = 'weights/last.pt', help = 'Model weights, default = weights/last.pt')
+    parser.add_argument('--frames', type = str, default = os.path.join('Data', '08_11_2023'), help = 'Folder of full resolution frames, default = Data/08_11_2023')
+    parser.add_argument('--regions', type = str, default = None, help = 'Apron regions JSON, default = whole frame')
+    parser.add_argument('--tile_size', type = int, default = 640, help = 'Tile size in pixels, default = 640')
+    parser.add_argument('--full_imgsz', type = int, default = 1280, help = 'Input size of the full-frame baseline, default = 1280')
+    parser.add_argument('--max_frames', type = int, default = 30, help = 'Frames to compare, default = 30')
+    parser.add_argument('--labels', type = str, default = None, help = 'YOLO polygon labels of the frames (e.g. valid/labels of the dataset) to report precision and recall per class')
+    parser.add_argument('--iou', type = float, default = 0.5, help = 'Box IoU for a detection to match a label with --labels, default = 0.5')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    regions = load_regions(args.regions) if args.regions else []
+    compare(YOLO(args.weights), args.frames, regions, tile_size = args.tile_size, full_imgsz = args.full_imgsz,
+            max_frames = args.max_frames, labels_dir = args.labels, iou_threshold = args.iou)
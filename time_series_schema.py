@@ -0,0 +1,262 @@
+import time
+import numpy as np
+
+from hdf5_writer import BufferedDatasetWriter
+
+'''
+Compact storage schema for the time-series data.
+
+Instead of one 16 x float64 row (128 bytes) per detection, the compact layout stores three tables:
+
+    frames      | timestamp_us (int64, unix microseconds UTC) | weather (int32, row in `weather`, -1 if missing) |
+                | flags (uint8, FRAME_PREDICTED: detections carried forward without inference) |
+    detections  | frame (uint32, row in `frames`) | track_id (uint32) | cls (uint8) | x (float32) | y (float32) |
+    weather     | observed_at (float64) | fetched_at (float64) | temperature_2m | relative_humidity_2m | rain |
+                | showers | snowfall | cloud_cover (float32) |
+
+A detection costs 17 bytes, a frame 13 bytes and a weather row is only added when a new observation was fetched.
+`read_flat` rebuilds the original flat layout (FLAT_COLUMNS), so existing consumers keep working:
+
+    with h5py.File('Raw_Time_Series_Data/tracking_data_compact.h5', 'r') as file:
+        data = read_tracking_data(file)        # works for both layouts
+'''
+
+FLAT_COLUMNS = ['Date', 'Hour', 'Minute', 'Seconds', 'Microseconds', 'Time Norm', 'Track_ID', 'Object Class', 'X', 'Y',
+                'Temp', 'Humidity', 'Rain', 'Showers', 'Snowfall', 'Cloud Cover']
+NUM_FLAT_COLUMNS = len(FLAT_COLUMNS)
+
+FRAME_DTYPE = np.dtype([('timestamp_us', np.int64), ('weather', np.int32), ('flags', np.uint8)])
+
+# Frame flags
+FRAME_PREDICTED = 1
+
+DETECTION_DTYPE = np.dtype([('frame', np.uint32), ('track_id', np.uint32), ('cls', np.uint8),
+                            ('x', np.float32), ('y', np.float32)])
+
+WEATHER_FIELDS = ['temperature_2m', 'relative_humidity_2m', 'rain', 'showers', 'snowfall', 'cloud_cover']
+WEATHER_DTYPE = np.dtype([('observed_at', np.float64), ('fetched_at', np.float64)] +
+                         [(field, np.float32) for field in WEATHER_FIELDS])
+
+# Timestamps are stored in UTC, the flat layout is in GMT+1
+UTC_OFFSET_HOURS = 1
+
+# Stored in the 'schema_version' attribute of compact files; version 1 frames have no flags column
+SCHEMA_VERSION = 2
+
+
+def is_compact(file):
+    return 'detections' in file and 'frames' in file
+
+
+def migrate_frames(file, block_rows = 1 << 20):
+    '''
+    Rewrite a version 1 frames table (no flags column) with FRAME_DTYPE, flags = 0, keeping its chunking and
+    compression. Must run before SWMR mode is enabled. Returns True if the table was migrated.
+    '''
+    if 'frames' not in file or file['frames'].dtype == FRAME_DTYPE:
+        return False
+
+    old = file['frames']
+    new = file.create_dataset('frames_migrating', shape = old.shape, maxshape = (None,), chunks = old.chunks,
+                              dtype = FRAME_DTYPE, compression = old.compression,
+                              compression_opts = old.compression_opts, shuffle = old.shuffle)
+    for start in range(0, old.shape[0], block_rows):
+        rows = old[start:start + block_rows]
+        block = np.zeros(len(rows), dtype = FRAME_DTYPE)
+        for name in rows.dtype.names:
+            block[name] = rows[name]
+        new[start:start + len(rows)] = block
+
+    del file['frames']
+    file.move('frames_migrating', 'frames')
+    return True
+
+
+class CompactTrackingWriter:
+    '''
+    Writes frames, detections and weather observations into the compact layout using buffered HDF5 writers.
+    flush_interval --> write all buffered tables at least every this many seconds
+    Other keyword arguments (chunk_rows, compression, ...) are passed on to BufferedDatasetWriter.
+
+    Enable SWMR mode only after constructing the writer, as the datasets are created here. Files written before
+    the frames table had a flags column are migrated first (see migrate_frames).
+    '''
+    def __init__(self, file, flush_interval = 1.0, **writer_kwargs):
+        self.file = file
+        if 'utc_offset_hours' not in file.attrs:
+            file.attrs['utc_offset_hours'] = UTC_OFFSET_HOURS
+        if migrate_frames(file):
+            print (f'Migrated the frames table of {file.filename} to schema version {SCHEMA_VERSION}')
+        file.attrs['schema_version'] = SCHEMA_VERSION
+
+        # Time based flushes are done here for all tables at once, in dependency order
+        writer_kwargs['flush_interval'] = None
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+
+        self.frames = BufferedDatasetWriter(file, 'frames', dtype = FRAME_DTYPE, **writer_kwargs)
+        self.detections = BufferedDatasetWriter(file, 'detections', dtype = DETECTION_DTYPE, **writer_kwargs)
+        weather_kwargs = dict(writer_kwargs, chunk_rows = 256)
+        self.weather = BufferedDatasetWriter(file, 'weather', dtype = WEATHER_DTYPE, **weather_kwargs)
+
+        self._next_frame = self.frames.dataset.shape[0]
+        self._next_weather = self.weather.dataset.shape[0]
+        self._last_fetched_at = None
+
+        self._frame_row = np.zeros(1, dtype = FRAME_DTYPE)
+        self._weather_row = np.zeros(1, dtype = WEATHER_DTYPE)
+
+    def _weather_index(self, observation):
+        '''
+        Row of the observation in the weather table, appending it if it hasn't been stored yet. -1 if missing/stale.
+        '''
+        if observation is None or observation.stale:
+            return -1
+
+        if observation.fetched_at != self._last_fetched_at:
+            row = self._weather_row
+            row['observed_at'] = observation.observed_at
+            row['fetched_at'] = observation.fetched_at
+            for field, value in zip(WEATHER_FIELDS, observation.values):
+                row[field] = value
+            self.weather.append(row)
+
+            self._last_fetched_at = observation.fetched_at
+            self._next_weather += 1
+
+        return self._next_weather - 1
+
+    def append_frame(self, timestamp_us, weather, track_ids, classes, x, y, predicted = False):
+        '''
+        timestamp_us --> frame time in unix microseconds (UTC)
+        weather --> WeatherObservation (see weather_provider.py) or None
+        track_ids, classes, x, y --> per-detection arrays of equal length
+        predicted --> detections were carried forward from an earlier frame (see motion_gate.py)
+        Returns the frame index.
+        '''
+        frame_index = self._next_frame
+
+        self._frame_row['timestamp_us'] = timestamp_us
+        self._frame_row['weather'] = self._weather_index(weather)
+        self._frame_row['flags'] = FRAME_PREDICTED if predicted else 0
+        # A frame must never reach the file before the weather row it references
+        if len(self.frames) + 1 >= self.frames.flush_rows:
+            self.weather.flush()
+        self.frames.append(self._frame_row)
+        self._next_frame += 1
+
+        n = len(track_ids)
+        if n:
+            rows = np.empty(n, dtype = DETECTION_DTYPE)
+            rows['frame'] = frame_index
+            rows['track_id'] = track_ids
+            rows['cls'] = classes
+            rows['x'] = x
+            rows['y'] = y
+            # ... and detections never before their frame
+            if len(self.detections) + n >= self.detections.flush_rows:
+                self.weather.flush()
+                self.frames.flush()
+            self.detections.append(rows)
+
+        if self.flush_interval is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+        return frame_index
+
+    def flush(self):
+        # Weather and frames first, so readers never see detections referencing rows that aren't written yet
+        self.weather.flush()
+        self.frames.flush()
+        self.detections.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def split_timestamps(timestamp_us, utc_offset_hours = UTC_OFFSET_HOURS):
+    '''
+    Vectorised conversion of unix microseconds to the flat time columns (GMT+1 by default):
+    returns date (YYYYMMDD), hour, minute, seconds, microseconds, time normalized as float64 arrays
+    '''
+    local_us = np.asarray(timestamp_us, dtype = np.int64) + int(utc_offset_hours * 3600 * 1000000)
+    days, us_of_day = np.divmod(local_us, 86400 * 1000000)
+
+    day = days.astype('datetime64[D]')
+    month = day.astype('datetime64[M]')
+    year = month.astype('datetime64[Y]').astype(np.int64) + 1970
+    month_of_year = month.astype(np.int64) % 12 + 1
+    day_of_month = (day - month).astype(np.int64) + 1
+    date = year * 10000 + month_of_year * 100 + day_of_month
+
+    seconds_of_day, microseconds = np.divmod(us_of_day, 1000000)
+    hour, rest = np.divmod(seconds_of_day, 3600)
+    minute, seconds = np.divmod(rest, 60)
+
+    time_normalized = (hour + minute/60.0 + seconds/3600.0 + microseconds/(60*60*1000000))/24
+
+    return (date.astype(np.float64), hour.astype(np.float64), minute.astype(np.float64),
+            seconds.astype(np.float64), microseconds.astype(np.float64), time_normalized)
+
+
+def detections_to_flat(detections, frames, weather, utc_offset_hours = UTC_OFFSET_HOURS):
+    '''
+    Join detection rows with their frame and weather rows into the flat (n, 16) float64 layout.
+    frames and weather must contain every row referenced by the detections (e.g. the full tables).
+    '''
+    out = np.empty((len(detections), NUM_FLAT_COLUMNS), dtype = np.float64)
+    if len(detections) == 0:
+        return out
+
+    frame_rows = frames[detections['frame']]
+    out[:, 0:6] = np.column_stack(split_timestamps(frame_rows['timestamp_us'], utc_offset_hours))
+    out[:, 6] = detections['track_id']
+    out[:, 7] = detections['cls']
+    out[:, 8] = detections['x']
+    out[:, 9] = detections['y']
+
+    weather_index = frame_rows['weather']
+    has_weather = weather_index >= 0
+    out[:, 10:] = np.nan
+    if has_weather.any():
+        weather_rows = weather[weather_index[has_weather]]
+        for column, field in enumerate(WEATHER_FIELDS, start = 10):
+            out[has_weather, column] = weather_rows[field]
+
+    return out
+
+
+def read_flat(file, start = 0, stop = None):
+    '''
+    Rebuild the flat 16-column layout for detections[start:stop] of a compact file
+    '''
+    detections = file['detections'][start:stop]
+    if len(detections) == 0:
+        return np.empty((0, NUM_FLAT_COLUMNS), dtype = np.float64)
+
+    # Only read the frame range these detections refer to
+    first, last = int(detections['frame'].min()), int(detections['frame'].max())
+    frames = file['frames'][first:last + 1]
+    detections = detections.copy()
+    detections['frame'] -= first
+
+    weather = file['weather'][:] if 'weather' in file else np.empty(0, dtype = WEATHER_DTYPE)
+    return detections_to_flat(detections, frames, weather, file.attrs.get('utc_offset_hours', UTC_OFFSET_HOURS))
+
+
+def read_tracking_data(file, start = 0, stop = None):
+    '''
+    Read rows [start:stop] in the flat 16-column layout from either a flat or a compact file
+    '''
+    if is_compact(file):
+        return read_flat(file, start, stop)
+    if 'tracking_data' in file:
+        return file['tracking_data'][start:stop]
+    return np.empty((0, NUM_FLAT_COLUMNS), dtype = np.float64)
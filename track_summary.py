@@ -0,0 +1,237 @@
+from collections import namedtuple
+
+import numpy as np
+
+'''
+Multi-resolution summaries of the tracks for live dashboards (Extras/live_tracker.py).
+
+Plotting every raw centroid gets slower with every second of history. TrackSummaries keeps, per track and per level,
+one row per time bucket with the sample count and the min / max / sum of x and y. Bucket widths grow geometrically
+(default 1 s, 4 s, 16 s, ... 16384 s), every level is updated incrementally from the new rows of a tick, and a query
+returns the finest level that still fits the requested number of points (e.g. the axes width in pixels), so the
+cost of a redraw depends on the screen, not on how long the tracker has been running.
+
+    summaries = TrackSummaries()
+    summaries.append(track_ids, classes, seconds, xs, ys)               # rows of one tick, any order of tracks
+    summary = summaries.query(track_id, t0, t1, points = 800)             # Summary(time, mean, low, high, width)
+    for track_id in summaries.recent(t0): ...                              # tracks with samples after t0
+    summaries = TrackSummaries(retention = 3600)                           # forget tracks idle for an hour
+
+Samples older than a track's last bucket are merged into that bucket, and the finest levels only keep their newest
+max_buckets buckets; queries reaching further back fall through to a coarser level.
+'''
+
+# Columns of a level table
+BUCKET, COUNT, SUM_X, SUM_Y, MIN_X, MIN_Y, MAX_X, MAX_Y = range(8)
+NUM_SUMMARY_COLUMNS = 8
+
+# time --> bucket centres, mean / low / high --> (n, 2) x and y, width --> bucket width of the level used
+Summary = namedtuple('Summary', ['time', 'mean', 'low', 'high', 'width'])
+
+
+def flat_seconds(dates, time_normalized):
+    '''
+    Seconds since 1970-01-01 on the clock of the flat layout (GMT+1) from its Date (YYYYMMDD) and Time Norm columns
+    '''
+    dates = np.asarray(dates, dtype = np.int64)
+    years, rest = np.divmod(dates, 10000)
+    months, days = np.divmod(rest, 100)
+    month_start = (years - 1970) * 12 + (months - 1)
+    day = month_start.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + days - 1
+    return day * 86400.0 + np.asarray(time_normalized, dtype = np.float64) * 86400.0
+
+
+class TrackSummaries:
+    '''
+    base_width --> bucket width of the finest level, in the unit of the times passed to append (seconds)
+    factor --> each level's buckets are this many times wider than the previous level's
+    levels --> number of levels
+    max_buckets --> buckets kept per track and level, the oldest are dropped beyond that
+    retention --> drop tracks without samples in the last `retention` time units (None: keep all, see evict)
+    '''
+    def __init__(self, base_width = 1.0, factor = 4, levels = 8, max_buckets = 20000, retention = None):
+        self.widths = [base_width * factor ** level for level in range(levels)]
+        self.max_buckets = max_buckets
+        self.retention = retention
+        self.classes = {}
+
+        # track ID --> one (capacity, NUM_SUMMARY_COLUMNS) table and its number of used rows per level
+        self._tables = {}
+        self._sizes = {}
+        self._start = {}
+
+        # track ID --> last sample time
+        self._last = {}
+
+        # track ID --> newest sample time of any track when it was last updated, ordered by update (re-inserted on
+        # every append). The values never decrease along the order and are at least the track's own last time, so
+        # recent() and evict() can stop at the first value outside their range even if a track got old samples.
+        self._updated = {}
+
+        # Time of the newest sample of any track (None before the first append)
+        self.latest = None
+
+    def __contains__(self, track_id):
+        return track_id in self._tables
+
+    def __iter__(self):
+        return iter(self._tables)
+
+    def time_range(self, track_id):
+        '''(first, last) sample time of a track'''
+        return self._start[track_id], self._last[track_id]
+
+    def recent(self, t0):
+        '''
+        Tracks with samples at or after t0, most recently updated first. Walks back from the newest update and stops
+        once the newest time at the update was before t0, so the cost is the number of recently updated tracks, not
+        all tracks ever seen. Tracks that only received old samples (e.g. backfilled rows) are skipped, not a stop.
+        '''
+        tracks = []
+        for track_id in reversed(self._updated):
+            if self._updated[track_id] < t0:
+                break
+            if self._last[track_id] >= t0:
+                tracks.append(track_id)
+        return tracks
+
+    def evict(self, t0):
+        '''
+        Drop every track updated last while the newest time was before t0 (so its last sample is older too).
+        Returns the number of tracks dropped.
+        '''
+        old = []
+        for track_id, updated in self._updated.items():
+            if updated >= t0:
+                break
+            old.append(track_id)
+        for track_id in old:
+            for table in (self._tables, self._sizes, self._start, self._last, self._updated, self.classes):
+                del table[track_id]
+        return len(old)
+
+    def append(self, track_ids, classes, times, xs, ys):
+        '''
+        Add new samples; arrays of equal length, any order of tracks.
+        Returns the set of track IDs that received samples.
+        '''
+        if len(track_ids) == 0:
+            return set()
+
+        # Group rows by track, then by time, with one sort
+        order = np.lexsort((times, track_ids))
+        sorted_ids = np.asarray(track_ids)[order]
+        unique_ids, starts = np.unique(sorted_ids, return_index = True)
+        stops = np.append(starts[1:], len(sorted_ids))
+
+        times = np.asarray(times, dtype = np.float64)[order]
+        xy = np.column_stack((xs, ys)).astype(np.float64)[order]
+        sorted_classes = np.asarray(classes)[order]
+
+        for track_id, start, stop in zip(unique_ids.tolist(), starts, stops):
+            self._append_track(track_id, times[start:stop], xy[start:stop])
+            self.classes[track_id] = int(sorted_classes[stop - 1])
+            self._last[track_id] = max(self._last.get(track_id, times[stop - 1]), times[stop - 1])
+        updated = unique_ids.tolist()
+        newest = max(self._last[track_id] for track_id in updated)
+        self.latest = newest if self.latest is None else max(self.latest, newest)
+
+        # Re-inserted in ascending order of their last time, so the newest track of the tick is the most recent
+        for track_id in sorted(updated, key = self._last.get):
+            self._updated.pop(track_id, None)
+            self._updated[track_id] = self.latest
+
+        if self.retention is not None:
+            self.evict(self.latest - self.retention)
+        return set(updated)
+
+    def _append_track(self, track_id, times, xy):
+        if track_id not in self._tables:
+            # Tables start empty and grow with their level's buckets; the coarse levels of most tracks hold a few
+            self._tables[track_id] = [np.empty((0, NUM_SUMMARY_COLUMNS)) for _ in self.widths]
+            self._sizes[track_id] = [0] * len(self.widths)
+            self._start[track_id] = times[0]
+        self._start[track_id] = min(self._start[track_id], times[0])
+
+        for level, width in enumerate(self.widths):
+            buckets = np.floor(times / width)
+            starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+
+            rows = np.empty((len(starts), NUM_SUMMARY_COLUMNS))
+            rows[:, BUCKET] = buckets[starts]
+            rows[:, COUNT] = np.diff(np.append(starts, len(buckets)))
+            rows[:, SUM_X:SUM_Y + 1] = np.add.reduceat(xy, starts)
+            rows[:, MIN_X:MIN_Y + 1] = np.minimum.reduceat(xy, starts)
+            rows[:, MAX_X:MAX_Y + 1] = np.maximum.reduceat(xy, starts)
+            self._merge(track_id, level, rows)
+
+    def _merge(self, track_id, level, rows):
+        table = self._tables[track_id][level]
+        size = self._sizes[track_id][level]
+
+        # Rows that fall into (or before) the last bucket update it in place
+        if size:
+            last = table[size - 1]
+            late = rows[:, BUCKET] <= last[BUCKET]
+            if late.any():
+                merged = rows[late]
+                last[COUNT] += merged[:, COUNT].sum()
+                last[SUM_X:SUM_Y + 1] += merged[:, SUM_X:SUM_Y + 1].sum(axis = 0)
+                last[MIN_X:MIN_Y + 1] = np.minimum(last[MIN_X:MIN_Y + 1], merged[:, MIN_X:MIN_Y + 1].min(axis = 0))
+                last[MAX_X:MAX_Y + 1] = np.maximum(last[MAX_X:MAX_Y + 1], merged[:, MAX_X:MAX_Y + 1].max(axis = 0))
+                rows = rows[~late]
+
+        rows = rows[-self.max_buckets:]
+        n = len(rows)
+        if n == 0:
+            return
+
+        if size + n > len(table):
+            # Same growth as tracking_reader.TrackBuffers: double up to 2 x max_buckets, then drop the oldest
+            keep = min(size, self.max_buckets - n)
+            capacity = max(len(table), 4)
+            while capacity < keep + n:
+                capacity *= 2
+            capacity = max(min(capacity, 2 * self.max_buckets), keep + n)
+
+            new_table = np.empty((capacity, NUM_SUMMARY_COLUMNS))
+            if keep:
+                new_table[:keep] = table[size - keep:size]
+            table, size = new_table, keep
+            self._tables[track_id][level] = table
+
+        table[size:size + n] = rows
+        self._sizes[track_id][level] = size + n
+
+    def level_for(self, track_id, t0, t1, points):
+        '''
+        Finest level with at most `points` buckets between t0 and t1 that still holds the track's data from t0 on
+        '''
+        t0 = max(t0, self._start[track_id])
+        for level, width in enumerate(self.widths):
+            if (t1 - t0) / width > points:
+                continue
+            table = self._tables[track_id][level]
+            if table[0, BUCKET] * width <= t0 or level == len(self.widths) - 1:
+                return level
+        return len(self.widths) - 1
+
+    def query(self, track_id, t0 = None, t1 = None, points = 1000):
+        '''
+        Summary of a track between t0 and t1 (default: its whole history) with at most about `points` buckets
+        '''
+        first, last = self.time_range(track_id)
+        t0 = first if t0 is None else t0
+        t1 = last if t1 is None else t1
+
+        level = self.level_for(track_id, t0, t1, points)
+        width = self.widths[level]
+        table = self._tables[track_id][level][:self._sizes[track_id][level]]
+
+        buckets = table[:, BUCKET]
+        start = np.searchsorted(buckets, np.floor(t0 / width))
+        stop = np.searchsorted(buckets, np.floor(t1 / width), side = 'right')
+        rows = table[start:stop]
+        count = rows[:, COUNT:COUNT + 1]
+        return Summary((rows[:, BUCKET] + 0.5) * width, rows[:, SUM_X:SUM_Y + 1] / count,
+                       rows[:, MIN_X:MIN_Y + 1], rows[:, MAX_X:MAX_Y + 1], width)
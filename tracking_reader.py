@@ -0,0 +1,216 @@
+import os
+import numpy as np
+import h5py
+
+from time_series_schema import (is_compact, detections_to_flat, NUM_FLAT_COLUMNS, WEATHER_DTYPE,
+                                UTC_OFFSET_HOURS)
+
+'''
+Incremental (tail-follow) reader for the time-series HDF5 file written by generate_time_series.py.
+
+The file is opened once in SWMR read mode; every call to `read_new()` refreshes the datasets and reads only the
+rows appended since the previous call, so the cost of a tick is proportional to the new rows, not the history.
+Rows are returned in the flat 16-column layout for both the flat and the compact schema.
+
+    tail = TrackingTail('Raw_Time_Series_Data/tracking_data.h5')
+    rows = tail.read_new()      # only new rows
+    columns = tail.columns      # column indices for the layout of this file (handles the old 15 column layout)
+
+TrackBuffers keeps a rolling window of (time, x, y) per track for plotting.
+'''
+
+# Column indices of the flat 16-column layout
+FLAT_COLUMN_INDEX = {'date': 0, 'hour': 1, 'minute': 2, 'seconds': 3, 'microseconds': 4, 'time': 5,
+                     'track_id': 6, 'class': 7, 'x': 8, 'y': 9}
+
+# The old 15-column layout (Raw_Time_Series_Data/old_tracking_data.h5) has no microseconds column
+LEGACY_COLUMN_INDEX = {'date': 0, 'hour': 1, 'minute': 2, 'seconds': 3, 'time': 4,
+                       'track_id': 5, 'class': 6, 'x': 7, 'y': 8}
+
+
+def column_index(num_columns):
+    return LEGACY_COLUMN_INDEX if num_columns == NUM_FLAT_COLUMNS - 1 else FLAT_COLUMN_INDEX
+
+
+class TrackingTail:
+    '''
+    hdf5_file_path --> file written by generate_time_series.py (flat or compact schema)
+    start_at_end --> skip the existing history and only return rows written from now on
+    '''
+    def __init__(self, hdf5_file_path, start_at_end = False):
+        self.hdf5_file_path = hdf5_file_path
+        self.start_at_end = start_at_end
+        self.file = None
+        self.offset = 0
+        self.columns = FLAT_COLUMN_INDEX
+
+        self._compact = False
+        self._datasets = {}
+        self._frames = None
+        self._frames_start = 0
+        self._weather = np.empty(0, dtype = WEATHER_DTYPE)
+        self._utc_offset_hours = UTC_OFFSET_HOURS
+
+    def _open(self):
+        '''
+        Open the file once it exists and contains data. Returns True if the file is open.
+        '''
+        if self.file is not None:
+            return True
+        if not os.path.exists(self.hdf5_file_path):
+            return False
+
+        file = h5py.File(self.hdf5_file_path, 'r', libver = 'latest', swmr = True)
+        if is_compact(file):
+            self._compact = True
+            self._datasets = {name: file[name] for name in ('frames', 'detections', 'weather') if name in file}
+            self._utc_offset_hours = file.attrs.get('utc_offset_hours', UTC_OFFSET_HOURS)
+            self.columns = FLAT_COLUMN_INDEX
+        elif 'tracking_data' in file:
+            self._datasets = {'tracking_data': file['tracking_data']}
+            self.columns = column_index(file['tracking_data'].shape[1])
+        else:
+            file.close()
+            return False
+
+        self.file = file
+        if self.start_at_end:
+            self.offset = self._main_dataset().shape[0]
+        return True
+
+    def _main_dataset(self):
+        return self._datasets['detections' if self._compact else 'tracking_data']
+
+    def _read_compact(self, start, stop):
+        detections = self._datasets['detections'][start:stop]
+        if len(detections) == 0:
+            return np.empty((0, NUM_FLAT_COLUMNS), dtype = np.float64)
+
+        # Keep the frame rows from the first frame still referenced onwards, and only read frames we haven't seen
+        first, last = int(detections['frame'].min()), int(detections['frame'].max())
+        frames = self._frames
+        known_stop = self._frames_start + (0 if frames is None else len(frames))
+        if frames is None or first < self._frames_start or first >= known_stop:
+            frames = self._datasets['frames'][first:last + 1]
+            self._frames_start = first
+        else:
+            frames = frames[first - self._frames_start:]
+            if last >= known_stop:
+                new_frames = self._datasets['frames'][known_stop:last + 1]
+                frames = np.concatenate((frames, new_frames))
+            self._frames_start = first
+        self._frames = frames
+
+        # The weather table is small and only grows, append the new observations
+        if 'weather' in self._datasets:
+            weather_size = self._datasets['weather'].shape[0]
+            if weather_size > len(self._weather):
+                self._weather = np.concatenate((self._weather, self._datasets['weather'][len(self._weather):weather_size]))
+
+        detections['frame'] -= first
+        return detections_to_flat(detections, frames, self._weather, self._utc_offset_hours)
+
+    def read_new(self):
+        '''
+        Rows appended since the last call, in the flat layout (see self.columns for column indices)
+        '''
+        if not self._open():
+            return np.empty((0, NUM_FLAT_COLUMNS), dtype = np.float64)
+
+        for dataset in self._datasets.values():
+            dataset.refresh()
+
+        stop = self._main_dataset().shape[0]
+        if stop <= self.offset:
+            return np.empty((0, self._main_dataset().shape[1] if not self._compact else NUM_FLAT_COLUMNS), dtype = np.float64)
+
+        if self._compact:
+            rows = self._read_compact(self.offset, stop)
+        else:
+            rows = self._datasets['tracking_data'][self.offset:stop]
+
+        self.offset = stop
+        return rows
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class TrackBuffers:
+    '''
+    Rolling (time, x, y) buffers per track ID, capped at max_points samples per track.
+    Appending a tick's rows is amortised O(new rows).
+    '''
+    def __init__(self, max_points = 100000):
+        self.max_points = max_points
+        self.classes = {}
+        self._data = {}
+        self._size = {}
+
+    def __contains__(self, track_id):
+        return track_id in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def append(self, track_ids, classes, times, xs, ys):
+        '''
+        Append new samples; arrays of equal length, any order of tracks
+        Returns the set of track IDs that received samples.
+        '''
+        if len(track_ids) == 0:
+            return set()
+
+        # Group rows by track with one sort instead of a mask per track
+        order = np.argsort(track_ids, kind = 'stable')
+        sorted_ids = track_ids[order]
+        unique_ids, starts = np.unique(sorted_ids, return_index = True)
+        stops = np.append(starts[1:], len(sorted_ids))
+
+        samples = np.column_stack((times, xs, ys))[order]
+        sorted_classes = classes[order]
+
+        updated = set()
+        for track_id, start, stop in zip(unique_ids.tolist(), starts, stops):
+            self._append_track(track_id, samples[start:stop])
+            self.classes[track_id] = int(sorted_classes[stop - 1])
+            updated.add(track_id)
+        return updated
+
+    def _append_track(self, track_id, samples):
+        samples = samples[-self.max_points:]
+        n = len(samples)
+        buffer = self._data.get(track_id)
+        size = self._size.get(track_id, 0)
+
+        if buffer is None or size + n > len(buffer):
+            # Grow by doubling up to 2 x max_points; once there, drop the oldest samples. Either way the copy
+            # happens at most once every ~max_points appended samples
+            keep = min(size, self.max_points - n)
+            capacity = 64 if buffer is None else len(buffer)
+            while capacity < keep + n:
+                capacity *= 2
+            capacity = max(min(capacity, 2 * self.max_points), keep + n)
+
+            new_buffer = np.empty((capacity, 3), dtype = np.float64)
+            if keep:
+                new_buffer[:keep] = buffer[size - keep:size]
+            buffer, size = new_buffer, keep
+
+        buffer[size:size + n] = samples
+        self._data[track_id] = buffer
+        self._size[track_id] = size + n
+
+    def get(self, track_id):
+        '''(time, x, y) views of the buffered samples of a track'''
+        size = self._size[track_id]
+        data = self._data[track_id][max(size - self.max_points, 0):size]
+        return data[:, 0], data[:, 1], data[:, 2]
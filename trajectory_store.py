@@ -0,0 +1,393 @@
+import os
+import time
+import argparse
+from datetime import datetime
+
+import numpy as np
+import h5py
+
+from tracking_reader import TrackingTail
+
+'''
+Trajectory store: the time-series output of generate_time_series.py regrouped per track.
+
+New rows of the source file are read incrementally (TrackingTail), sorted by (track, time) and written into the
+track's extents: contiguous blocks of the `points` table reserved for one track. The first extent of a track holds
+MIN_EXTENT_ROWS points, each next one twice as many up to MAX_EXTENT_ROWS, and a sync fills the free rows of the
+track's last extent before reserving a new one, so the number of extents of a track depends on its number of points,
+not on how often the store was synced. The `extents` index keeps (track_id, start row, capacity, count, first time,
+last time) per extent; the extents of a track are in time order, so a time window is found with a binary search and
+only the overlapping extents are read. The `extents` and `tracks` tables are updated in place.
+Derived features are computed incrementally while rows arrive: per point speed (px/s) and heading (degrees), per
+track distance travelled and dwell time (time spent below DWELL_SPEED).
+
+    store = TrajectoryStore('Raw_Time_Series_Data/trajectories.h5')
+    store.sync('Raw_Time_Series_Data/tracking_data.h5')              # ingest rows added since the last sync
+    points = store.trajectory(17, start = datetime(2024, 1, 18, 10), end = datetime(2024, 1, 18, 11))
+    store.summary(17)['dwell_seconds']
+
+Times are seconds since the epoch of the GMT+1 wall clock, as in the source data. Stores written with the older
+layout (one `runs` entry per track and sync) are regrouped into extents when opened.
+
+    python3 trajectory_store.py --sync --follow
+    python3 trajectory_store.py --track 17 --start "2024-01-18 10:00" --end "2024-01-18 11:00"
+'''
+
+POINT_DTYPE = np.dtype([('time', np.float64), ('track_id', np.uint32), ('cls', np.uint8), ('x', np.float32),
+                        ('y', np.float32), ('speed', np.float32), ('heading', np.float32)])
+
+EXTENT_DTYPE = np.dtype([('track_id', np.uint32), ('start', np.uint64), ('capacity', np.uint32), ('count', np.uint32),
+                         ('t_min', np.float64), ('t_max', np.float64)])
+
+TRACK_DTYPE = np.dtype([('track_id', np.uint32), ('cls', np.uint8), ('first_time', np.float64),
+                        ('last_time', np.float64), ('count', np.uint64), ('last_x', np.float32),
+                        ('last_y', np.float32), ('distance', np.float64), ('dwell_seconds', np.float64)])
+
+# Points per extent: the first extent of a track holds MIN_EXTENT_ROWS, every next one twice as many up to MAX_EXTENT_ROWS
+MIN_EXTENT_ROWS = 64
+MAX_EXTENT_ROWS = 4096
+
+# Below this speed (px/s) an object counts as standing still for the dwell time
+DWELL_SPEED = 5.0
+
+
+def to_seconds(timestamp):
+    '''naive GMT+1 datetime --> store time'''
+    return (np.datetime64(timestamp, 'us') - np.datetime64(0, 'us')) / np.timedelta64(1, 's')
+
+
+def rows_to_times(rows, columns):
+    '''
+    Flat rows --> store time (float64 seconds) from the date/hour/minute/seconds(/microseconds) columns
+    '''
+    date = rows[:, columns['date']].astype(np.int64)
+    year, rest = np.divmod(date, 10000)
+    month, day = np.divmod(rest, 100)
+    days = ((year - 1970).astype('datetime64[Y]') + (month - 1)).astype('datetime64[M]').astype('datetime64[D]') + (day - 1)
+
+    seconds = (days - np.datetime64(0, 'D')).astype(np.float64) * 86400
+    seconds += rows[:, columns['hour']] * 3600 + rows[:, columns['minute']] * 60 + rows[:, columns['seconds']]
+    if 'microseconds' in columns:
+        seconds += rows[:, columns['microseconds']] / 1e6
+    return seconds
+
+
+def write_rows(dataset, rows, values):
+    '''
+    Write values to the given (sorted, unique) rows of a dataset, one write per contiguous range of rows
+    '''
+    breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+    for range_rows, range_values in zip(np.split(rows, breaks), np.split(values, breaks)):
+        dataset[range_rows[0]:range_rows[-1] + 1] = range_values
+
+
+class TrajectoryStore:
+    '''
+    store_path --> HDF5 file holding points, extents, tracks
+    dwell_speed --> speed (px/s) below which time counts as dwell time
+    '''
+    def __init__(self, store_path, dwell_speed = DWELL_SPEED, chunk_rows = 4096, compression = 'gzip'):
+        self.store_path = store_path
+        self.dwell_speed = dwell_speed
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+        self.file = h5py.File(store_path, 'a', libver = 'latest')
+
+        # Older stores: one run per track and sync, regrouped below
+        migrate = 'runs' in self.file
+        tracks = self.file['tracks'][:] if 'tracks' in self.file else np.empty(0, dtype = TRACK_DTYPE)
+        if migrate:
+            self.file.move('points', 'points_runs')
+            del self.file['runs']
+            if 'tracks' in self.file:
+                del self.file['tracks']
+
+        self.points = self._dataset('points', POINT_DTYPE, chunk_rows)
+        self.extents = self._dataset('extents', EXTENT_DTYPE, 1024)
+        self.tracks = self._dataset('tracks', TRACK_DTYPE, 1024)
+
+        # track_id --> (rows in the extents table, EXTENT_DTYPE array), both in time order
+        extents = self.extents[:]
+        self._index = {}
+        order = np.argsort(extents['track_id'], kind = 'stable')
+        unique_ids, starts = np.unique(extents['track_id'][order], return_index = True)
+        for track_id, rows in zip(unique_ids.tolist(), np.split(order, starts[1:])):
+            self._index[track_id] = (rows, extents[rows])
+        self._num_extents = len(extents)
+
+        # track_id --> summary row (TRACK_DTYPE), also the state for incremental features, and its row in `tracks`
+        self._tracks = {int(track['track_id']): track for track in tracks}
+        self._track_rows = {track_id: row for row, track_id in enumerate(self._tracks)}
+
+        # Rows changed since the last flush: extents row --> (track_id, position in the track's extents), track IDs
+        self._dirty_extents = {}
+        self._dirty_tracks = set(self._tracks) if migrate else set()
+
+        if migrate:
+            self._migrate_runs()
+
+    def _dataset(self, name, dtype, chunk_rows):
+        if name not in self.file:
+            self.file.create_dataset(name, shape = (0,), maxshape = (None,), chunks = (chunk_rows,), dtype = dtype,
+                                     compression = self.compression, shuffle = self.compression is not None)
+        return self.file[name]
+
+    def _migrate_runs(self, block_rows = 1 << 20):
+        '''
+        Move the points of an older store into extents. Its points are in ingestion order, so every track's points
+        stay in time order after a stable sort by track.
+        '''
+        old = self.file['points_runs']
+        for start in range(0, old.shape[0], block_rows):
+            points = old[start:start + block_rows]
+            self._store(points[np.argsort(points['track_id'], kind = 'stable')])
+        del self.file['points_runs']
+        self.flush()
+        print (f'Regrouped {old.shape[0]} points of {self.store_path} into {self._num_extents} extents')
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # ---- ingestion -------------------------------------------------------------------------------------------
+
+    def append(self, track_ids, classes, times, xs, ys):
+        '''
+        Append detections (arrays of equal length, any order). Rows of a track must arrive in time order across calls.
+        '''
+        n = len(track_ids)
+        if n == 0:
+            return 0
+
+        order = np.lexsort((times, track_ids))
+        points = np.empty(n, dtype = POINT_DTYPE)
+        points['time'] = times[order]
+        points['track_id'] = track_ids[order]
+        points['cls'] = classes[order]
+        points['x'] = xs[order]
+        points['y'] = ys[order]
+
+        # Previous point of every row: the row before in the same track, or the track's last stored point
+        prev_time = np.empty(n)
+        prev_x = np.empty(n)
+        prev_y = np.empty(n)
+        prev_time[1:], prev_x[1:], prev_y[1:] = points['time'][:-1], points['x'][:-1], points['y'][:-1]
+
+        unique_ids, starts, counts = np.unique(points['track_id'], return_index = True, return_counts = True)
+        for track_id, start in zip(unique_ids.tolist(), starts):
+            track = self._tracks.get(track_id)
+            if track is None:
+                prev_time[start], prev_x[start], prev_y[start] = points['time'][start], points['x'][start], points['y'][start]
+            else:
+                prev_time[start], prev_x[start], prev_y[start] = track['last_time'], track['last_x'], track['last_y']
+
+        dt = points['time'] - prev_time
+        dx = points['x'] - prev_x
+        dy = points['y'] - prev_y
+        step = np.hypot(dx, dy)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            points['speed'] = np.where(dt > 0, step / dt, 0.0)
+        points['heading'] = np.degrees(np.arctan2(dy, dx))
+
+        # Per track sums with one reduceat instead of a loop over rows
+        dwell = np.where(points['speed'] < self.dwell_speed, np.maximum(dt, 0.0), 0.0)
+        distance_sums = np.add.reduceat(step, starts)
+        dwell_sums = np.add.reduceat(dwell, starts)
+
+        self._store(points)
+
+        for track_id, start, count, distance, dwell_seconds in zip(unique_ids.tolist(), starts.tolist(), counts.tolist(),
+                                                                   distance_sums, dwell_sums):
+            last = start + count - 1
+            track = self._tracks.get(track_id)
+            if track is None:
+                track = np.zeros((), dtype = TRACK_DTYPE)
+                track['track_id'] = track_id
+                track['first_time'] = points['time'][start]
+                self._track_rows[track_id] = len(self._track_rows)
+            track['cls'] = points['cls'][last]
+            track['last_time'] = points['time'][last]
+            track['count'] += count
+            track['last_x'] = points['x'][last]
+            track['last_y'] = points['y'][last]
+            track['distance'] += distance
+            track['dwell_seconds'] += dwell_seconds
+            self._tracks[track_id] = track
+            self._dirty_tracks.add(track_id)
+
+        return n
+
+    def _store(self, points):
+        '''
+        Write points sorted by (track, time): first into the free rows of each track's last extent, the rest into
+        new extents reserved at the end of the points table (written with one resize and one write)
+        '''
+        unique_ids, starts, counts = np.unique(points['track_id'], return_index = True, return_counts = True)
+        first_new = allocated = self.points.shape[0]
+        new_points = []
+
+        for track_id, start, count in zip(unique_ids.tolist(), starts.tolist(), counts.tolist()):
+            rows, extents = self._index.get(track_id, (np.empty(0, dtype = np.int64), np.empty(0, dtype = EXTENT_DTYPE)))
+            track_points = points[start:start + count]
+
+            if len(extents) and extents[-1]['count'] < extents[-1]['capacity']:
+                last = extents[-1]
+                take = min(count, int(last['capacity'] - last['count']))
+                begin = int(last['start'] + last['count'])
+                self.points[begin:begin + take] = track_points[:take]
+                last['count'] += take
+                last['t_max'] = track_points['time'][take - 1]
+                self._dirty_extents[int(rows[-1])] = (track_id, len(extents) - 1)
+                track_points = track_points[take:]
+
+            while len(track_points):
+                capacity = MIN_EXTENT_ROWS if not len(extents) else min(2 * int(extents[-1]['capacity']), MAX_EXTENT_ROWS)
+                part, track_points = track_points[:capacity], track_points[capacity:]
+                extent = np.zeros(1, dtype = EXTENT_DTYPE)
+                extent['track_id'] = track_id
+                extent['start'] = allocated
+                extent['capacity'] = capacity
+                extent['count'] = len(part)
+                extent['t_min'] = part['time'][0]
+                extent['t_max'] = part['time'][-1]
+                new_points.append((allocated - first_new, part))
+                allocated += capacity
+
+                rows = np.append(rows, self._num_extents)
+                extents = np.append(extents, extent)
+                self._dirty_extents[self._num_extents] = (track_id, len(extents) - 1)
+                self._num_extents += 1
+
+            self._index[track_id] = (rows, extents)
+
+        if allocated > first_new:
+            block = np.zeros(allocated - first_new, dtype = POINT_DTYPE)
+            for offset, part in new_points:
+                block[offset:offset + len(part)] = part
+            self.points.resize((allocated,))
+            self.points[first_new:allocated] = block
+
+    def sync(self, source_path):
+        '''
+        Ingest the rows added to the source file (flat or compact schema) since the last sync
+        '''
+        tail = TrackingTail(source_path)
+        tail.offset = int(self.file.attrs.get('source_offset', 0))
+        rows = tail.read_new()
+        added = 0
+        if len(rows):
+            columns = tail.columns
+            added = self.append(rows[:, columns['track_id']].astype(np.uint32), rows[:, columns['class']].astype(np.uint8),
+                                rows_to_times(rows, columns), rows[:, columns['x']], rows[:, columns['y']])
+        self.file.attrs['source_offset'] = tail.offset
+        tail.close()
+        self.flush()
+        return added
+
+    def flush(self):
+        '''
+        Write the extents and track summaries changed since the last flush, in place
+        '''
+        if self._dirty_extents:
+            rows = np.array(sorted(self._dirty_extents))
+            extents = np.array([self._index[track_id][1][position]
+                                for track_id, position in (self._dirty_extents[row] for row in rows)], dtype = EXTENT_DTYPE)
+            if self._num_extents > self.extents.shape[0]:
+                self.extents.resize((self._num_extents,))
+            write_rows(self.extents, rows, extents)
+            self._dirty_extents.clear()
+
+        if self._dirty_tracks:
+            track_ids = sorted(self._dirty_tracks, key = self._track_rows.get)
+            rows = np.array([self._track_rows[track_id] for track_id in track_ids])
+            tracks = np.array([self._tracks[track_id] for track_id in track_ids], dtype = TRACK_DTYPE)
+            if len(self._track_rows) > self.tracks.shape[0]:
+                self.tracks.resize((len(self._track_rows),))
+            write_rows(self.tracks, rows, tracks)
+            self._dirty_tracks.clear()
+
+        self.file.flush()
+
+    # ---- queries ---------------------------------------------------------------------------------------------
+
+    def track_ids(self):
+        return sorted(self._tracks)
+
+    def summary(self, track_id):
+        '''
+        Summary of a track: class, first/last time, number of points, last position, distance (px), dwell_seconds
+        '''
+        track = self._tracks[track_id]
+        return {name: track[name].item() for name in TRACK_DTYPE.names}
+
+    def trajectory(self, track_id, start = None, end = None):
+        '''
+        Points of a track ordered by time, optionally limited to start <= time < end (datetime or store time).
+        Reads only the extents of this track that overlap the window, found by binary search on their time bounds.
+        '''
+        start = -np.inf if start is None else (to_seconds(start) if isinstance(start, datetime) else start)
+        end = np.inf if end is None else (to_seconds(end) if isinstance(end, datetime) else end)
+
+        if track_id not in self._index:
+            return np.empty(0, dtype = POINT_DTYPE)
+        extents = self._index[track_id][1]
+        first = np.searchsorted(extents['t_max'], start, side = 'left')
+        stop = np.searchsorted(extents['t_min'], end, side = 'left')
+
+        parts = []
+        for extent in extents[first:stop]:
+            begin = int(extent['start'])
+            points = self.points[begin:begin + int(extent['count'])]
+            if extent['t_min'] < start or extent['t_max'] >= end:
+                points = points[(points['time'] >= start) & (points['time'] < end)]
+            parts.append(points)
+
+        return np.concatenate(parts) if parts else np.empty(0, dtype = POINT_DTYPE)
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Trajectory Store')
+
+    # Arguments
+    parser.add_argument('--source', type = str, default = os.path.join('Raw_Time_Series_Data', 'tracking_data.h5'), help = 'Time-series file to ingest, default = Raw_Time_Series_Data/tracking_data.h5')
+    parser.add_argument('--store', type = str, default = os.path.join('Raw_Time_Series_Data', 'trajectories.h5'), help = 'Trajectory store file, default = Raw_Time_Series_Data/trajectories.h5')
+    parser.add_argument('--sync', action = 'store_true', help = 'Ingest new rows from --source')
+    parser.add_argument('--follow', action = 'store_true', help = 'Keep syncing every --interval seconds')
+    parser.add_argument('--interval', type = float, default = 5.0, help = 'Seconds between syncs with --follow, default = 5')
+    parser.add_argument('--track', type = int, default = None, help = 'Print the trajectory and features of this track ID')
+    parser.add_argument('--start', type = str, default = None, help = 'Start of the time window, e.g. "2024-01-18 10:00"')
+    parser.add_argument('--end', type = str, default = None, help = 'End of the time window, e.g. "2024-01-18 11:00"')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    with TrajectoryStore(args.store) as store:
+        if args.sync:
+            while True:
+                added = store.sync(args.source)
+                print (f'Ingested {added} rows, {len(store.track_ids())} tracks')
+                if not args.follow:
+                    break
+                time.sleep(args.interval)
+
+        if args.track is not None:
+            start = datetime.fromisoformat(args.start) if args.start else None
+            end = datetime.fromisoformat(args.end) if args.end else None
+            points = store.trajectory(args.track, start, end)
+            print (store.summary(args.track))
+            for point in points:
+                print (f"{np.datetime64(int(point['time'] * 1e6), 'us')}  x: {point['x']:.1f}  y: {point['y']:.1f}  "
+                       f"speed: {point['speed']:.1f} px/s  heading: {point['heading']:.0f}")
@@ -0,0 +1,321 @@
+import os
+import csv
+import time
+import argparse
+from collections import namedtuple
+from datetime import datetime
+
+import numpy as np
+
+from tracking_reader import TrackingTail
+from trajectory_store import rows_to_times
+
+'''
+Streaming turnaround events from the per-frame detections of generate_time_series.py (--events) or from an
+existing time-series file (python3 turnaround_events.py --follow).
+
+Every frame, service vehicles are matched to nearby aircraft through a uniform grid (cell size = leave_distance):
+aircraft are sorted by cell key and each vehicle only looks up its 3x3 neighbouring cells, all with numpy, so the
+cost grows with the number of close pairs rather than vehicles x aircraft. A contact needs arrive_seconds of
+proximity to count as an arrival and leave_seconds of absence to count as a departure (hysteresis between
+arrive_distance and leave_distance keeps jitter from toggling it). Aircraft that stand still for parked_seconds are
+parked; a parked aircraft that moves more than pushback_distance starts a pushback.
+
+Times are seconds since the epoch of the GMT+1 wall clock, as in trajectory_store.py. Event times are the frame
+times of the physical event (first / last frame in contact); latency is how much later the
+event was confirmed, in stream seconds. Tracks unseen for track_timeout seconds are dropped (closing their contacts),
+so memory stays bounded by the number of objects currently in view.
+
+    detector = TurnaroundDetector()
+    for event in detector.update(time.time() + 3600, track_ids, classes, xs, ys):
+        print (describe(event))
+'''
+
+AIRCRAFT = 0
+AIRPORT_TRACTOR = 1
+BAGGAGE_TROLLEY = 2
+CONVEYOR_BELT = 3
+FUEL_TRUCK = 4
+GROUND_CREW = 5
+PASSENGERS = 6
+PUSHBACK_TUG = 7
+
+CLASS_NAMES = {AIRCRAFT: 'Aircraft', AIRPORT_TRACTOR: 'Airport Tractor', BAGGAGE_TROLLEY: 'Baggage Trolley',
+               CONVEYOR_BELT: 'Conveyor Belt', FUEL_TRUCK: 'Fuel Truck', GROUND_CREW: 'Ground Crew',
+               PASSENGERS: 'Passengers', PUSHBACK_TUG: 'Pushback Tug'}
+
+SERVICE_VEHICLES = (AIRPORT_TRACTOR, BAGGAGE_TROLLEY, CONVEYOR_BELT, FUEL_TRUCK, PUSHBACK_TUG)
+
+# kind: 'arrived' / 'left' (vehicle at aircraft), 'parked' / 'pushback_started' (aircraft; vehicle = attached tug or -1)
+Event = namedtuple('Event', ['time', 'kind', 'aircraft_id', 'vehicle_id', 'vehicle_class', 'latency'])
+
+EVENT_FIELDS = list(Event._fields)
+
+# Cell keys pack (cell_x, cell_y) into one int64
+_CELL_OFFSET = 1 << 20
+
+
+def describe(event):
+    when = datetime.utcfromtimestamp(event.time).strftime('%H:%M:%S')
+    if event.kind in ('arrived', 'left'):
+        what = f'{CLASS_NAMES.get(event.vehicle_class, event.vehicle_class)} {event.vehicle_id} {event.kind} ' \
+               f'{"at" if event.kind == "arrived" else "from"} aircraft {event.aircraft_id}'
+    elif event.kind == 'pushback_started' and event.vehicle_id >= 0:
+        what = f'Pushback started for aircraft {event.aircraft_id} (tug {event.vehicle_id})'
+    else:
+        what = f'Aircraft {event.aircraft_id} {event.kind.replace("_", " ")}'
+    return f'{when} {what}, latency {event.latency:.1f} s'
+
+
+def write_events(csv_file, events):
+    '''
+    Append events to a CSV file (header on creation)
+    '''
+    if not events:
+        return
+    new_file = not os.path.exists(csv_file)
+    with open(csv_file, 'a', newline = '') as file:
+        writer = csv.writer(file)
+        if new_file:
+            writer.writerow(EVENT_FIELDS)
+        writer.writerows(events)
+
+
+def _cell_keys(cell_x, cell_y):
+    return (cell_x + _CELL_OFFSET) * (2 * _CELL_OFFSET) + (cell_y + _CELL_OFFSET)
+
+
+def near_pairs(aircraft_xy, vehicle_xy, max_distance):
+    '''
+    (aircraft index, vehicle index, distance) of all pairs closer than max_distance, via a uniform grid
+    '''
+    if len(aircraft_xy) == 0 or len(vehicle_xy) == 0:
+        empty = np.empty(0, dtype = np.int64)
+        return empty, empty, np.empty(0)
+
+    aircraft_cells = np.floor(aircraft_xy / max_distance).astype(np.int64)
+    aircraft_keys = _cell_keys(aircraft_cells[:, 0], aircraft_cells[:, 1])
+    order = np.argsort(aircraft_keys)
+    sorted_keys = aircraft_keys[order]
+
+    # 3x3 neighbourhood of every vehicle's cell --> ranges of aircraft in those cells
+    vehicle_cells = np.floor(vehicle_xy / max_distance).astype(np.int64)
+    offsets = np.array([(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+    neighbour_x = vehicle_cells[:, 0:1] + offsets[:, 0]
+    neighbour_y = vehicle_cells[:, 1:2] + offsets[:, 1]
+    neighbour_keys = _cell_keys(neighbour_x, neighbour_y).ravel()
+    low = np.searchsorted(sorted_keys, neighbour_keys, 'left')
+    high = np.searchsorted(sorted_keys, neighbour_keys, 'right')
+    counts = high - low
+
+    total = counts.sum()
+    if total == 0:
+        empty = np.empty(0, dtype = np.int64)
+        return empty, empty, np.empty(0)
+
+    # Expand the ranges into candidate pairs
+    vehicle_index = np.repeat(np.arange(len(neighbour_keys)) // len(offsets), counts)
+    starts = np.repeat(low - np.cumsum(counts) + counts, counts)
+    aircraft_index = order[starts + np.arange(total)]
+
+    distance = np.hypot(*(aircraft_xy[aircraft_index] - vehicle_xy[vehicle_index]).T)
+    close = distance < max_distance
+    return aircraft_index[close], vehicle_index[close], distance[close]
+
+
+class _Contact:
+    __slots__ = ('first_near', 'last_near', 'confirmed')
+
+    def __init__(self, now):
+        self.first_near = now
+        self.last_near = now
+        self.confirmed = False
+
+
+class _Aircraft:
+    __slots__ = ('anchor_x', 'anchor_y', 'anchor_time', 'last_still', 'parked', 'last_seen')
+
+    def __init__(self, x, y, now):
+        self.anchor_x, self.anchor_y, self.anchor_time = x, y, now
+        self.last_still = now
+        self.parked = False
+        self.last_seen = now
+
+
+class TurnaroundDetector:
+    '''
+    arrive_distance --> centroid distance (px) at which a service vehicle starts being in contact with an aircraft
+    leave_distance --> distance (px) beyond which a contact counts as absent (>= arrive_distance)
+    arrive_seconds / leave_seconds --> proximity / absence needed to confirm an arrival / departure
+    parked_seconds --> an aircraft within move_distance of the same spot for this long is parked
+    pushback_distance --> a parked aircraft moving this far from its parking spot starts a pushback
+    track_timeout --> forget tracks unseen for this long
+    '''
+    def __init__(self, arrive_distance = 200.0, leave_distance = 260.0, arrive_seconds = 5.0, leave_seconds = 10.0,
+                 parked_seconds = 60.0, move_distance = 15.0, pushback_distance = 40.0, track_timeout = 30.0,
+                 vehicle_classes = SERVICE_VEHICLES):
+        self.arrive_distance = arrive_distance
+        self.leave_distance = max(leave_distance, arrive_distance)
+        self.arrive_seconds = arrive_seconds
+        self.leave_seconds = leave_seconds
+        self.parked_seconds = parked_seconds
+        self.move_distance = move_distance
+        self.pushback_distance = pushback_distance
+        self.track_timeout = track_timeout
+        self.vehicle_classes = np.array(vehicle_classes)
+
+        self._aircraft = {}
+        # vehicle track ID --> (class, last seen)
+        self._vehicles = {}
+        # (aircraft ID, vehicle ID) --> _Contact
+        self._contacts = {}
+
+        self.frames = 0
+        self.events = 0
+
+    def __len__(self):
+        '''Number of tracked objects and contacts held in memory'''
+        return len(self._aircraft) + len(self._vehicles) + len(self._contacts)
+
+    def update(self, now, track_ids, classes, xs, ys):
+        '''
+        Process one frame (now: frame time in seconds). Returns the list of events confirmed by this frame.
+        '''
+        track_ids = np.asarray(track_ids, dtype = np.int64)
+        classes = np.asarray(classes, dtype = np.int64)
+        xy = np.column_stack((xs, ys)).astype(np.float64)
+        events = []
+        self.frames += 1
+
+        is_aircraft = classes == AIRCRAFT
+        is_vehicle = np.isin(classes, self.vehicle_classes)
+        aircraft_ids, aircraft_xy = track_ids[is_aircraft], xy[is_aircraft]
+        vehicle_ids, vehicle_classes, vehicle_xy = track_ids[is_vehicle], classes[is_vehicle], xy[is_vehicle]
+
+        for vehicle_id, vehicle_class in zip(vehicle_ids.tolist(), vehicle_classes.tolist()):
+            self._vehicles[vehicle_id] = (vehicle_class, now)
+
+        self._update_aircraft(now, aircraft_ids, aircraft_xy, events)
+
+        # Pairs within leave_distance; new contacts additionally need arrive_distance
+        aircraft_index, vehicle_index, distance = near_pairs(aircraft_xy, vehicle_xy, self.leave_distance)
+        for a, v, d in zip(aircraft_index.tolist(), vehicle_index.tolist(), distance.tolist()):
+            key = (int(aircraft_ids[a]), int(vehicle_ids[v]))
+            contact = self._contacts.get(key)
+            if contact is None:
+                if d < self.arrive_distance:
+                    self._contacts[key] = _Contact(now)
+                continue
+            contact.last_near = now
+
+        # Confirm arrivals and departures
+        for key, contact in list(self._contacts.items()):
+            aircraft_id, vehicle_id = key
+            vehicle_class = self._vehicles[vehicle_id][0] if vehicle_id in self._vehicles else -1
+            if contact.last_near == now:
+                if not contact.confirmed and now - contact.first_near >= self.arrive_seconds:
+                    contact.confirmed = True
+                    events.append(Event(contact.first_near, 'arrived', aircraft_id, vehicle_id, vehicle_class,
+                                        now - contact.first_near))
+            elif now - contact.last_near >= self.leave_seconds:
+                if contact.confirmed:
+                    events.append(Event(contact.last_near, 'left', aircraft_id, vehicle_id, vehicle_class,
+                                        now - contact.last_near))
+                del self._contacts[key]
+
+        self._expire(now)
+        self.events += len(events)
+        return events
+
+    def _update_aircraft(self, now, aircraft_ids, aircraft_xy, events):
+        for aircraft_id, (x, y) in zip(aircraft_ids.tolist(), aircraft_xy.tolist()):
+            aircraft = self._aircraft.get(aircraft_id)
+            if aircraft is None:
+                self._aircraft[aircraft_id] = _Aircraft(x, y, now)
+                continue
+            aircraft.last_seen = now
+            moved = np.hypot(x - aircraft.anchor_x, y - aircraft.anchor_y)
+
+            if aircraft.parked:
+                if moved >= self.pushback_distance:
+                    events.append(Event(aircraft.last_still, 'pushback_started', aircraft_id,
+                                        self._attached_tug(aircraft_id), PUSHBACK_TUG, now - aircraft.last_still))
+                    aircraft.parked = False
+                    aircraft.anchor_x, aircraft.anchor_y, aircraft.anchor_time = x, y, now
+                elif moved < self.move_distance:
+                    aircraft.last_still = now
+            elif moved >= self.move_distance:
+                aircraft.anchor_x, aircraft.anchor_y, aircraft.anchor_time = x, y, now
+            else:
+                aircraft.last_still = now
+                if now - aircraft.anchor_time >= self.parked_seconds:
+                    aircraft.parked = True
+                    events.append(Event(aircraft.anchor_time, 'parked', aircraft_id, -1, -1,
+                                        now - aircraft.anchor_time))
+
+    def _attached_tug(self, aircraft_id):
+        for (contact_aircraft, vehicle_id), contact in self._contacts.items():
+            if contact_aircraft == aircraft_id and contact.confirmed and \
+                    self._vehicles.get(vehicle_id, (None,))[0] == PUSHBACK_TUG:
+                return vehicle_id
+        return -1
+
+    def _expire(self, now):
+        # Contacts of expired tracks are closed by the leave_seconds rule above, since they are no longer near
+        self._aircraft = {track_id: aircraft for track_id, aircraft in self._aircraft.items()
+                          if now - aircraft.last_seen < self.track_timeout}
+        self._vehicles = {track_id: vehicle for track_id, vehicle in self._vehicles.items()
+                          if now - vehicle[1] < self.track_timeout}
+
+
+def replay(tail, detector, csv_file = None):
+    '''
+    Feed the rows appended to a time-series file to the detector, frame by frame. Returns the events.
+    '''
+    rows = tail.read_new()
+    if len(rows) == 0:
+        return []
+
+    columns = tail.columns
+    times = rows_to_times(rows, columns)
+    # Rows of a frame share the timestamp --> split at every change
+    boundaries = np.flatnonzero(np.diff(times)) + 1
+    events = []
+    for start, stop in zip(np.r_[0, boundaries], np.r_[boundaries, len(rows)]):
+        frame = rows[start:stop]
+        events += detector.update(times[start], frame[:, columns['track_id']], frame[:, columns['class']],
+                                  frame[:, columns['x']], frame[:, columns['y']])
+    if csv_file is not None:
+        write_events(csv_file, events)
+    return events
+
+
+def parse_arguments():
+    '''
+        Command Line Argument Parser
+    '''
+    parser = argparse.ArgumentParser('Turnaround Events')
+
+    # Arguments
+    parser.add_argument('--source', type = str, default = os.path.join('Raw_Time_Series_Data', 'tracking_data.h5'), help = 'Time-series file to read, default = Raw_Time_Series_Data/tracking_data.h5')
+    parser.add_argument('--output', type = str, default = os.path.join('Raw_Time_Series_Data', 'turnaround_events.csv'), help = 'CSV file the events are appended to, default = Raw_Time_Series_Data/turnaround_events.csv')
+    parser.add_argument('--follow', action = 'store_true', help = 'Keep reading new rows every --interval seconds')
+    parser.add_argument('--interval', type = float, default = 1.0, help = 'Seconds between reads with --follow, default = 1')
+    parser.add_argument('--arrive_distance', type = float, default = 200.0, help = 'Vehicle to aircraft distance (px) for a contact, default = 200')
+    parser.add_argument('--leave_distance', type = float, default = 260.0, help = 'Distance (px) beyond which a contact is absent, default = 260')
+
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    detector = TurnaroundDetector(arrive_distance = args.arrive_distance, leave_distance = args.leave_distance)
+    with TrackingTail(args.source) as tail:
+        while True:
+            for event in replay(tail, detector, args.output):
+                print (describe(event))
+            if not args.follow:
+                break
+            time.sleep(args.interval)
@@ -0,0 +1,137 @@
+import os
+import time
+import math
+from datetime import datetime, timezone, timedelta
+
+import numpy as np
+
+from weather_provider import WeatherObservation, MISSING_OBSERVATION, NUM_WEATHER_VALUES
+
+'''
+Locally cached hourly weather history for offline re-processing (backfill_time_series.py).
+
+Archived video needs the weather at the time it was recorded, not the current weather. The hourly history is
+fetched from the Open-Meteo archive once per UTC day and kept as a small .npy file per day
+(weather_history/YYYY-MM-DD.npy, 24 rows of unix hour + the 6 weather values), so re-running a backfill never calls
+the API again. Recent days the archive does not have yet (NaN values) are not cached and are retried next time.
+
+    history = WeatherHistory('Raw_Time_Series_Data/weather_history')
+    history.prefetch(start_s, end_s)                 # one API call for all missing days
+    values = history.values(unix_seconds)            # (n, 6), NaN where unknown
+    observation = history.observation(unix_s)        # WeatherObservation of the hour
+'''
+
+DAY_SECONDS = 86400
+
+# Days younger than this may still get filled in by the archive
+ARCHIVE_DELAY_DAYS = 7
+
+
+def day_of(unix_seconds):
+    return datetime.fromtimestamp(unix_seconds, tz = timezone.utc).strftime('%Y-%m-%d')
+
+
+class WeatherHistory:
+    '''
+    cache_dir --> folder of the per-day .npy files
+    offline --> never call the API, days missing from the cache are NaN
+    '''
+    def __init__(self, cache_dir = os.path.join('Raw_Time_Series_Data', 'weather_history'), offline = False,
+                 retries = 3, backoff_factor = 0.5):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        os.makedirs(cache_dir, exist_ok = True)
+
+        # UTC day (YYYY-MM-DD) --> (24, 1 + NUM_WEATHER_VALUES) array
+        self._days = {}
+
+    def _path(self, day):
+        return os.path.join(self.cache_dir, f'{day}.npy')
+
+    def _missing_day(self, day):
+        start = datetime.strptime(day, '%Y-%m-%d').replace(tzinfo = timezone.utc).timestamp()
+        table = np.full((24, 1 + NUM_WEATHER_VALUES), np.nan)
+        table[:, 0] = start + 3600 * np.arange(24)
+        return table
+
+    def _load(self, day):
+        table = self._days.get(day)
+        if table is None:
+            path = self._path(day)
+            table = np.load(path) if os.path.exists(path) else None
+            if table is not None:
+                self._days[day] = table
+        return table
+
+    def _fetch(self, days):
+        import requests
+        import openmeteo_requests
+        from retry_requests import retry
+        from live_weather import fetch_hourly_weather
+
+        client = openmeteo_requests.Client(session = retry(requests.Session(), retries = self.retries,
+                                                           backoff_factor = self.backoff_factor))
+        times, values = fetch_hourly_weather(client, days[0], days[-1])
+
+        recent = day_of(time.time() - ARCHIVE_DELAY_DAYS * DAY_SECONDS)
+        for day in days:
+            table = self._missing_day(day)
+            rows = np.searchsorted(times, table[:, 0])
+            found = (rows < len(times)) & (times[np.minimum(rows, len(times) - 1)] == table[:, 0])
+            table[found, 1:] = values[rows[found]]
+
+            self._days[day] = table
+            if day < recent or not np.isnan(table[:, 1:]).any():
+                np.save(self._path(day), table)
+
+    def prefetch(self, start_s, end_s):
+        '''
+        Make sure every UTC day between the two unix times is cached (one API call for the missing ones)
+        '''
+        days = []
+        day = datetime.fromtimestamp(start_s, tz = timezone.utc).date()
+        last = datetime.fromtimestamp(end_s, tz = timezone.utc).date()
+        while day <= last:
+            days.append(day.strftime('%Y-%m-%d'))
+            day += timedelta(days = 1)
+
+        missing = [day for day in days if self._load(day) is None]
+        if missing and not self.offline:
+            try:
+                self._fetch(missing)
+                print (f'Weather history: fetched {len(missing)} day(s) {missing[0]} .. {missing[-1]}')
+            except Exception as e:
+                print (f'An error occured while retrieving the weather history: {e}')
+        for day in missing:
+            self._days.setdefault(day, self._missing_day(day))
+
+    def values(self, unix_seconds):
+        '''
+        (n, 6) weather values of the hour each time falls into
+        '''
+        unix_seconds = np.asarray(unix_seconds, dtype = np.float64).reshape(-1)
+        out = np.full((len(unix_seconds), NUM_WEATHER_VALUES), np.nan)
+        if len(unix_seconds) == 0:
+            return out
+
+        hours = np.floor(unix_seconds / 3600).astype(np.int64)
+        for hour in np.unique(hours):
+            table = self._load(day_of(hour * 3600))
+            if table is None:
+                self.prefetch(hour * 3600, hour * 3600)
+                table = self._days[day_of(hour * 3600)]
+            out[hours == hour] = table[hour % 24, 1:]
+        return out
+
+    def observation(self, unix_s):
+        '''
+        WeatherObservation of the hour of unix_s. fetched_at is the hour as well, so every hour is its own
+        observation (compact schema weather rows).
+        '''
+        values = self.values([unix_s])[0]
+        if np.isnan(values).all():
+            return MISSING_OBSERVATION
+        hour = math.floor(unix_s / 3600) * 3600.0
+        return WeatherObservation(tuple(values.tolist()), hour, hour, False)
@@ -0,0 +1,125 @@
+import threading
+import time
+import math
+from collections import namedtuple
+
+import requests
+import openmeteo_requests
+from retry_requests import retry
+
+from live_weather import fetch_current_weather, WEATHER_API_URL
+
+'''
+Background weather provider for the tracking loop.
+
+A daemon thread refreshes the current Open-Meteo observation every REFRESH_INTERVAL seconds and keeps the latest
+result in memory, so per-frame lookups (`current()`) never touch the network or disk. Every observation carries the
+time it was observed by Open-Meteo and the time it was fetched, so callers can tell how stale it is. If no observation
+has been fetched yet, or the latest one is older than MAX_AGE seconds, `current()` falls back to NaN weather values.
+
+Usage:
+    with WeatherProvider(refresh_interval = 300) as weather:
+        for result in model.track(...):
+            observation = weather.current()
+            temperature = observation.values[0]
+
+Point `url` at a local HTTP stub to test without Open-Meteo.
+'''
+
+# Temp (C) 2m | Humidity (%) 2m | Rain (mm) | Showers (mm) | Snowfall (cm) | Cloud Cover (%)
+NUM_WEATHER_VALUES = 6
+MISSING_WEATHER = (math.nan,) * NUM_WEATHER_VALUES
+
+# values: weather tuple in the order above, observed_at: Open-Meteo observation time, fetched_at: local fetch time
+# (both unix seconds, NaN when missing), stale: True if the values are a fallback
+WeatherObservation = namedtuple('WeatherObservation', ['values', 'observed_at', 'fetched_at', 'stale'])
+
+MISSING_OBSERVATION = WeatherObservation(MISSING_WEATHER, math.nan, math.nan, True)
+
+
+class WeatherProvider:
+    '''
+    Polls the weather API on a background thread and serves the latest observation from memory.
+
+    refresh_interval --> seconds between API calls
+    max_age --> observations fetched longer ago than this (seconds) are treated as missing
+    url --> weather API endpoint, e.g. a local stub for testing
+    '''
+    def __init__(self, refresh_interval = 300, max_age = 1800, url = WEATHER_API_URL, retries = 3, backoff_factor = 0.5):
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+        self.url = url
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+        # Replaced wholesale by the poller; reading a single attribute needs no lock
+        self._observation = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._client = None
+
+    def _make_client(self):
+        # A plain session: freshness is handled by refresh_interval, an HTTP cache would only serve old values
+        retry_session = retry(requests.Session(), retries = self.retries, backoff_factor = self.backoff_factor)
+        return openmeteo_requests.Client(session = retry_session)
+
+    def refresh(self):
+        '''
+        Fetch a new observation. Returns True on success; on failure the previous observation is kept.
+        '''
+        if self._client is None:
+            self._client = self._make_client()
+
+        try:
+            values, observed_at = fetch_current_weather(self._client, url = self.url)
+        except Exception as e:
+            print (f'An error occured while retrieving weather update: {e}')
+            return False
+
+        self._observation = WeatherObservation(values, observed_at, time.time(), False)
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.refresh()
+            self._stop_event.wait(self.refresh_interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target = self._run, name = 'weather-provider', daemon = True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout = None):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def latest(self):
+        '''
+        Latest fetched observation regardless of its age, or None if nothing has been fetched yet.
+        '''
+        return self._observation
+
+    def current(self, now = None):
+        '''
+        Latest observation if it is fresh enough, otherwise NaN weather values flagged as stale.
+        The stale fallback keeps the timestamps of the last good observation (if any).
+        '''
+        observation = self._observation
+        if observation is None:
+            return MISSING_OBSERVATION
+
+        now = time.time() if now is None else now
+        if now - observation.fetched_at > self.max_age:
+            return WeatherObservation(MISSING_WEATHER, observation.observed_at, observation.fetched_at, True)
+
+        return observation